@@ -0,0 +1,97 @@
+import threading
+
+# Индекс текущих балансов по (источник, валюта) - то же правило, что в формуле колонки E листа "fact":
+# строки категории "💰 ДОХОДЫ" прибавляются, все остальные вычитаются.
+
+INCOME_CATEGORY = "💰 ДОХОДЫ"
+
+
+def signed_amount(category, amount) -> float:
+    if amount is None or amount == '':
+        return 0.0
+    amount = float(amount)
+    return amount if category == INCOME_CATEGORY else -amount
+
+
+def ledger_totals(ledger, where: str = '', params: tuple = ()) -> dict:
+    # Балансы по (источник, валюта) одним агрегирующим запросом к зеркалу
+    query = ('SELECT source, currency, SUM(CASE WHEN category = ? THEN amount ELSE -amount END) '
+             'FROM fact WHERE amount IS NOT NULL')
+    if where:
+        query += ' AND ' + where
+    rows = ledger.execute(query + ' GROUP BY source, currency', (INCOME_CATEGORY,) + tuple(params))
+    return {(source, currency): total or 0.0 for source, currency, total in rows}
+
+
+class BalanceIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._balances = {}
+
+    def rebuild_from_ledger(self, ledger):
+        balances = ledger_totals(ledger)
+        with self._lock:
+            self._balances = balances
+
+    def apply_rows(self, rows: list[dict]):
+        # Слушатель зеркала "fact": новые строки (записанные ботом или дочитанные из таблицы)
+        with self._lock:
+            for row in rows:
+                key = (row['source'], row['currency'])
+                self._balances[key] = self._balances.get(key, 0.0) + signed_amount(row['category'], row['amount'])
+
+    def preview(self, rows: list[list]) -> list[float]:
+        # Нарастающие балансы для ещё не записанных строк (в формате записи бота), индекс не меняется
+        running = {}
+        result = []
+        with self._lock:
+            for row in rows:
+                category, amount, currency, source = row[1], row[3], row[5], row[6]
+                key = (source, currency)
+                balance = running.get(key, self._balances.get(key, 0.0)) + signed_amount(category, amount)
+                running[key] = balance
+                result.append(round(balance, 2))
+        return result
+
+    def replace(self, balances: dict):
+        with self._lock:
+            self._balances = dict(balances)
+
+    def get(self, source: str, currency: str) -> float:
+        with self._lock:
+            return self._balances.get((source, currency), 0.0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._balances)
+
+
+def running_balances(rows: list[dict]) -> list[float]:
+    # Нарастающий баланс для каждой строки зеркала (строки в порядке номеров) - для заполнения колонки E
+    balances = {}
+    result = []
+    for row in rows:
+        key = (row['source'], row['currency'])
+        balances[key] = balances.get(key, 0.0) + signed_amount(row['category'], row['amount'])
+        result.append(round(balances[key], 2))
+    return result
+
+
+def totals(records) -> dict:
+    # Итоговые балансы по (источник, валюта) для набора строк (dict с category, amount, source, currency)
+    result = {}
+    for record in records:
+        if record['amount'] is None:
+            continue
+        key = (record['source'], record['currency'])
+        result[key] = result.get(key, 0.0) + signed_amount(record['category'], record['amount'])
+    return result
+
+
+def diff_balances(expected: dict, actual: dict, tolerance: float = 0.005) -> dict:
+    # Ключи, по которым балансы расходятся: ключ -> (ожидаемое, фактическое)
+    return {
+        key: (expected.get(key, 0.0), actual.get(key, 0.0))
+        for key in set(expected) | set(actual)
+        if abs(expected.get(key, 0.0) - actual.get(key, 0.0)) > tolerance
+    }
@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import legacy_sms_parser
+import sms_parser
+
+# Сравнение парсера СМС с прежней реализацией: сначала проверка, что на эталонном наборе СМС
+# результаты совпадают полностью, затем замер пропускной способности (сообщений в секунду).
+#
+# Запуск: python benchmarks/bench_sms_parser.py [повторов]
+
+GOLDEN_SMS = [
+    "Karta *1234 Pokupka: 150000.00 UZS 12.05.2024 10:15 KORZINKA TASHKENT",
+    "Karta *1234 Summa: 25000,50 UZS 01.06.24 09:00 XARID MAGAZIN",
+    "Schet po karte *5678 zachislenie 1500000 UZS 15-04-2024 18:30",
+    "OTMENA E-Com oplata: summa: 49900 UZS 05-MAR-2024 11:45 YANDEX GO",
+    "OTMENA E-Com oplata: summa: -49900 UZS 05-MAR-2024 11:45 YANDEX GO",
+    "E-Com oplata: 12000 UZS 03/02/24 23:59 CLICK",
+    "Pokupka: 350.25 RUB 28.02 14:20 OZON",
+    "Platezh: 99 USD 29.02 12:00 NETFLIX",
+    "Perevod na kartu: 500000 UZS 10.10.2023 08:05",
+    "Perevod na kartu: zachisl 500000 UZS 10.10.2023 08:05",
+    "Karta *1111 popolnen 200 EUR 31.12.2023 23:00",
+    "Karta *2222 Поступление 1000 RUB 07.07.2024 07:07",
+    "Karta *3333 списание 1000 RUB 07.07.2024 07:07",
+    "Karta *4444 spisan -300 UZS 08.08.24 08:08",
+    "Karta *5555 0 UZS 01.01.2024 00:00",
+    "Karta *6666 oplata 15000 UZS 31.02.2024 10:00 26.05.24 11:00",
+    "Karta *7777 oplata 15000 UZS 32-XYZ-2024 10:00 26.05 11:00",
+    "Karta *8888 oplata 15000 UZS 26.05 11:00 27.05.2024 12:00",
+    "Karta *9999 oplata 15000 UZS 01.02.03 04:05",
+    "Karta *9999 oplata 15000 UZS 31.02.03 04:05",
+    "Karta *0000 oplata 15000 UZS без даты",
+    "Karta *0001 без суммы 12.05.2024 10:15",
+    "Karta *0002 summa 1 200 UZS 12.05.2024 10:15",
+    "Karta *0003 ZACHISLENIE 77.7 usd 01-JAN-2025 00:01",
+    "Karta *0004 pokupka 77.7 eur 01-jan-2025 00:01 perevod na kartu",
+]
+
+
+def _golden_inputs() -> list[str]:
+    inputs = list(GOLDEN_SMS)
+    # Вставка нескольких СМС одним сообщением, включая повторы (проверяется и дедупликация)
+    inputs.append("\n".join(GOLDEN_SMS))
+    inputs.append(" ".join(GOLDEN_SMS + GOLDEN_SMS[:5]))
+    inputs.append("мусор перед СМС " + "\n\n".join(reversed(GOLDEN_SMS)))
+    return inputs
+
+
+def check_golden() -> int:
+    current_year = time.localtime().tm_year
+    mismatches = 0
+    for sms in GOLDEN_SMS:
+        expected = legacy_sms_parser._parse_one_sms(sms, current_year)
+        actual = sms_parser._parse_one_sms(sms, current_year)
+        if expected != actual:
+            mismatches += 1
+            print(f"РАСХОЖДЕНИЕ _parse_one_sms: {sms!r}\n  было:  {expected}\n  стало: {actual}")
+    for text in _golden_inputs():
+        expected = legacy_sms_parser.parse_sms_by_date(text)
+        actual = sms_parser.parse_sms_by_date(text)
+        if expected != actual:
+            mismatches += 1
+            print(f"РАСХОЖДЕНИЕ parse_sms_by_date: {text[:60]!r}...\n  было:  {expected}\n  стало: {actual}")
+    return mismatches
+
+
+def _throughput(parse, text: str, messages: int, repeats: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeats):
+        parse(text)
+    elapsed = time.perf_counter() - started
+    return messages * repeats / elapsed
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    mismatches = check_golden()
+    print(f"Эталонный набор: {len(GOLDEN_SMS)} СМС, {len(_golden_inputs())} вставок, расхождений: {mismatches}")
+    if mismatches:
+        sys.exit(1)
+
+    paste = "\n".join(GOLDEN_SMS * 4)
+    messages = len(sms_parser.split_sms(paste))
+    before = _throughput(legacy_sms_parser.parse_sms_by_date, paste, messages, repeats)
+    after = _throughput(sms_parser.parse_sms_by_date, paste, messages, repeats)
+    print(f"parse_sms_by_date, {messages} СМС во вставке x {repeats} повторов:")
+    print(f"  было:  {before:,.0f} сообщений/сек")
+    print(f"  стало: {after:,.0f} сообщений/сек ({after / before:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
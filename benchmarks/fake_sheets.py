@@ -0,0 +1,197 @@
+import json
+import random
+import re
+import threading
+import time
+
+import requests
+from gspread.exceptions import APIError, WorksheetNotFound
+
+# Таблица Google Sheets в памяти для нагрузочного стенда: те же методы Spreadsheet/Worksheet gspread,
+# которыми пользуется бот (worksheet, get, get_all_values, col_values, append_rows, update),
+# с настраиваемой задержкой каждого вызова и долей ошибок API (429/503, как у настоящего сервиса).
+# Вызовы выполняются в потоках шлюза, поэтому задержка - обычный time.sleep.
+
+_CELL_RE = re.compile(r'^([A-Z]+)(\d+)?$')
+
+
+def _column_index(letters: str) -> int:
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index
+
+
+def _parse_range(range_name: str):
+    # 'A2:H100', 'A2:H', 'E5' -> (первая строка, первая колонка, последняя строка или None, последняя колонка)
+    range_name = range_name.split('!')[-1]
+    start, _, end = range_name.partition(':')
+    start_match = _CELL_RE.match(start)
+    end_match = _CELL_RE.match(end or start)
+    first_row = int(start_match.group(2) or 1)
+    last_row = int(end_match.group(2)) if end_match.group(2) else None
+    return first_row, _column_index(start_match.group(1)), last_row, _column_index(end_match.group(1))
+
+
+def make_api_error(code: int, message: str = 'Injected error') -> APIError:
+    response = requests.Response()
+    response.status_code = code
+    response._content = json.dumps({'error': {'code': code, 'message': message, 'status': 'UNAVAILABLE'}}).encode()
+    if code == 429:
+        response.headers['Retry-After'] = '1'
+    return APIError(response)
+
+
+class FakeBackend:
+    # Общие для всех листов параметры: задержка вызова (мс, с разбросом) и доля ошибок
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.errors = 0
+
+    def before_call(self, method: str):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            delay = max(0.0, self.latency_ms + self._rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+                code = self._rng.choice((429, 503))
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise make_api_error(code)
+
+
+class FakeWorksheet:
+    def __init__(self, backend: FakeBackend, title: str, rows: list[list] = None, sheet_id: int = 0):
+        self.backend = backend
+        self.title = title
+        self.id = sheet_id
+        self._rows = [list(row) for row in rows or []]
+        self._lock = threading.Lock()
+
+    @property
+    def row_count(self) -> int:
+        return max(1000, len(self._rows))
+
+    def get_all_values(self, **kwargs) -> list[list]:
+        self.backend.before_call('get_all_values')
+        with self._lock:
+            return [list(row) for row in self._rows]
+
+    def get(self, range_name: str, **kwargs) -> list[list]:
+        self.backend.before_call('get')
+        first_row, first_col, last_row, last_col = _parse_range(range_name)
+        with self._lock:
+            values = [row[first_col - 1:last_col] for row in self._rows[first_row - 1:last_row]]
+        # Как и API, пустые строки в конце диапазона не возвращаются
+        while values and not any(values[-1]):
+            values.pop()
+        return values
+
+    def col_values(self, col: int, **kwargs) -> list:
+        self.backend.before_call('col_values')
+        with self._lock:
+            values = [row[col - 1] if len(row) >= col else '' for row in self._rows]
+        while values and values[-1] in ('', None):
+            values.pop()
+        return values
+
+    def append_rows(self, values: list[list], value_input_option: str = None, **kwargs) -> dict:
+        self.backend.before_call('append_rows')
+        with self._lock:
+            first_row = len(self._rows) + 1
+            self._rows.extend(list(row) for row in values)
+            last_row = len(self._rows)
+        return {'updates': {'updatedRange': f"'{self.title}'!A{first_row}:H{last_row}", 'updatedRows': len(values)}}
+
+    def append_row(self, values: list, value_input_option: str = None, **kwargs) -> dict:
+        return self.append_rows([values], value_input_option=value_input_option, **kwargs)
+
+    def update(self, values: list[list] = None, range_name: str = None, **kwargs) -> dict:
+        self.backend.before_call('update')
+        first_row, first_col, _, _ = _parse_range(range_name)
+        with self._lock:
+            for i, row_values in enumerate(values):
+                row_index = first_row - 1 + i
+                while len(self._rows) <= row_index:
+                    self._rows.append([])
+                row = self._rows[row_index]
+                for j, value in enumerate(row_values):
+                    while len(row) < first_col + j:
+                        row.append('')
+                    row[first_col - 1 + j] = value
+        return {'updatedRange': f"'{self.title}'!{range_name}"}
+
+
+class FakeSpreadsheet:
+    def __init__(self, backend: FakeBackend, sheets: dict[str, list[list]], spreadsheet_id: str = 'fake-spreadsheet'):
+        self.backend = backend
+        self.id = spreadsheet_id
+        self._worksheets = {
+            title: FakeWorksheet(backend, title, rows, sheet_id=i) for i, (title, rows) in enumerate(sheets.items())
+        }
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        self.backend.before_call('worksheet')
+        try:
+            return self._worksheets[title]
+        except KeyError:
+            raise WorksheetNotFound(title)
+
+    def worksheets(self) -> list[FakeWorksheet]:
+        self.backend.before_call('worksheets')
+        return list(self._worksheets.values())
+
+
+FACT_HEADER = ['Дата', 'Категория', 'Подкатегория', 'Сумма', 'Баланс', 'Комментарий', 'Валюта', 'Источник', 'Сумма (UZS)']
+
+
+def system_rows(categories: list, subcategories: dict, sources: list) -> list[list]:
+    # Лист "system": A - категория, B - подкатегория, F - источник (строка на каждую подкатегорию)
+    rows = [['Категория', 'Подкатегория', '', '', '', 'Источник']]
+    for category in categories:
+        for subcategory in subcategories.get(category) or ['']:
+            rows.append([category, subcategory, '', '', '', ''])
+    for i, source in enumerate(sources):
+        if i + 1 < len(rows):
+            rows[i + 1][5] = source
+        else:
+            rows.append(['', '', '', '', '', source])
+    return rows
+
+
+FX_ROWS = [['Валюта', 'Курс'], ['USD', 12700], ['EUR', 13800], ['RUB', 140]]
+
+
+def make_budget_spreadsheet(backend: FakeBackend, categories: list, subcategories: dict, sources: list,
+                            fact_rows: list[list] = None, spreadsheet_id: str = 'fake-spreadsheet',
+                            fx_rows: list[list] = FX_ROWS) -> FakeSpreadsheet:
+    sheets = {
+        'system': system_rows(categories, subcategories, sources),
+        'fact': [FACT_HEADER] + [list(row) for row in fact_rows or []],
+    }
+    if fx_rows:
+        sheets['fx'] = [list(row) for row in fx_rows]
+    return FakeSpreadsheet(backend, sheets, spreadsheet_id=spreadsheet_id)
+
+
+class FakeClient:
+    # Вместо gspread.Client: open_by_key создаёт таблицу через factory(spreadsheet_id) при первом открытии
+    def __init__(self, backend: FakeBackend, factory):
+        self.backend = backend
+        self.factory = factory
+        self.spreadsheets = {}
+        self._lock = threading.Lock()
+
+    def open_by_key(self, spreadsheet_id: str) -> FakeSpreadsheet:
+        self.backend.before_call('open_by_key')
+        with self._lock:
+            if spreadsheet_id not in self.spreadsheets:
+                self.spreadsheets[spreadsheet_id] = self.factory(spreadsheet_id)
+            return self.spreadsheets[spreadsheet_id]
@@ -0,0 +1,122 @@
+import re
+from datetime import datetime
+
+# Парсер СМС в том виде, в каком он был до перехода на sms_parser.py.
+# Используется только бенчмарком как эталон: новый парсер должен давать тот же результат.
+
+MONTH_MAP = {
+    'JAN': 1, 'FEB': 2, 'MAR': 3, 'APR': 4, 'MAY': 5, 'JUN': 6,
+    'JUL': 7, 'AUG': 8, 'SEP': 9, 'OCT': 10, 'NOV': 11, 'DEC': 12
+}
+
+
+def _parse_one_sms(sms_text: str, current_year: int) -> dict:
+    res = {'дата': None, 'сумма': None, 'валюта_из_смс': None, 'операция': 'неизвестно'}
+    text = sms_text.strip()
+    low = text.lower()
+
+    m_sum_specific = re.search(
+        r'summa:?\s*(-?\d+(?:[.,]\d+)?)\s*,?\s*(UZS|RUB|USD|EUR)\b',
+        text,
+        flags=re.IGNORECASE
+    )
+    m_sum_to_use = None
+    if m_sum_specific:
+        m_sum_to_use = m_sum_specific
+    else:
+        m_sum_general = re.search(
+            r'(-?\d+(?:[.,]\d+)?)\s*,?\s*(UZS|RUB|USD|EUR)\b',
+            text,
+            flags=re.IGNORECASE
+        )
+        m_sum_to_use = m_sum_general
+
+    if m_sum_to_use:
+        amt_str = m_sum_to_use.group(1).replace(',', '.')
+        try:
+            res['сумма'] = float(amt_str)
+            res['валюта_из_смс'] = m_sum_to_use.group(2).upper()
+        except ValueError:
+            pass
+
+    dt = None
+    date_parse_patterns = [
+        (r'(\d{2}-[A-Za-z]{3}-\d{4}\s+\d{2}:\d{2})', 'custom_day_mon_year_time'),
+        (r'(\d{2}\.\d{2}\.\d{4}\s+\d{2}:\d{2})', '%d.%m.%Y %H:%M'),
+        (r'(\d{2}-\d{2}-\d{4}\s+\d{2}:\d{2})', '%d-%m-%Y %H:%M'),
+        (r'(\d{2}\.\d{2}\.\d{2}\s+\d{2}:\d{2})', '%d.%m.%y %H:%M'),
+        (r'(\d{2}/\d{2}/\d{2}\s+\d{2}:\d{2})', '%d/%m/%y %H:%M'),
+        (r'(\d{2}\.\d{2}\s+\d{2}:\d{2})', '%d.%m %H:%M'),
+    ]
+
+    for pat_regex, fmt_or_handler in date_parse_patterns:
+        if dt: break
+        m_date = re.search(pat_regex, text)
+        if m_date:
+            try:
+                parsed_datetime_obj = None
+                date_str_matched = m_date.group(1)
+                if fmt_or_handler == 'custom_day_mon_year_time':
+                    sub_match = re.match(r'(\d{2})-([A-Za-z]{3})-(\d{4})\s+(\d{2}:\d{2})', date_str_matched)
+                    if sub_match:
+                        day_s, mon_s, year_s, time_s = sub_match.groups()
+                        month_num = MONTH_MAP.get(mon_s.upper())
+                        if month_num:
+                            std_date_str = f"{day_s}-{month_num:02d}-{year_s} {time_s}"
+                            parsed_datetime_obj = datetime.strptime(std_date_str, '%d-%m-%Y %H:%M')
+                else:
+                    parsed_datetime_obj = datetime.strptime(date_str_matched, fmt_or_handler)
+
+                if fmt_or_handler == '%d.%m %H:%M' and parsed_datetime_obj:
+                    dt = parsed_datetime_obj.replace(year=current_year)
+                else:
+                    dt = parsed_datetime_obj
+            except ValueError:
+                pass
+    res['дата'] = dt
+
+    if res['сумма'] is not None:
+        op_type = 'неизвестно'
+        income_keywords = ['поступлен', 'zachisl', 'zachislenie', 'popolnen']
+        expense_keywords_for_positive_sum = ['xarid', 'pokupka', 'списан', 'spisan', 'oplata', 'platezh']
+
+        if 'otmena' in low:
+            op_type = 'доход' if res['сумма'] > 0 else ('расход' if res['сумма'] < 0 else 'неизвестно')
+        elif res['сумма'] < 0:
+            op_type = 'расход'
+        else:
+            is_explicit_income = any(keyword in low for keyword in income_keywords)
+            is_explicit_expense = any(keyword in low for keyword in expense_keywords_for_positive_sum)
+
+            if is_explicit_income:
+                op_type = 'доход'
+            elif is_explicit_expense:
+                op_type = 'расход'
+            elif 'perevod na kartu' in low:
+                op_type = 'расход' if not is_explicit_income and res['сумма'] >= 0 else 'доход'
+            elif res['сумма'] > 0:
+                op_type = 'доход'
+        res['операция'] = op_type
+    return res
+
+
+def parse_sms_by_date(input_text: str) -> list[dict]:
+    current_year = datetime.now().year
+    final_sms_start_patterns = [
+        r'Karta\s+\*\d{4}', r'Schet\s+po\s+karte\s+\*\d{4}',
+        r'OTMENA\s+E-Com\s+oplata:', r'Pokupka:', r'E-Com\s+oplata:',
+        r'Platezh:', r'Perevod na kartu:',
+    ]
+    combined_start_pattern = r'(?=(' + '|'.join(final_sms_start_patterns) + r'))'
+    raw_sms_list = re.split(combined_start_pattern, input_text)
+    actual_sms_messages = [sms.strip() for sms in raw_sms_list if sms and sms.strip()]
+    parsed_records = [_parse_one_sms(m, current_year) for m in actual_sms_messages]
+    unique_records = []
+    seen_keys = set()
+    for record in parsed_records:
+        if record['дата'] and record['сумма'] is not None:
+            record_key = (record['дата'], record['сумма'], record['операция'])
+            if record_key not in seen_keys:
+                seen_keys.add(record_key)
+                unique_records.append(record)
+    return unique_records
@@ -0,0 +1,342 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+# Нагрузочный стенд: приложение из bot.build_application() с поддельным ботом Telegram (ответы API
+# формируются в памяти) и таблицей Google Sheets в памяти с задержкой и ошибками. Несколько пользователей
+# одновременно проходят сценарии - ручной ввод, вставка СМС, навигация по кнопкам; каждый шаг ждёт ответа
+# бота, как настоящий пользователь. Считаются p50/p95/p99 задержки ответа по видам шагов, время до
+# подтверждения записи и пропускная способность.
+#
+# Запуск: python benchmarks/load_harness.py [--users 20] [--iterations 5] [--sheets-latency-ms 150]
+#         [--sheets-error-rate 0.02] [--output результат.json]
+
+SCENARIOS = ('manual_entry', 'sms_paste', 'navigation')
+CONFIRM_PREFIXES = ('Данные успешно записаны', 'Записаны ')
+ACCEPTED_PREFIX = 'Принято'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Нагрузочный стенд бота с поддельными Telegram и Google Sheets')
+    parser.add_argument('--users', type=int, default=20, help='одновременных пользователей')
+    parser.add_argument('--iterations', type=int, default=5, help='сценариев на пользователя')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='сценарии через запятую')
+    parser.add_argument('--categories', type=int, default=20, help='категорий в листе "system"')
+    parser.add_argument('--sms-per-paste', type=int, default=10, help='СМС в одной вставке')
+    parser.add_argument('--think-ms', type=float, default=0.0, help='пауза пользователя между шагами')
+    parser.add_argument('--sheets-latency-ms', type=float, default=150.0, help='задержка вызова Google Sheets')
+    parser.add_argument('--sheets-jitter-ms', type=float, default=50.0, help='разброс задержки Google Sheets')
+    parser.add_argument('--sheets-error-rate', type=float, default=0.0, help='доля вызовов Google Sheets с ошибкой')
+    parser.add_argument('--telegram-latency-ms', type=float, default=30.0, help='задержка вызова Bot API')
+    parser.add_argument('--quota-per-minute', type=int, help='квота чтений и записей в минуту (по умолчанию из config)')
+    parser.add_argument('--tenants', type=int, default=0,
+                        help='режим нескольких таблиц: пользователи распределяются по стольким таблицам (0 - одна таблица)')
+    parser.add_argument('--tenant-cache-size', type=int, help='TENANT_CACHE_SIZE (по умолчанию из config)')
+    parser.add_argument('--concurrency', type=int, help='MAX_CONCURRENT_UPDATES (по умолчанию из config)')
+    parser.add_argument('--timeout', type=float, default=60.0, help='сколько ждать ответа бота на шаг, с')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    # До импорта bot: локальные базы во временном каталоге, без сервера метрик
+    data_dir = tempfile.mkdtemp(prefix='load_bot_')
+    os.environ['DATA_DIR'] = data_dir
+    os.environ['LEDGER_PATH'] = os.path.join(data_dir, 'ledger.sqlite3')
+    os.environ['WRITE_JOURNAL_PATH'] = os.path.join(data_dir, 'write_journal.jsonl')
+    os.environ['REFERENCE_SNAPSHOT_PATH'] = os.path.join(data_dir, 'reference_snapshot.json')
+    os.environ['USER_STATE_PATH'] = os.path.join(data_dir, 'user_state.sqlite3')
+    os.environ['METRICS_PORT'] = '0'
+    if args.tenants:
+        os.environ['MULTI_TENANT'] = 'true'
+    if args.tenant_cache_size:
+        os.environ['TENANT_CACHE_SIZE'] = str(args.tenant_cache_size)
+    if args.concurrency:
+        os.environ['MAX_CONCURRENT_UPDATES'] = str(args.concurrency)
+    if args.quota_per_minute:
+        os.environ['SHEETS_READ_PER_MINUTE'] = str(args.quota_per_minute)
+        os.environ['SHEETS_WRITE_PER_MINUTE'] = str(args.quota_per_minute)
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies: list[float]) -> dict:
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'max_ms': round(max(latencies, default=0.0) * 1000, 1),
+    }
+
+
+def make_fake_bot_class():
+    from telegram.ext import ExtBot
+
+    class FakeTelegramBot(ExtBot):
+        # Bot API в памяти: ответы бота складываются в очереди по чатам, подтверждения записи - отдельно
+        def __init__(self, latency_ms: float = 0.0):
+            super().__init__(token='123456:LOAD-TEST')
+            with self._unfrozen():
+                self.latency = latency_ms / 1000
+                self.message_ids = itertools.count(1_000_000)
+                self.replies = defaultdict(asyncio.Queue)
+                self.confirmations = defaultdict(asyncio.Queue)
+                self.api_calls = Counter()
+
+        async def _do_post(self, endpoint: str, data: dict, **kwargs):
+            self.api_calls[endpoint] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if endpoint == 'getMe':
+                return {'id': 123456, 'is_bot': True, 'first_name': 'Load test', 'username': 'load_test_bot'}
+            if endpoint in ('sendMessage', 'editMessageText'):
+                chat_id = int(data['chat_id'])
+                text = data.get('text', '')
+                message_id = data.get('message_id') or next(self.message_ids)
+                queue = self.confirmations if text.startswith(CONFIRM_PREFIXES) else self.replies
+                queue[chat_id].put_nowait((time.perf_counter(), text, data.get('reply_markup'), message_id))
+                return {'message_id': message_id, 'date': int(time.time()), 'text': text,
+                        'chat': {'id': chat_id, 'type': 'private'}}
+            return True
+
+    return FakeTelegramBot
+
+
+class SimulatedUser:
+    def __init__(self, harness, user_id: int, rng: random.Random):
+        self.harness = harness
+        self.user_id = user_id
+        self.rng = rng
+        self.menu_message_id = None
+        self.markup = None
+        self.pending_writes = [] # моменты отправки записей, ожидающих подтверждения
+
+    def _user(self) -> dict:
+        return {'id': self.user_id, 'is_bot': False, 'first_name': f'User{self.user_id}'}
+
+    def _message(self, message_id: int, text: str) -> dict:
+        return {'message_id': message_id, 'date': int(time.time()), 'text': text, 'from': self._user(),
+                'chat': {'id': self.user_id, 'type': 'private', 'first_name': f'User{self.user_id}'}}
+
+    async def _step(self, kind: str, payload: dict):
+        from telegram import Update
+
+        harness = self.harness
+        payload['update_id'] = next(harness.update_ids)
+        update = Update.de_json(payload, harness.fake_bot)
+        started = time.perf_counter()
+        await harness.app.update_queue.put(update)
+        try:
+            replied_at, text, markup, message_id = await asyncio.wait_for(
+                harness.fake_bot.replies[self.user_id].get(), harness.args.timeout)
+        except asyncio.TimeoutError:
+            harness.timeouts[kind] += 1
+            return None
+        harness.latencies[kind].append(replied_at - started)
+        if markup is not None:
+            self.markup = markup
+            self.menu_message_id = message_id
+        if harness.args.think_ms:
+            await asyncio.sleep(harness.args.think_ms / 1000)
+        return text, started
+
+    async def send_text(self, kind: str, text: str):
+        message = self._message(next(self.harness.message_ids), text)
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return await self._step(kind, {'message': message})
+
+    async def press(self, action: str):
+        from callbacks import decode
+
+        buttons = [button for row in (self.markup.inline_keyboard if self.markup else ()) for button in row
+                   if button.callback_data and decode(button.callback_data)[0] == action]
+        if not buttons:
+            self.harness.timeouts['missing_button'] += 1
+            return None
+        button = self.rng.choice(buttons)
+        callback_query = {
+            'id': str(next(self.harness.message_ids)), 'from': self._user(), 'chat_instance': str(self.user_id),
+            'data': button.callback_data, 'message': self._message(self.menu_message_id, 'menu'),
+        }
+        return await self._step('button', {'callback_query': callback_query})
+
+    async def manual_entry(self):
+        import callbacks
+
+        await self.send_text('command', '/start')
+        await self.press(callbacks.ACTION_CATEGORY)
+        await self.press(callbacks.ACTION_SUBCATEGORY)
+        amount = self.rng.randint(1000, 500000)
+        result = await self.send_text('manual_entry', f"{amount} обед {self.user_id}-{self.rng.random():.6f}")
+        if result and result[0].startswith(ACCEPTED_PREFIX):
+            self.pending_writes.append(result[1])
+
+    async def sms_paste(self):
+        import callbacks
+        import sms_corpus
+
+        await self.send_text('command', '/start')
+        await self.press(callbacks.ACTION_SMS)
+        paste = sms_corpus.generate_paste(self.harness.args.sms_per_paste, seed=self.rng.randrange(1 << 30))
+        result = await self.send_text('sms_paste', paste)
+        if result and result[0].startswith(ACCEPTED_PREFIX):
+            self.pending_writes.append(result[1])
+
+    async def navigation(self):
+        import callbacks
+
+        await self.send_text('command', '/start')
+        await self.press(callbacks.ACTION_CATEGORY)
+        await self.press(callbacks.ACTION_BACK_TO_CATEGORIES)
+        await self.press(callbacks.ACTION_CHANGE_SOURCE)
+        await self.press(callbacks.ACTION_SET_SOURCE)
+        await self.press(callbacks.ACTION_CATEGORY)
+
+    async def run(self, iterations: int, scenarios: list[str]):
+        for _ in range(iterations):
+            await getattr(self, self.rng.choice(scenarios))()
+
+    async def wait_confirmations(self):
+        # Подтверждения приходят по порядку записей; время прихода зафиксировано поддельным ботом
+        queue = self.harness.fake_bot.confirmations[self.user_id]
+        for sent_at in self.pending_writes:
+            try:
+                confirmed_at, _, _, _ = await asyncio.wait_for(queue.get(), self.harness.args.timeout)
+            except asyncio.TimeoutError:
+                self.harness.timeouts['write_confirmed'] += 1
+                continue
+            self.harness.latencies['write_confirmed'].append(confirmed_at - sent_at)
+
+
+class LoadHarness:
+    def __init__(self, args):
+        self.args = args
+        self.latencies = defaultdict(list)
+        self.timeouts = Counter()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.app = None
+        self.fake_bot = None
+        self.backend = None
+
+    async def _wait_ready(self, bot):
+        # Первичная загрузка справочников и синхронизация зеркала идут в фоне после post_init
+        deadline = time.perf_counter() + self.args.timeout
+        while not (bot.default_tenant.categories and bot.default_tenant.ledger_synced):
+            if time.perf_counter() > deadline:
+                raise RuntimeError('Бот не загрузил справочники из поддельной таблицы')
+            await asyncio.sleep(0.05)
+
+    async def run(self) -> dict:
+        import bot
+        import fake_sheets
+        import sms_corpus
+        from telegram.ext import ApplicationBuilder
+
+        args = self.args
+        self.backend = fake_sheets.FakeBackend(args.sheets_latency_ms, args.sheets_jitter_ms, args.sheets_error_rate,
+                                               seed=args.seed)
+        reference_data = sms_corpus.generate_reference_data(args.categories)
+        fake_client = fake_sheets.FakeClient(
+            self.backend,
+            lambda spreadsheet_id: fake_sheets.make_budget_spreadsheet(self.backend, *reference_data, spreadsheet_id=spreadsheet_id)
+        )
+        # Все клиенты таблиц (и клиенты for_spreadsheet режима нескольких таблиц) открывают таблицы через поддельный клиент
+        bot.sheets_client._authorized = lambda: fake_client
+        bot.SPREADSHEET_ID = bot.sheets_client.spreadsheet_id = 'load-test-spreadsheet'
+        rng = random.Random(args.seed)
+        users = [SimulatedUser(self, 10_000 + i, random.Random(rng.random())) for i in range(args.users)]
+        self.fake_bot = make_fake_bot_class()(args.telegram_latency_ms)
+        self.app = bot.build_application(ApplicationBuilder().bot(self.fake_bot).updater(None))
+        if args.tenants:
+            for i, user in enumerate(users):
+                bot.tenant_directory.assign(user.user_id, f'load-test-spreadsheet-{i % args.tenants:04d}')
+
+        await self.app.initialize()
+        await self.app.post_init(self.app)
+        await self.app.start()
+        try:
+            if not args.tenants:
+                await self._wait_ready(bot)
+            scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+            started = time.perf_counter()
+            await asyncio.gather(*(user.run(args.iterations, scenarios) for user in users))
+            elapsed = time.perf_counter() - started
+            await asyncio.gather(*(user.wait_confirmations() for user in users))
+            confirmed_elapsed = time.perf_counter() - started
+            open_tenants = len(bot.tenant_cache) if args.tenants else 1
+        finally:
+            await self.app.stop()
+            await self.app.post_stop(self.app)
+            await self.app.shutdown()
+            await self.app.post_shutdown(self.app)
+
+        steps = sum(len(values) for kind, values in self.latencies.items() if kind != 'write_confirmed')
+        return {
+            'config': {key: value for key, value in vars(args).items() if key != 'output'},
+            'concurrent_updates': self.app.concurrent_updates,
+            'updates': steps,
+            'elapsed_s': round(elapsed, 3),
+            'updates_per_sec': round(steps / elapsed, 1) if elapsed else 0.0,
+            'all_confirmed_s': round(confirmed_elapsed, 3),
+            'latency': {kind: summarize(values) for kind, values in sorted(self.latencies.items())},
+            'timeouts': dict(self.timeouts),
+            'sheets_calls': dict(sorted(self.backend.calls.items())),
+            'sheets_injected_errors': self.backend.errors,
+            'fact_rows_written': sum(len(spreadsheet._worksheets['fact']._rows) - 1
+                                     for spreadsheet in fake_client.spreadsheets.values()),
+            'spreadsheets': len(fake_client.spreadsheets),
+            'open_tenants': open_tenants,
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'telegram_calls': dict(sorted(self.fake_bot.api_calls.items())),
+        }
+
+
+def print_report(result: dict):
+    print()
+    print(f"Обновлений: {result['updates']} (параллельно до {result['concurrent_updates']}) за {result['elapsed_s']} с - {result['updates_per_sec']} в секунду; "
+          f"все записи подтверждены через {result['all_confirmed_s']} с")
+    print(f"{'шаг':<16}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for kind, stats in result['latency'].items():
+        print(f"{kind:<16}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+    if result['timeouts']:
+        print(f"Без ответа: {result['timeouts']}")
+    print(f"Вызовы Google Sheets: {result['sheets_calls']}, внесённых ошибок: {result['sheets_injected_errors']}, "
+          f"строк в 'fact': {result['fact_rows_written']}")
+    print(f"Вызовы Bot API: {result['telegram_calls']}")
+    print(f"Таблиц: {result['spreadsheets']}, открыто в конце: {result['open_tenants']}, пик памяти процесса {result['max_rss_mb']} МиБ")
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    result = asyncio.run(LoadHarness(args).run())
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import sms_parser
+import sms_corpus
+
+# Набор бенчмарков: разбор СМС (пропускная способность и пиковая память) на синтетическом корпусе,
+# разделение СМС при росте числа зарегистрированных форматов банков и построение inline-клавиатур
+# при 10/100/1000 категориях. Результаты сохраняются в JSON, который можно сравнить с прогоном на другом коммите.
+#
+# Запуск: python benchmarks/run_benchmarks.py [--quick] [--output файл.json] [--compare прошлый.json]
+
+PARSE_SIZES = (100, 1000, 10000)
+KEYBOARD_SIZES = (10, 100, 1000)
+EXTRA_FORMAT_COUNTS = (0, 20, 100)
+
+
+class _Context:
+    # Минимальный контекст обработчика для generate_categories_keyboard
+    def __init__(self, source=None):
+        self.user_data = {'source': source} if source else {}
+
+
+def _best_time(func, repeats: int) -> float:
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _peak_memory(func) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_parser(repeats: int, sizes=PARSE_SIZES) -> dict:
+    results = {}
+    for size in sizes:
+        paste = sms_corpus.generate_paste(size)
+        lines = paste.splitlines(keepends=True)
+        messages = sms_parser.split_sms(paste)
+        recognized = len(sms_parser.parse_sms_by_date(paste))
+
+        by_date = _best_time(lambda: sms_parser.parse_sms_by_date(paste), repeats)
+        stream = _best_time(lambda: sum(1 for _ in sms_parser.parse_sms_stream(lines)), repeats)
+        current_year = datetime.now().year
+        one = _best_time(lambda: [sms_parser._parse_one_sms(m, current_year) for m in messages], repeats)
+
+        results[str(size)] = {
+            'messages': len(messages),
+            'recognized': recognized,
+            'parse_sms_by_date_msgs_per_sec': round(len(messages) / by_date),
+            'parse_sms_stream_msgs_per_sec': round(len(messages) / stream),
+            'parse_one_sms_msgs_per_sec': round(len(messages) / one),
+            'parse_sms_by_date_peak_bytes': _peak_memory(lambda: sms_parser.parse_sms_by_date(paste)),
+            'parse_sms_stream_peak_bytes': _peak_memory(lambda: sum(1 for _ in sms_parser.parse_sms_stream(lines))),
+        }
+        print(f"Разбор {size} СМС: parse_sms_by_date {results[str(size)]['parse_sms_by_date_msgs_per_sec']:,} СМС/сек, "
+              f"пик памяти {results[str(size)]['parse_sms_by_date_peak_bytes'] / 1024:.0f} КиБ, распознано {recognized}")
+    return results
+
+
+def bench_formats(repeats: int, counts=EXTRA_FORMAT_COUNTS, size: int = 1000) -> dict:
+    # Разделение вставки на СМС при росте реестра форматов: к встроенным добавляются форматы вымышленных банков
+    paste = sms_corpus.generate_paste(size)
+    results = {}
+    for count in counts:
+        registry = sms_parser.SmsFormatRegistry(sms_parser.registry.fallback)
+        for sms_format in sms_parser.registry.formats():
+            registry.register(sms_format)
+        for i in range(count):
+            registry.register(sms_parser.SmsFormat(f"bank{i:03d}", rf'BANK{i:03d}\s+\*\d{{4}}'))
+        messages = len(registry.segments(paste))
+        elapsed = _best_time(lambda: registry.segments(paste), repeats)
+        results[str(count)] = {'formats': len(registry.formats()), 'split_msgs_per_sec': round(messages / elapsed)}
+        print(f"Разделение {size} СМС при {len(registry.formats())} форматах: "
+              f"{results[str(count)]['split_msgs_per_sec']:,} СМС/сек")
+    return results
+
+
+def bench_keyboards(repeats: int, sizes=KEYBOARD_SIZES) -> dict:
+    import bot
+
+    # Таблица для замеров - с локальными базами во временном каталоге
+    data_dir = tempfile.mkdtemp(prefix='bench_bot_')
+    tenant = bot._create_tenant('bench', bot.sheets_client, os.path.join(data_dir, 'ledger.sqlite3'),
+                                os.path.join(data_dir, 'write_journal.jsonl'),
+                                os.path.join(data_dir, 'reference_snapshot.json'))
+    results = {}
+    for size in sizes:
+        categories, subcategories, sources = sms_corpus.generate_reference_data(size)
+        tenant.apply_reference_data(categories, subcategories, sources)
+        context = _Context(sources[0])
+        first_category = categories[0]
+        builders = {
+            'categories': lambda: bot.generate_categories_keyboard(tenant, context),
+            'subcategories': lambda: bot.generate_subcategories_keyboard(tenant, first_category),
+            'sources': lambda: bot.generate_sources_keyboard(tenant),
+        }
+        size_results = {}
+        for name, build in builders.items():
+            def cold():
+                bot.keyboard_cache.clear()
+                build()
+            cold_time = _best_time(cold, repeats)
+            build()
+            cached_time = _best_time(build, repeats)
+            size_results[name] = {
+                'cold_ms': round(cold_time * 1000, 3),
+                'cached_us': round(cached_time * 1_000_000, 2),
+                'cold_peak_bytes': _peak_memory(cold),
+            }
+        results[str(size)] = size_results
+        print(f"Клавиатуры при {size} категориях: категории {size_results['categories']['cold_ms']} мс "
+              f"(из кэша {size_results['categories']['cached_us']} мкс), "
+              f"пик памяти {size_results['categories']['cold_peak_bytes'] / 1024:.0f} КиБ")
+    return results
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _compare(previous: dict, current: dict, path: str = ''):
+    # Печатает отношение текущих значений к прошлому прогону для всех общих числовых метрик
+    for key, value in current.items():
+        old = previous.get(key) if isinstance(previous, dict) else None
+        name = f"{path}.{key}" if path else key
+        if isinstance(value, dict):
+            _compare(old or {}, value, name)
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            print(f"  {name}: {old} -> {value} ({value / old:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки парсера СМС и построения клавиатур')
+    parser.add_argument('--quick', action='store_true', help='меньше повторов и без самых больших размеров')
+    parser.add_argument('--output', help='файл результатов (по умолчанию benchmarks/results/<время>-<коммит>.json)')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    args = parser.parse_args()
+
+    repeats = 2 if args.quick else 5
+    commit = _git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parser': bench_parser(repeats, PARSE_SIZES[:2] if args.quick else PARSE_SIZES),
+        'formats': bench_formats(repeats),
+        'keyboards': bench_keyboards(repeats, KEYBOARD_SIZES[:2] if args.quick else KEYBOARD_SIZES),
+    }
+
+    output = args.output or os.path.join(BENCH_DIR, 'results', f"{datetime.now():%Y%m%d-%H%M%S}-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+        print(f"Сравнение с {previous.get('commit')} ({previous.get('timestamp')}):")
+        sections = ('parser', 'formats', 'keyboards')
+        _compare({name: previous.get(name, {}) for name in sections}, {name: report[name] for name in sections})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import random
+from datetime import datetime, timedelta
+
+# Генератор синтетических банковских СМС для бенчмарков: все маркеры начала СМС, которые знает парсер,
+# все шесть форматов даты, суммы с точкой и запятой, разные валюты и ключевые слова операций.
+# Генерация детерминирована (seed), чтобы замеры на разных коммитах шли по одинаковому корпусу.
+
+MONTH_NAMES = ('JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC')
+CURRENCIES = ('UZS', 'RUB', 'USD', 'EUR')
+MERCHANTS = ('KORZINKA TASHKENT', 'YANDEX GO', 'OZON', 'CLICK', 'NETFLIX', 'MAKRO', 'UZUM MARKET', 'EVOS')
+
+DATE_FORMATS = {
+    'mon': lambda d: f"{d.day:02d}-{MONTH_NAMES[d.month - 1]}-{d.year} {d:%H:%M}",
+    'dmY': lambda d: f"{d:%d.%m.%Y %H:%M}",
+    'dmY_dash': lambda d: f"{d:%d-%m-%Y %H:%M}",
+    'dmy': lambda d: f"{d:%d.%m.%y %H:%M}",
+    'dmy_slash': lambda d: f"{d:%d/%m/%y %H:%M}",
+    'dm': lambda d: f"{d:%d.%m %H:%M}",
+}
+
+
+def _amount(rng: random.Random) -> str:
+    value = rng.choice((rng.randint(1, 999), rng.randint(1000, 5_000_000)))
+    if rng.random() < 0.4:
+        return f"{value}{rng.choice('.,')}{rng.randint(0, 99):02d}"
+    return str(value)
+
+
+def _card(rng: random.Random) -> str:
+    return f"*{rng.randint(0, 9999):04d}"
+
+
+# Шаблоны по маркерам начала СМС: функция (rng, сумма, валюта, дата) -> текст
+SMS_TEMPLATES = {
+    'karta_pokupka': lambda rng, a, c, d: f"Karta {_card(rng)} Pokupka: {a} {c} {d} {rng.choice(MERCHANTS)}",
+    'karta_income': lambda rng, a, c, d: f"Karta {_card(rng)} {rng.choice(('Поступление', 'popolnen', 'ZACHISLENIE'))} {a} {c} {d}",
+    'karta_expense': lambda rng, a, c, d: f"Karta {_card(rng)} {rng.choice(('списание', 'spisan', 'oplata', 'XARID'))} {a} {c} {d}",
+    'schet': lambda rng, a, c, d: f"Schet po karte {_card(rng)} zachislenie {a} {c} {d}",
+    'otmena': lambda rng, a, c, d: f"OTMENA E-Com oplata: summa: {rng.choice(('', '-'))}{a} {c} {d} {rng.choice(MERCHANTS)}",
+    'ecom': lambda rng, a, c, d: f"E-Com oplata: {a} {c} {d} {rng.choice(MERCHANTS)}",
+    'pokupka': lambda rng, a, c, d: f"Pokupka: {a} {c} {d} {rng.choice(MERCHANTS)}",
+    'platezh': lambda rng, a, c, d: f"Platezh: {a} {c} {d} {rng.choice(MERCHANTS)}",
+    'perevod': lambda rng, a, c, d: f"Perevod na kartu: {rng.choice(('', 'zachisl '))}{a} {c} {d}",
+}
+
+
+def generate_sms(count: int, seed: int = 42, start: datetime = datetime(2024, 1, 1)) -> list[str]:
+    # Шаблоны и форматы даты перебираются по кругу, поэтому каждая комбинация встречается уже на небольшом корпусе
+    rng = random.Random(seed)
+    templates = list(SMS_TEMPLATES.values())
+    formats = list(DATE_FORMATS.values())
+    messages = []
+    for i in range(count):
+        moment = start + timedelta(minutes=rng.randint(0, 365 * 24 * 60))
+        template = templates[i % len(templates)]
+        date_format = formats[(i // len(templates)) % len(formats)]
+        messages.append(template(rng, _amount(rng), rng.choice(CURRENCIES), date_format(moment)))
+    return messages
+
+
+def generate_paste(count: int, seed: int = 42) -> str:
+    # Вставка, как её присылает пользователь: СМС через перевод строки
+    return "\n".join(generate_sms(count, seed))
+
+
+def generate_reference_data(categories: int, subcategories_per_category: int = 8, sources: int = 6):
+    # Справочники листа "system" заданного размера для замеров клавиатур
+    category_names = [f"Категория {i:04d}" for i in range(categories)]
+    subcategories = {
+        name: [f"Подкатегория {name[-4:]}-{j:02d}" for j in range(subcategories_per_category)] for name in category_names
+    }
+    source_names = [f"card{i}{CURRENCIES[i % len(CURRENCIES)]}" for i in range(sources)]
+    return category_names, subcategories, source_names
@@ -1,11 +1,34 @@
 import os
+import time
+_STARTED_AT = time.perf_counter() # Точка отсчёта времени запуска (до импорта библиотек)
+import asyncio
+import contextvars
+import csv
+import functools
+import hashlib
+import tempfile
+from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 from google.oauth2.service_account import Credentials
-import gspread
-import re
-from datetime import datetime
-from requests.exceptions import ConnectionError
+from gspread.exceptions import APIError, SpreadsheetNotFound, WorksheetNotFound
+from row_cursor import RowCursor
+from sheets_gateway import SheetsGateway
+from sheets_client import SheetsClient, CircuitBreaker, CircuitOpenError, is_transient, is_auth_error
+from quota_scheduler import QuotaScheduler, READ, WRITE, PRIORITY_USER, PRIORITY_BACKGROUND
+from ledger import SYNC_READ_OPTIONS, sheet_record
+from balances import running_balances, ledger_totals, totals, diff_balances
+from sms_parser import parse_sms_by_date, parse_sms_stream
+from lru_cache import LRUCache
+import callbacks
+from callbacks import CallbackIndex, StaleCallbackError
+from reference_snapshot import save_snapshot, load_snapshot
+from user_state import SQLiteUserPersistence
+from rollups import month_key, render_report
+from metrics import instrument_handler, start_metrics_server, current_handler
+from update_processor import PerChatUpdateProcessor
+from fx_rates import FxRates, parse_rate_rows, load_rates_file, totals_in_base, convert_balances
+from tenants import Tenant, TenantDirectory, parse_spreadsheet_id, tenant_data_dir, tenants_with_pending_writes
 # Импортируем переменные из config.py
 # Обратите внимание, что если переменные не установлены в окружении и LOCAL_RUN=False,
 # они могут быть None после этого импорта, если в config.py нет значений по умолчанию.
@@ -13,6 +36,18 @@ from config import TELEGRAM_TOKEN as CONFIG_TELEGRAM_TOKEN, \
                      GOOGLE_PRIVATE_KEY as CONFIG_GOOGLE_PRIVATE_KEY, \
                      GOOGLE_SERVICE_ACCOUNT_EMAIL as CONFIG_GOOGLE_SERVICE_ACCOUNT_EMAIL, \
                      SPREADSHEET_ID as CONFIG_SPREADSHEET_ID
+from config import SHEETS_MAX_WORKERS, SHEETS_CALL_TIMEOUT, SHEETS_RETRIES, SHEETS_BACKOFF_BASE, SHEETS_BACKOFF_MAX, \
+                   SHEETS_BREAKER_THRESHOLD, SHEETS_BREAKER_RESET, \
+                   SHEETS_READ_PER_MINUTE, SHEETS_WRITE_PER_MINUTE, SHEETS_QUOTA_BURST, \
+                   USER_STATE_PATH, USER_STATE_FLUSH_INTERVAL, USER_STATE_CACHE_SIZE, LEDGER_SYNC_INTERVAL, BALANCE_CHECK_INTERVAL, \
+                   BALANCE_CHECK_CHUNK_ROWS, \
+                   METRICS_PORT, METRICS_HOST, METRICS_PATH, MAX_CONCURRENT_UPDATES, \
+                   MULTI_TENANT, TENANTS_PATH, TENANTS_DATA_DIR, TENANT_CACHE_SIZE, TENANT_IDLE_TTL, \
+                   WRITE_JOURNAL_PATH, WRITE_FLUSH_INTERVAL_MS, WRITE_FLUSH_MAX_ROWS, LEDGER_PATH, \
+                   WRITE_RETRY_BASE, WRITE_RETRY_MAX, WRITE_MAX_ATTEMPTS, \
+                   BALANCE_MODE, IMPORT_CHUNK_ROWS, IMPORT_CONFIRM_TIMEOUT, KEYBOARD_CACHE_SIZE, REFERENCE_SNAPSHOT_PATH, \
+                   SYSTEM_REFRESH_INTERVAL, SYSTEM_REFRESH_JITTER, \
+                   FX_BASE_CURRENCY, FX_SHEET_NAME, FX_RATES_PATH, FX_REFRESH_INTERVAL
 
 LOCAL_RUN = os.getenv('LOCAL_RUN', 'False').lower() == 'true'
 
@@ -41,46 +76,64 @@ TOKEN = TELEGRAM_TOKEN # TOKEN используется для ApplicationBuilde
 
 FALLBACK_CURRENCY = 'XXX'
 
-CATEGORIES = []
-SUBCATEGORIES = {}
-SOURCES = []
-
-# Аутентификация в Google Sheets
-if not GOOGLE_PRIVATE_KEY or not GOOGLE_SERVICE_ACCOUNT_EMAIL:
-    print("Ошибка: Не все учетные данные Google Cloud установлены (GOOGLE_PRIVATE_KEY или GOOGLE_SERVICE_ACCOUNT_EMAIL). Проверьте переменные окружения или файл .env.")
-    creds = None
-    client = None
-    sheet = None
-else:
-    creds_info = {
-        "type": "service_account",
-        "private_key": GOOGLE_PRIVATE_KEY,
-        "client_email": GOOGLE_SERVICE_ACCOUNT_EMAIL,
-        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-        "token_uri": "https://oauth2.googleapis.com/token",
-        "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-        # URL формируется динамически, убедитесь, что GOOGLE_SERVICE_ACCOUNT_EMAIL корректен
-        "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{GOOGLE_SERVICE_ACCOUNT_EMAIL.replace('@', '%40')}" if GOOGLE_SERVICE_ACCOUNT_EMAIL else ""
-    }
+# Готовые клавиатуры по (таблица, версия справочников таблицы, ...)
+keyboard_cache = LRUCache(maxsize=KEYBOARD_CACHE_SIZE)
+
+
+def _build_credentials():
+    # Учётные данные сервисного аккаунта создаются один раз; токен google-auth обновляет сам
+    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
+    if GOOGLE_PRIVATE_KEY and GOOGLE_SERVICE_ACCOUNT_EMAIL:
+        creds_info = {
+            "type": "service_account",
+            "private_key": GOOGLE_PRIVATE_KEY,
+            "client_email": GOOGLE_SERVICE_ACCOUNT_EMAIL,
+            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+            "token_uri": "https://oauth2.googleapis.com/token",
+            "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
+            # URL формируется динамически, убедитесь, что GOOGLE_SERVICE_ACCOUNT_EMAIL корректен
+            "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{GOOGLE_SERVICE_ACCOUNT_EMAIL.replace('@', '%40')}"
+        }
+        return Credentials.from_service_account_info(creds_info, scopes=scopes)
+    if GOOGLE_APPLICATION_CREDENTIALS_PATH and os.path.exists(GOOGLE_APPLICATION_CREDENTIALS_PATH):
+        return Credentials.from_service_account_file(GOOGLE_APPLICATION_CREDENTIALS_PATH, scopes=scopes)
+    print("Ошибка: Не все учетные данные Google Cloud установлены (GOOGLE_PRIVATE_KEY или GOOGLE_SERVICE_ACCOUNT_EMAIL). Пробуем учетные данные окружения по умолчанию.")
+    import google.auth
+    creds, _ = google.auth.default(scopes=scopes + ["https://www.googleapis.com/auth/drive.file"]) # может не сработать без GOOGLE_APPLICATION_CREDENTIALS
+    return creds
+
+
+# Все обращения к Google Sheets из обработчиков идут через пул потоков шлюза
+sheets_gateway = SheetsGateway(max_workers=SHEETS_MAX_WORKERS, default_timeout=SHEETS_CALL_TIMEOUT)
+
+# Бюджеты квот Google Sheets API на чтение и запись; записи пользователей обслуживаются раньше фоновых чтений
+sheets_quota = QuotaScheduler(SHEETS_READ_PER_MINUTE, SHEETS_WRITE_PER_MINUTE, burst=SHEETS_QUOTA_BURST)
+
+# Подключение к таблице: повторы с задержкой при временных ошибках и автомат отключения при серии сбоев.
+# Таблица открывается при первом обращении (в post_init), а не при импорте модуля.
+sheets_client = SheetsClient(
+    sheets_gateway, _build_credentials, SPREADSHEET_ID,
+    retries=SHEETS_RETRIES, backoff_base=SHEETS_BACKOFF_BASE, backoff_max=SHEETS_BACKOFF_MAX,
+    breaker=CircuitBreaker(failure_threshold=SHEETS_BREAKER_THRESHOLD, reset_timeout=SHEETS_BREAKER_RESET),
+    scheduler=sheets_quota
+)
+
+
+async def ensure_sheet(tenant: Tenant, priority: int = PRIORITY_BACKGROUND):
+    # Таблица для обработчика; None, если подключиться не удалось. При открытом автомате - CircuitOpenError
+    if not tenant.client.spreadsheet_id:
+        print("Ошибка: SPREADSHEET_ID не установлен. Невозможно открыть таблицу.")
+        return None
     try:
-        creds = Credentials.from_service_account_info(creds_info,
-                                                      scopes=["https://www.googleapis.com/auth/spreadsheets"])
-        client = gspread.authorize(creds)
-        if SPREADSHEET_ID:
-            sheet = client.open_by_key(SPREADSHEET_ID)
-        else:
-            print("Ошибка: SPREADSHEET_ID не установлен. Невозможно открыть таблицу.")
-            sheet = None
+        return await tenant.client.spreadsheet(priority)
+    except CircuitOpenError:
+        raise
     except Exception as e:
         print(f"Ошибка при аутентификации или открытии таблицы Google: {e}")
-        creds = None
-        client = None
-        sheet = None
+        return None
 
-MONTH_MAP = {
-    'JAN': 1, 'FEB': 2, 'MAR': 3, 'APR': 4, 'MAY': 5, 'JUN': 6,
-    'JUL': 7, 'AUG': 8, 'SEP': 9, 'OCT': 10, 'NOV': 11, 'DEC': 12
-}
+# HTTP-сервер метрик Prometheus (запускается в post_init)
+metrics_server = None
 
 
 def get_currency_from_source(source_name: str) -> str:
@@ -89,277 +142,582 @@ def get_currency_from_source(source_name: str) -> str:
     return FALLBACK_CURRENCY
 
 
-def _parse_one_sms(sms_text: str, current_year: int) -> dict:
-    res = {'дата': None, 'сумма': None, 'валюта_из_смс': None, 'операция': 'неизвестно'}
-    text = sms_text.strip()
-    low = text.lower()
+def sms_record_to_row(rec: dict, sms_text: str, currency: str, source: str) -> list:
+    date_str = rec['дата'].strftime('%d.%m.%Y')
+    amount = abs(rec['сумма']) if rec['сумма'] is not None else 0.0
+    op = rec['операция'].upper() if rec['операция'] else 'НЕИЗВЕСТНО'
+    category_sms = op if op != 'НЕИЗВЕСТНО' else '' # Для СМС категория = тип операции
+    return [
+        date_str,
+        category_sms,
+        "", # Подкатегория для СМС не указывается
+        amount,
+        f"SMS: {rec.get('валюта_из_смс', '')} {sms_text[:30]}...", # Комментарий - начало текста СМС
+        currency, # Валюта из источника
+        source,
+        rec.get('валюта_из_смс') or '', # В лист не пишется: валюта суммы для колонки I (пусто - валюта источника)
+    ]
 
-    m_sum_specific = re.search(
-        r'summa:?\s*(-?\d+(?:[.,]\d+)?)\s*,?\s*(UZS|RUB|USD|EUR)\b',
-        text,
-        flags=re.IGNORECASE
+
+def build_balance_formula(row_num: int) -> str:
+    return (
+        f'=СУММЕСЛИМН($D$2:D{row_num};'
+        f' $H$2:H{row_num}; $H{row_num};'
+        f' $G$2:G{row_num}; $G{row_num};'
+        f' $B$2:B{row_num}; "💰 ДОХОДЫ")'
+        f' - '
+        f'СУММЕСЛИМН($D$2:D{row_num};'
+        f' $H$2:H{row_num}; $H{row_num};'
+        f' $G$2:G{row_num}; $G{row_num};'
+        f' $B$2:B{row_num}; "<>💰 ДОХОДЫ")'
     )
-    m_sum_to_use = None
-    if m_sum_specific:
-        m_sum_to_use = m_sum_specific
-    else:
-        m_sum_general = re.search(
-            r'(-?\d+(?:[.,]\d+)?)\s*,?\s*(UZS|RUB|USD|EUR)\b',
-            text,
-            flags=re.IGNORECASE
-        )
-        m_sum_to_use = m_sum_general
 
-    if m_sum_to_use:
-        amt_str = m_sum_to_use.group(1).replace(',', '.')
-        try:
-            res['сумма'] = float(amt_str)
-            res['валюта_из_смс'] = m_sum_to_use.group(2).upper()
-        except ValueError:
-            pass
-
-    dt = None
-    date_parse_patterns = [
-        (r'(\d{2}-[A-Za-z]{3}-\d{4}\s+\d{2}:\d{2})', 'custom_day_mon_year_time'),
-        (r'(\d{2}\.\d{2}\.\d{4}\s+\d{2}:\d{2})', '%d.%m.%Y %H:%M'),
-        (r'(\d{2}-\d{2}-\d{4}\s+\d{2}:\d{2})', '%d-%m-%Y %H:%M'),
-        (r'(\d{2}\.\d{2}\.\d{2}\s+\d{2}:\d{2})', '%d.%m.%y %H:%M'),
-        (r'(\d{2}/\d{2}/\d{2}\s+\d{2}:\d{2})', '%d/%m/%y %H:%M'),
-        (r'(\d{2}\.\d{2}\s+\d{2}:\d{2})', '%d.%m %H:%M'),
-    ]
 
-    for pat_regex, fmt_or_handler in date_parse_patterns:
-        if dt: break
-        m_date = re.search(pat_regex, text)
-        if m_date:
-            try:
-                parsed_datetime_obj = None
-                date_str_matched = m_date.group(1)
-                if fmt_or_handler == 'custom_day_mon_year_time':
-                    sub_match = re.match(r'(\d{2})-([A-Za-z]{3})-(\d{4})\s+(\d{2}:\d{2})', date_str_matched)
-                    if sub_match:
-                        day_s, mon_s, year_s, time_s = sub_match.groups()
-                        month_num = MONTH_MAP.get(mon_s.upper())
-                        if month_num:
-                            std_date_str = f"{day_s}-{month_num:02d}-{year_s} {time_s}"
-                            parsed_datetime_obj = datetime.strptime(std_date_str, '%d-%m-%Y %H:%M')
-                else:
-                    parsed_datetime_obj = datetime.strptime(date_str_matched, fmt_or_handler)
-
-                if fmt_or_handler == '%d.%m %H:%M' and parsed_datetime_obj:
-                    dt = parsed_datetime_obj.replace(year=current_year)
-                else:
-                    dt = parsed_datetime_obj
-            except ValueError:
-                pass
-    res['дата'] = dt
-
-    if res['сумма'] is not None:
-        op_type = 'неизвестно'
-        income_keywords = ['поступлен', 'zachisl', 'zachislenie', 'popolnen']
-        expense_keywords_for_positive_sum = ['xarid', 'pokupka', 'списан', 'spisan', 'oplata', 'platezh']
-
-        if 'otmena' in low:
-            op_type = 'доход' if res['сумма'] > 0 else ('расход' if res['сумма'] < 0 else 'неизвестно')
-        elif res['сумма'] < 0:
-            op_type = 'расход'
+def append_fact_rows(fact_sheet, row_cursor: RowCursor, rows: list[list], on_begin=None, balances: list[float] = None):
+    # rows - строки листа "fact" без колонки баланса (E), с суммой в базовой валюте последней (колонка I). В колонку E пишется либо готовое значение из balances,
+    # либо формула по номеру строки из курсора.
+    # Возвращает фактический диапазон строк (first, last) или None, если его не удалось определить.
+    with row_cursor.lock:
+        start_row = row_cursor.reserve(fact_sheet)
+        if on_begin:
+            on_begin(start_row)
+        if balances is not None:
+            values = [row[:4] + [balance] + row[4:] for row, balance in zip(rows, balances)]
         else:
-            is_explicit_income = any(keyword in low for keyword in income_keywords)
-            is_explicit_expense = any(keyword in low for keyword in expense_keywords_for_positive_sum)
-
-            if is_explicit_income:
-                op_type = 'доход'
-            elif is_explicit_expense:
-                op_type = 'расход'
-            elif 'perevod na kartu' in low:
-                op_type = 'расход' if not is_explicit_income and res['сумма'] >= 0 else 'доход'
-            elif res['сумма'] > 0:
-                op_type = 'доход'
-        res['операция'] = op_type
-    return res
-
-
-def parse_sms_by_date(input_text: str) -> list[dict]:
-    current_year = datetime.now().year
-    final_sms_start_patterns = [
-        r'Karta\s+\*\d{4}', r'Schet\s+po\s+karte\s+\*\d{4}',
-        r'OTMENA\s+E-Com\s+oplata:', r'Pokupka:', r'E-Com\s+oplata:',
-        r'Platezh:', r'Perevod na kartu:',
-    ]
-    combined_start_pattern = r'(?=(' + '|'.join(final_sms_start_patterns) + r'))'
-    raw_sms_list = re.split(combined_start_pattern, input_text)
-    actual_sms_messages = [sms.strip() for sms in raw_sms_list if sms and sms.strip()]
-    parsed_records = [_parse_one_sms(m, current_year) for m in actual_sms_messages]
-    unique_records = []
-    seen_keys = set()
-    for record in parsed_records:
-        if record['дата'] and record['сумма'] is not None:
-            record_key = (record['дата'], record['сумма'], record['операция'])
-            if record_key not in seen_keys:
-                seen_keys.add(record_key)
-                unique_records.append(record)
-    return unique_records
-
-
-def load_keyboard_data():
-    global CATEGORIES, SUBCATEGORIES, SOURCES, sheet, client
-
-    if not sheet:
-        print("Sheet не инициализирован в load_keyboard_data. Данные не могут быть загружены.")
-        if client and SPREADSHEET_ID:
-            try:
-                # print("Попытка повторно открыть таблицу в load_keyboard_data...") # Пример удаленного комментария
-                sheet = client.open_by_key(SPREADSHEET_ID)
-            except Exception as e_reopen:
-                print(f"Не удалось повторно открыть таблицу: {e_reopen}")
-                return CATEGORIES, SUBCATEGORIES, SOURCES
+            values = [row[:4] + [build_balance_formula(start_row + i)] + row[4:] for i, row in enumerate(rows)]
+        try:
+            response = fact_sheet.append_rows(values, value_input_option='USER_ENTERED')
+        except Exception:
+            # Неизвестно, легли ли строки в таблицу - при следующей записи курсор сверится заново
+            row_cursor.invalidate()
+            raise
+        actual_range = row_cursor.commit(response, start_row)
+        if balances is None and actual_range and actual_range[0] != start_row:
+            # Строки легли не туда, где ожидалось (лист дописали извне) - переписываем формулы под фактические номера
+            first_row, last_row = actual_range
+            fact_sheet.update(
+                values=[[build_balance_formula(row_num)] for row_num in range(first_row, last_row + 1)],
+                range_name=f"E{first_row}:E{last_row}",
+                value_input_option='USER_ENTERED'
+            )
+    return actual_range
+
+
+async def _open_fact_sheet(tenant: Tenant, priority: int = PRIORITY_BACKGROUND):
+    # Ошибка открытия таблицы доходит до вызывающего как есть: очередь записи отличает временные ошибки от постоянных
+    if not tenant.client.spreadsheet_id:
+        raise ValueError("SPREADSHEET_ID не установлен - запись в 'fact' невозможна.")
+    return await tenant.client.worksheet("fact", priority)
+
+
+def _is_transient_write_error(error) -> bool:
+    # Пакет повторяется после временных ошибок API, открытого автомата и отозванной сессии;
+    # остальные ошибки (нет доступа к таблице, нет листа "fact") повтором не исправить
+    return isinstance(error, CircuitOpenError) or is_transient(error) or is_auth_error(error)
+
+
+async def load_fx_rates(tenant: Tenant, priority: int = PRIORITY_BACKGROUND) -> FxRates:
+    # Курсы таблицы из кэша; устаревшие перечитываются из FX_RATES_PATH или листа FX_SHEET_NAME.
+    # При ошибке остаются прежние курсы, следующая попытка - через FX_REFRESH_INTERVAL
+    fx_rates = tenant.fx_rates
+    if not fx_rates.is_stale(FX_REFRESH_INTERVAL):
+        return fx_rates
+    try:
+        if FX_RATES_PATH:
+            rates = load_rates_file(FX_RATES_PATH)
         else:
-            return CATEGORIES, SUBCATEGORIES, SOURCES
+            fx_sheet = await tenant.client.worksheet(FX_SHEET_NAME, priority)
+            rates = parse_rate_rows(await tenant.client.call(fx_sheet.get, "A:B", priority=priority, **SYNC_READ_OPTIONS))
+        print(f"Курсы валют загружены: {len(rates)} валют к {fx_rates.base}.")
+    except WorksheetNotFound:
+        print(f"Лист курсов '{FX_SHEET_NAME}' не найден - суммы в {fx_rates.base} считаются только для {fx_rates.base}.")
+        rates = {}
+    except CircuitOpenError:
+        raise
+    except Exception as e_fx:
+        print(f"Не удалось загрузить курсы валют: {e_fx}")
+        rates = {currency: rate for currency, rate in fx_rates.rates.items() if currency != fx_rates.base}
+    fx_rates.replace(rates)
+    return fx_rates
+
+
+async def _write_fact_rows(tenant: Tenant, rows: list[list], on_begin):
+    # Записи из очереди - это ввод пользователей, поэтому все вызовы API здесь идут с пользовательским приоритетом
+    fact_sheet = await _open_fact_sheet(tenant, PRIORITY_USER)
+    fx_rates = await load_fx_rates(tenant, PRIORITY_USER)
+    # Колонка I - сумма в базовой валюте по курсу на момент записи (пусто, если курса валюты нет).
+    # Сумма СМС пересчитывается из валюты, указанной в самом СМС, остальные строки - из валюты источника
+    base_amounts = [fx_rates.convert(row[3], row[7] if len(row) > 7 and row[7] else row[5]) for row in rows]
+    values = [row[:7] + ['' if amount is None else amount] for row, amount in zip(rows, base_amounts)]
+    balances = None
+    if BALANCE_MODE == 'value':
+        if not tenant.ledger_synced:
+            # Нарастающий баланс считается от зеркала - до первой синхронизации оно может быть неполным
+            await sync_fact_ledger(tenant, PRIORITY_USER)
+        balances = tenant.balance_index.preview(rows)
+    if tenant.row_cursor.next_row is None:
+        # Курсор сброшен (первая запись, сбой прошлой записи или ответ без updatedRange): сверка с таблицей - это чтение,
+        # оно идёт отдельным вызовом через планировщик квот, а не внутри вызова записи
+        await tenant.client.call(tenant.row_cursor.reconcile, fact_sheet, priority=PRIORITY_USER)
+    # Без повторов: при сбое очередь записи сама проверит, легли ли строки, и повторит пакет.
+    # Считается как один запрос на запись (append_rows; update формул - только при сдвиге строк)
+    written_range = await tenant.client.call(append_fact_rows, fact_sheet, tenant.row_cursor, values, on_begin, balances,
+                                             retry=False, kind=WRITE, priority=PRIORITY_USER)
+    if written_range:
+        tenant.ledger.record_written(written_range[0], rows)
+    return written_range
+
+
+async def sync_fact_ledger(tenant: Tenant, priority: int = PRIORITY_BACKGROUND) -> int:
+    # Дочитывает в локальное зеркало только строки, появившиеся в "fact" после последней синхронизации
+    fact_sheet = await _open_fact_sheet(tenant, priority)
+    total = 0
+    while True:
+        first_row, range_name = tenant.ledger.next_sync_range()
+        values = await tenant.client.call(fact_sheet.get, range_name, priority=priority, **SYNC_READ_OPTIONS)
+        tenant.ledger.store_sheet_rows(first_row, values)
+        total += len(values)
+        if len(values) < tenant.ledger.sync_chunk_rows:
+            tenant.ledger_synced = True
+            return total
+
+
+async def _sync_fact_ledger_in_background(tenant: Tenant):
+    try:
+        synced = await sync_fact_ledger(tenant)
+        print(f"Локальное зеркало 'fact' синхронизировано: новых строк {synced}, последняя строка {tenant.ledger.synced_row}.")
+    except Exception as e_sync:
+        print(f"Не удалось синхронизировать локальное зеркало 'fact': {e_sync}")
+
+
+async def _verify_fact_rows(tenant: Tenant, rows: list[list], start_row: int) -> bool:
+    # Проверка после сбоя: есть ли строки пакета в таблице начиная с start_row.
+    # Сравниваются категория, сумма, комментарий и источник - читается только хвост листа, а не весь лист.
+    fact_sheet = await _open_fact_sheet(tenant, PRIORITY_USER)
+    next_row = await tenant.client.call(tenant.row_cursor.reconcile, fact_sheet, priority=PRIORITY_USER)
+    if next_row - start_row < len(rows):
+        return False
+    tail = await tenant.client.call(fact_sheet.get, f"A{start_row}:H{next_row - 1}",
+                                    value_render_option='UNFORMATTED_VALUE', priority=PRIORITY_USER)
+    written = set()
+    for row in tail:
+        row = list(row) + [''] * (8 - len(row))
+        try:
+            written.add((str(row[1]), float(row[3]), str(row[5]), str(row[7])))
+        except (TypeError, ValueError):
+            continue
+    return all((str(row[1]), float(row[3]), str(row[4]), str(row[6])) in written for row in rows)
+
+
+def _create_tenant(key: str, client: SheetsClient, ledger_path: str, journal_path: str, snapshot_path: str) -> Tenant:
+    # Записи в лист "fact" копятся в очереди таблицы и уходят пакетами одним append_rows
+    return Tenant(
+        key, client, ledger_path, journal_path, snapshot_path,
+        writer=_write_fact_rows,
+        verifier=_verify_fact_rows,
+        flush_interval_ms=WRITE_FLUSH_INTERVAL_MS,
+        flush_max_rows=WRITE_FLUSH_MAX_ROWS,
+        base_currency=FX_BASE_CURRENCY,
+        is_transient=_is_transient_write_error,
+        retry_base=WRITE_RETRY_BASE,
+        retry_max=WRITE_RETRY_MAX,
+        max_attempts=WRITE_MAX_ATTEMPTS,
+    )
+
+
+# Единственная таблица обычного режима (SPREADSHEET_ID); в режиме нескольких таблиц не используется.
+# Открывается в open_stores() (из build_application), а не при импорте: импорт модуля не создаёт файлов
+default_tenant = None
+
+# Режим нескольких таблиц: привязка чатов к таблицам и открытые таблицы (LRU с закрытием после простоя)
+tenant_directory = None
+_opening_tenants = {} # идентификатор таблицы -> задача открытия (одновременные обращения ждут одну)
+_closing_tenants = {} # идентификатор таблицы -> задача закрытия вытесненной таблицы
+_tenant_tasks = set()
+_handler_leases = contextvars.ContextVar('handler_leases', default=None) # таблицы, занятые текущим обработчиком
+
 
+def open_stores():
+    # Локальные базы бота: зеркало и журнал записи таблицы обычного режима или справочник таблиц чатов
+    global default_tenant, tenant_directory
+    if MULTI_TENANT:
+        if tenant_directory is None:
+            tenant_directory = TenantDirectory(TENANTS_PATH)
+    elif default_tenant is None:
+        default_tenant = _create_tenant('default', sheets_client, LEDGER_PATH, WRITE_JOURNAL_PATH, REFERENCE_SNAPSHOT_PATH)
+
+
+def _on_tenant_evicted(spreadsheet_id: str, tenant: Tenant):
+    task = asyncio.get_running_loop().create_task(_close_tenant(tenant))
+    _closing_tenants[spreadsheet_id] = task
+    task.add_done_callback(lambda t: _closing_tenants.pop(spreadsheet_id, None) if _closing_tenants.get(spreadsheet_id) is t else None)
+
+
+tenant_cache = LRUCache(maxsize=TENANT_CACHE_SIZE, idle_ttl=TENANT_IDLE_TTL, on_evict=_on_tenant_evicted)
+
+
+async def _close_tenant(tenant: Tenant):
     try:
-        system_sheet = sheet.worksheet("system")
-        data = system_sheet.get_all_values()
-    except (gspread.exceptions.APIError, ConnectionError) as e:
-        print(f"Ошибка API/Соединения Google Sheets при загрузке данных клавиатуры: {e}. Попытка переподключения...")
+        await tenant.close()
+        print(f"Таблица {tenant.key} закрыта (простой или вытеснение из кэша).")
+    except Exception as e_close:
+        print(f"Ошибка при закрытии таблицы {tenant.key}: {e_close}")
+
+
+def _spawn(tenant: Tenant, coro):
+    # Фоновая задача таблицы: держим ссылку, чтобы задачу не собрал сборщик мусора, а таблицу не закрываем до её конца
+    tenant.acquire()
+    task = asyncio.create_task(coro)
+    _tenant_tasks.add(task)
+    task.add_done_callback(_tenant_tasks.discard)
+    task.add_done_callback(lambda _: tenant.release())
+    return task
+
+
+async def open_tenant(spreadsheet_id: str, bot, priority: int = PRIORITY_USER, client: SheetsClient = None) -> Tenant:
+    # priority - для чтения справочников при первом открытии: обычно таблицу открывает сообщение пользователя.
+    # client - уже открытый клиент таблицы (/connect проверяет доступ до того, как создать файлы таблицы)
+    tenant = tenant_cache.get(spreadsheet_id)
+    if tenant is not None:
+        return tenant
+    opening = _opening_tenants.get(spreadsheet_id)
+    if opening is None:
+        opening = asyncio.ensure_future(_open_tenant(spreadsheet_id, bot, priority, client))
+        _opening_tenants[spreadsheet_id] = opening
+        opening.add_done_callback(lambda _: _opening_tenants.pop(spreadsheet_id, None))
+    return await asyncio.shield(opening)
+
+
+async def _open_tenant(spreadsheet_id: str, bot, priority: int, client: SheetsClient = None) -> Tenant:
+    tenant_cache.evict_idle()
+    closing = _closing_tenants.get(spreadsheet_id)
+    if closing:
+        # Вытесненная таблица ещё дописывает очередь - её файлы нельзя открывать повторно до закрытия
+        await closing
+    data_dir = tenant_data_dir(TENANTS_DATA_DIR, spreadsheet_id)
+    tenant = _create_tenant(
+        spreadsheet_id, client or sheets_client.for_spreadsheet(spreadsheet_id),
+        os.path.join(data_dir, os.path.basename(LEDGER_PATH)),
+        os.path.join(data_dir, os.path.basename(WRITE_JOURNAL_PATH)),
+        os.path.join(data_dir, os.path.basename(REFERENCE_SNAPSHOT_PATH)),
+    )
+    for confirmation, meta in await tenant.write_queue.start():
+        _schedule_write_confirmation(bot, confirmation, meta)
+    if restore_reference_snapshot(tenant):
+        _spawn(tenant, _init_google(tenant))
+    else:
+        # Первое обращение к таблице: без справочников меню не построить - ждём их здесь
         try:
-            if GOOGLE_APPLICATION_CREDENTIALS_PATH and os.path.exists(GOOGLE_APPLICATION_CREDENTIALS_PATH):
-                client = gspread.service_account(filename=GOOGLE_APPLICATION_CREDENTIALS_PATH)
-            elif GOOGLE_PRIVATE_KEY and GOOGLE_SERVICE_ACCOUNT_EMAIL : # Попытка пересоздать creds из основных переменных
-                print("Попытка пересоздать аутентификацию gspread...")
-                creds_info_retry = {
-                    "type": "service_account",
-                    "private_key": GOOGLE_PRIVATE_KEY,
-                    "client_email": GOOGLE_SERVICE_ACCOUNT_EMAIL,
-                    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                    "token_uri": "https://oauth2.googleapis.com/token",
-                    "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-                    "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{GOOGLE_SERVICE_ACCOUNT_EMAIL.replace('@', '%40')}"
-                }
-                creds_retry = Credentials.from_service_account_info(creds_info_retry, scopes=["https://www.googleapis.com/auth/spreadsheets"])
-                client = gspread.authorize(creds_retry)
-            else: # крайний случай, если нет ни пути к файлу, ни ключей для ручного создания
-                import google.auth
-                scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive.file"]
-                creds_retry, _ = google.auth.default(scopes=scopes) # может не сработать без GOOGLE_APPLICATION_CREDENTIALS
-                client = gspread.authorize(creds_retry)
-
-
-            if client and SPREADSHEET_ID:
-                sheet = client.open_by_key(SPREADSHEET_ID)
-                system_sheet = sheet.worksheet("system")
-                data = system_sheet.get_all_values()
-            else:
-                raise Exception("Не удалось переинициализировать client или sheet.")
-        except Exception as ex:
-            print(f"Не удалось переподключиться и загрузить данные: {ex}")
-            return CATEGORIES, SUBCATEGORIES, SOURCES
+            await load_keyboard_data(tenant, priority)
+        except Exception as e_load:
+            print(f"Не удалось загрузить справочники таблицы {spreadsheet_id}: {e_load}")
+        _spawn(tenant, _init_google(tenant, load_reference=False))
+    tenant_cache.put(spreadsheet_id, tenant)
+    print(f"Таблица {spreadsheet_id} открыта: категорий {len(tenant.categories)}, источников {len(tenant.sources)}; "
+          f"открытых таблиц {len(tenant_cache)}.")
+    return tenant
+
+
+def active_tenants() -> list[Tenant]:
+    if MULTI_TENANT:
+        return tenant_cache.values()
+    return [default_tenant] if default_tenant else []
+
+
+def releases_tenants(handler):
+    # Декоратор обработчика: таблица, полученная через tenant_for_update, не закрывается (даже вытесненная
+    # из кэша), пока обработчик не завершится
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        leases = []
+        token = _handler_leases.set(leases)
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            _handler_leases.reset(token)
+            for tenant in leases:
+                tenant.release()
+    return wrapper
+
+
+async def _lease_tenant(spreadsheet_id: str, bot, client: SheetsClient = None) -> Tenant:
+    while True:
+        tenant = await open_tenant(spreadsheet_id, bot, client=client)
+        if not tenant.closing: # Таблицу успели вытеснить и закрыть - открываем заново
+            break
+    leases = _handler_leases.get()
+    if leases is not None:
+        tenant.acquire()
+        leases.append(tenant)
+    return tenant
+
+
+async def tenant_for_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Таблица чата; None (с подсказкой пользователю), если чат ещё не привязан к таблице
+    if not MULTI_TENANT:
+        return default_tenant
+    chat = update.effective_chat
+    spreadsheet_id = tenant_directory.get(chat.id) if chat else None
+    if not spreadsheet_id:
+        if update.effective_message:
+            await update.effective_message.reply_text(
+                'Для этого чата не подключена таблица. Откройте доступ к своей Google Таблице для сервисного аккаунта '
+                f'{GOOGLE_SERVICE_ACCOUNT_EMAIL or "бота"} и отправьте /connect <ссылка на таблицу>.')
+        return None
+    return await _lease_tenant(spreadsheet_id, context.bot)
+
+
+_write_confirmation_tasks = set()
+
+
+def _schedule_write_confirmation(bot, confirmation, meta: dict):
+    # Не через Application.create_task: такие задачи ожидаются при остановке, а подтверждение может не прийти
+    task = asyncio.create_task(_confirm_write(bot, confirmation, meta))
+    _write_confirmation_tasks.add(task)
+    task.add_done_callback(_write_confirmation_tasks.discard)
+
+
+async def _confirm_write(bot, confirmation, meta: dict):
+    chat_id = meta.get('chat_id')
+    try:
+        await confirmation
+    except asyncio.CancelledError:
+        return # Бот останавливается - заявка осталась в журнале и будет записана при следующем запуске
+    except Exception as e_write:
+        # Пакет отклонён очередью - данные не записаны, пользователь должен узнать об этом
+        if chat_id:
+            try:
+                await bot.send_message(chat_id=chat_id, text=f"Не удалось записать данные в таблицу: {e_write}\n"
+                                                             f"Данные не сохранены - отправьте их ещё раз позже.")
+            except Exception as e_send:
+                print(f"Не удалось сообщить об ошибке записи в чат {chat_id}: {e_send}")
+        return
+    if not chat_id:
+        return
+    if meta.get('delete_message_id'):
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=meta['delete_message_id'])
+            print(f"Сообщение {meta['delete_message_id']} с СМС удалено.")
+        except Exception as e_delete:
+            print(f"Не удалось удалить сообщение с СМС {meta['delete_message_id']}: {e_delete}")
+    try:
+        await bot.send_message(chat_id=chat_id, text=meta.get('confirm_text', 'Данные успешно записаны.'))
+    except Exception as e_send:
+        print(f"Не удалось отправить подтверждение записи в чат {chat_id}: {e_send}")
+
+
+async def _fetch_system_values(tenant: Tenant, priority: int = PRIORITY_BACKGROUND):
+    # Чтение листа "system"; None, если таблица недоступна
+    if not await ensure_sheet(tenant, priority):
+        print("Sheet не инициализирован при чтении листа 'system'. Данные не могут быть загружены.")
+        return None
+    try:
+        system_sheet = await tenant.client.worksheet("system", priority)
+        return await tenant.client.call(system_sheet.get_all_values, priority=priority)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"Ошибка Google Sheets при загрузке данных клавиатуры: {e}")
+        return None
+
+
+def _system_columns(data: list[list]) -> list[tuple]:
+    # Колонки, из которых строятся справочники: A - категория, B - подкатегория, F - источник
+    return [
+        (row[0].strip() if len(row) > 0 and row[0] else "",
+         row[1].strip() if len(row) > 1 and row[1] else "",
+         row[5].strip() if len(row) > 5 and row[5] else "")
+        for row in data[1:]
+    ]
+
+
+def _system_hash(columns: list[tuple]) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for column_values in columns:
+        digest.update('\x1f'.join(column_values).encode('utf-8'))
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+
+def apply_system_values(tenant: Tenant, data: list[list]) -> bool:
+    # Пересобирает справочники, только если колонки A, B, F изменились; True - данные заменены
+    columns = _system_columns(data)
+    content_hash = _system_hash(columns)
+    if content_hash == tenant.reference_hash:
+        return False
 
     temp_categories = []
     temp_subcategories = {}
     temp_sources = []
 
-    if len(data) > 1:
-        for row_idx, row in enumerate(data):
-            if row_idx == 0:
-                continue
+    for category, subcategory, source_from_sheet in columns:
+        if category and category not in temp_categories:
+            temp_categories.append(category)
+
+        if category and subcategory:
+            temp_subcategories.setdefault(category, []).append(subcategory)
 
-            category = row[0].strip() if len(row) > 0 and row[0] else ""
-            subcategory = row[1].strip() if len(row) > 1 and row[1] else ""
-            source_from_sheet = row[5].strip() if len(row) > 5 and row[5] else ""
+        if source_from_sheet and source_from_sheet not in temp_sources:
+            temp_sources.append(source_from_sheet)
 
-            if category and category not in temp_categories:
-                temp_categories.append(category)
+    tenant.apply_reference_data(temp_categories, temp_subcategories, temp_sources, content_hash)
+    try:
+        save_snapshot(tenant.snapshot_path, temp_categories, temp_subcategories, temp_sources, content_hash)
+    except OSError as e_snapshot:
+        print(f"Не удалось сохранить снимок справочников: {e_snapshot}")
+    return True
+
+
+async def load_keyboard_data(tenant: Tenant, priority: int = PRIORITY_BACKGROUND):
+    # Чтение листа "system" идёт в пуле шлюза; сами справочники заменяются в цикле событий, одним шагом между
+    # обработчиками. None - таблица недоступна, иначе признак того, что данные изменились.
+    # priority - PRIORITY_USER, когда ответа ждёт пользователь (открытие таблицы, /reboot, /connect)
+    data = await _fetch_system_values(tenant, priority)
+    if data is None:
+        return None
+    return apply_system_values(tenant, data)
+
+
+async def refresh_reference_job(context: ContextTypes.DEFAULT_TYPE):
+    # Периодическая задача JobQueue вместо ручного /reboot - для всех открытых таблиц
+    for tenant in active_tenants():
+        with tenant:
+            try:
+                changed = await load_keyboard_data(tenant)
+            except Exception as e_refresh:
+                print(f"Ошибка фонового обновления справочников: {e_refresh}")
+                continue
+            if changed:
+                print(f"Справочники из листа 'system' изменились и обновлены: категорий {len(tenant.categories)}, "
+                      f"источников {len(tenant.sources)}.")
 
-            if category and subcategory:
-                temp_subcategories.setdefault(category, []).append(subcategory)
 
-            if source_from_sheet and source_from_sheet not in temp_sources:
-                temp_sources.append(source_from_sheet)
+def restore_reference_snapshot(tenant: Tenant) -> bool:
+    # Справочники из снимка на диске - доступны сразу, без обращения к Google Sheets
+    snapshot = load_snapshot(tenant.snapshot_path)
+    if not snapshot:
+        return False
+    tenant.apply_reference_data(*snapshot)
+    return True
 
-    CATEGORIES = temp_categories
-    SUBCATEGORIES = temp_subcategories
-    SOURCES = temp_sources
 
-    return CATEGORIES, SUBCATEGORIES, SOURCES
+async def _init_google(tenant: Tenant, load_reference: bool = True):
+    # Первое подключение к таблице: справочники, курсор "fact" и зеркало - в фоне
+    started = time.perf_counter()
+    try:
+        if not await ensure_sheet(tenant):
+            print("Sheet не был инициализирован при запуске. Данные клавиатуры не загружены.")
+            return
+        if load_reference:
+            await load_keyboard_data(tenant)
+            print(f"Справочники загружены из Google Sheets за {(time.perf_counter() - started) * 1000:.0f} мс: "
+                  f"категорий {len(tenant.categories)}, источников {len(tenant.sources)}.")
+        fact_sheet = await tenant.client.worksheet("fact")
+        await tenant.client.call(tenant.row_cursor.reconcile, fact_sheet)
+    except Exception as e_init:
+        print(f"Ошибка первичной загрузки данных из Google Sheets: {e_init}")
+        return
+    await _sync_fact_ledger_in_background(tenant)
 
 
-if sheet:
-    load_keyboard_data()
-else:
-    print("Sheet не был инициализирован при запуске. Данные клавиатуры не загружены.")
+def generate_categories_keyboard(tenant: Tenant, context: ContextTypes.DEFAULT_TYPE = None):
+    current_source = context.user_data.get('source') if context else None
+    return keyboard_cache.get_or_build(
+        ('categories', tenant.key, tenant.callback_index.version, current_source),
+        lambda: _build_categories_keyboard(tenant.callback_index, current_source)
+    )
 
 
-def generate_categories_keyboard(context: ContextTypes.DEFAULT_TYPE = None):
+def _build_categories_keyboard(index: CallbackIndex, current_source):
     keyboard = []
     row_buttons = []
-    for idx, category in enumerate(CATEGORIES, 1):
-        row_buttons.append(InlineKeyboardButton(text=category, callback_data=f"cat_{category}"))
-        if idx % 3 == 0 or idx == len(CATEGORIES):
+    for idx, category in enumerate(index.categories, 1):
+        row_buttons.append(InlineKeyboardButton(text=category, callback_data=index.category_data(category)))
+        if idx % 3 == 0 or idx == len(index.categories):
             keyboard.append(row_buttons)
             row_buttons = []
     if row_buttons:
         keyboard.append(row_buttons)
 
     action_buttons_row = [
-        InlineKeyboardButton(text="СМС", callback_data="sms")
+        InlineKeyboardButton(text="СМС", callback_data=callbacks.ACTION_SMS)
     ]
 
     source_button_text = "Источник (не выбран)"
-    current_source = None
-    if context and context.user_data.get('source'):
-        current_source = context.user_data.get('source')
+    if current_source:
         source_button_text = f"Источник: {current_source}"
 
-    action_buttons_row.append(InlineKeyboardButton(text=source_button_text, callback_data="change_source"))
+    action_buttons_row.append(InlineKeyboardButton(text=source_button_text, callback_data=callbacks.ACTION_CHANGE_SOURCE))
     keyboard.append(action_buttons_row)
 
     return InlineKeyboardMarkup(keyboard)
 
 
-def generate_sources_keyboard():
+def generate_sources_keyboard(tenant: Tenant):
+    return keyboard_cache.get_or_build(('sources', tenant.key, tenant.callback_index.version),
+                                       lambda: _build_sources_keyboard(tenant.callback_index))
+
+
+def _build_sources_keyboard(index: CallbackIndex):
     keyboard = []
     row_buttons = []
-    for idx, src_name in enumerate(SOURCES, 1):
-        row_buttons.append(InlineKeyboardButton(text=src_name, callback_data=f"set_source_{src_name}"))
-        if idx % 2 == 0 or idx == len(SOURCES):
+    for idx, src_name in enumerate(index.sources, 1):
+        row_buttons.append(InlineKeyboardButton(text=src_name, callback_data=index.source_data(idx - 1)))
+        if idx % 2 == 0 or idx == len(index.sources):
             keyboard.append(row_buttons)
             row_buttons = []
     if row_buttons:
         keyboard.append(row_buttons)
     keyboard.append([
-        InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_categories_from_source")
+        InlineKeyboardButton(text="⬅️ Назад", callback_data=callbacks.ACTION_BACK_FROM_SOURCES)
     ])
     return InlineKeyboardMarkup(keyboard)
 
 
-def generate_subcategories_keyboard(selected_category):
+def generate_subcategories_keyboard(tenant: Tenant, selected_category):
+    return keyboard_cache.get_or_build(
+        ('subcategories', tenant.key, tenant.callback_index.version, selected_category),
+        lambda: _build_subcategories_keyboard(tenant.callback_index, selected_category)
+    )
+
+
+def _build_subcategories_keyboard(index: CallbackIndex, selected_category):
     keyboard = []
     row_buttons = []
-    subcategories_list = SUBCATEGORIES.get(selected_category, [])
+    subcategories_list = []
+    if selected_category in index.category_ids:
+        subcategories_list = index.subcategories[index.category_ids[selected_category]]
     for idx, subcategory_name in enumerate(subcategories_list, 1):
-        row_buttons.append(InlineKeyboardButton(text=subcategory_name, callback_data=f"sub_{subcategory_name}"))
+        row_buttons.append(InlineKeyboardButton(text=subcategory_name,
+                                                callback_data=index.subcategory_data(selected_category, idx - 1)))
         if idx % 2 == 0 or idx == len(subcategories_list):
             keyboard.append(row_buttons)
             row_buttons = []
     if row_buttons:
         keyboard.append(row_buttons)
     keyboard.append([
-        InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_categories")
+        InlineKeyboardButton(text="⬅️ Назад", callback_data=callbacks.ACTION_BACK_TO_CATEGORIES)
     ])
     return InlineKeyboardMarkup(keyboard)
 
 
+@instrument_handler("start")
+@releases_tenants
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not sheet:
+    # Меню строится по справочникам из снимка, не дожидаясь подключения к таблице
+    tenant = await tenant_for_update(update, context)
+    if not tenant:
+        return
+    if not tenant.categories and not await ensure_sheet(tenant):
         await update.message.reply_text(
             'Ошибка: Не удалось подключиться к Google Sheets. Пожалуйста, проверьте конфигурацию (переменные окружения / .env) и перезапустите бота.')
         return
 
     current_source = context.user_data.get('source')
-    if not current_source and SOURCES:
-        context.user_data['source'] = SOURCES[0]
-        current_source = SOURCES[0]
-    elif not SOURCES:
+    if not current_source and tenant.sources:
+        context.user_data['source'] = tenant.sources[0]
+        current_source = tenant.sources[0]
+    elif not tenant.sources:
         await update.message.reply_text(
             "Список источников пуст. Пожалуйста, заполните источники в Google Таблице (лист 'system', колонка F) и выполните /reboot.",
             reply_markup=None)
@@ -377,163 +735,207 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(
         welcome_message,
-        reply_markup=generate_categories_keyboard(context)
+        reply_markup=generate_categories_keyboard(tenant, context)
     )
 
 
+@instrument_handler("reboot")
+@releases_tenants
 async def reboot(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not client:
-        await update.message.reply_text(
-            'Ошибка: Не удалось подключиться к Google Sheets (client не инициализирован). Команда reboot не может обновить данные.')
+    tenant = await tenant_for_update(update, context)
+    if not tenant:
         return
-
-    global CATEGORIES, SUBCATEGORIES, SOURCES, sheet # Объявляем sheet как global для возможного переназначения
-    if not sheet and client and SPREADSHEET_ID:
-        try:
-            print("Попытка открыть таблицу в reboot...")
-            sheet = client.open_by_key(SPREADSHEET_ID)
-        except Exception as e_reopen_reboot:
-            await update.message.reply_text(f'Ошибка при попытке открыть таблицу в reboot: {e_reopen_reboot}')
-            return
-
-    if not sheet: # Повторная проверка после попытки открытия
+    if not await ensure_sheet(tenant, PRIORITY_USER):
         await update.message.reply_text(
-            'Ошибка: Не удалось подключиться к Google Sheets (sheet не инициализирован). Команда reboot не может обновить данные.')
+            'Ошибка: Не удалось подключиться к Google Sheets. Команда reboot не может обновить данные.')
         return
 
-    CATEGORIES, SUBCATEGORIES, SOURCES = load_keyboard_data() # load_keyboard_data сама обрабатывает ошибки с sheet
+    await load_keyboard_data(tenant, PRIORITY_USER) # load_keyboard_data сама обрабатывает ошибки с sheet
+    await _sync_fact_ledger_in_background(tenant) # Заодно дочитываем строки, добавленные в "fact" вручную
 
     current_source = context.user_data.get('source')
     source_updated = False
-    if not current_source and SOURCES:
-        context.user_data['source'] = SOURCES[0]
+    if not current_source and tenant.sources:
+        context.user_data['source'] = tenant.sources[0]
         source_updated = True
-    elif current_source and current_source not in SOURCES:
-        context.user_data['source'] = SOURCES[0] if SOURCES else None
+    elif current_source and current_source not in tenant.sources:
+        context.user_data['source'] = tenant.sources[0] if tenant.sources else None
         source_updated = True
 
-    if SOURCES or source_updated : # Условие изменено чтобы сообщение об обновлении появлялось даже если источники были пустыми и остались пустыми
+    if tenant.sources or source_updated : # Условие изменено чтобы сообщение об обновлении появлялось даже если источники были пустыми и остались пустыми
         await update.message.reply_text('Данные клавиатуры (категории, подкатегории, источники) успешно обновлены.')
         await start(update, context) # Передаем update и context в start
-    elif not SOURCES: # Это условие теперь избыточно, т.к. предыдущее его покрывает
+    elif not tenant.sources: # Это условие теперь избыточно, т.к. предыдущее его покрывает
         await update.message.reply_text(
              "Данные клавиатуры обновлены, но список источников пуст. Пожалуйста, заполните их в Google Таблице.")
 
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-
+def _selected_source_and_currency(context: ContextTypes.DEFAULT_TYPE):
     selected_source = context.user_data.get('source')
     derived_currency = FALLBACK_CURRENCY
     if selected_source:
         derived_currency = get_currency_from_source(selected_source)
+    return selected_source, derived_currency
 
-    if data.startswith("cat_"):
-        selected_category = data[4:]
-        context.user_data['category'] = selected_category
-        if not selected_source:
-            await query.edit_message_text(
-                text=f"Сначала выберите ИСТОЧНИК.\nЗатем выберите категорию.",
-                reply_markup=generate_categories_keyboard(context)
-            )
-            return
+
+async def _on_category(query, context: ContextTypes.DEFAULT_TYPE, tenant: Tenant, version: str, ids: list[int]):
+    selected_source, derived_currency = _selected_source_and_currency(context)
+    selected_category = tenant.callback_index.resolve(version, ids, callbacks.ACTION_CATEGORY)
+    context.user_data['category'] = selected_category
+    if not selected_source:
         await query.edit_message_text(
-            text=f"Источник: {selected_source} (Валюта: {derived_currency})\nКатегория: {selected_category}\n\nВыберите подкатегорию:",
-            reply_markup=generate_subcategories_keyboard(selected_category)
+            text=f"Сначала выберите ИСТОЧНИК.\nЗатем выберите категорию.",
+            reply_markup=generate_categories_keyboard(tenant, context)
         )
+        return
+    await query.edit_message_text(
+        text=f"Источник: {selected_source} (Валюта: {derived_currency})\nКатегория: {selected_category}\n\nВыберите подкатегорию:",
+        reply_markup=generate_subcategories_keyboard(tenant, selected_category)
+    )
 
-    elif data in ["back_to_categories", "back_to_categories_from_source"]:
-        context.user_data.pop('category', None)
-        context.user_data.pop('subcategory', None)
 
-        message_text = "Выбери категорию:"
-        if selected_source:
-            message_text = f"Источник: {selected_source} (Валюта: {derived_currency})\n{message_text}"
-        else:
-            message_text = f"Источник не выбран. Валюта не определена.\n{message_text}"
+async def _on_back_to_categories(query, context: ContextTypes.DEFAULT_TYPE, tenant: Tenant, version: str, ids: list[int]):
+    selected_source, derived_currency = _selected_source_and_currency(context)
+    context.user_data.pop('category', None)
+    context.user_data.pop('subcategory', None)
 
-        await query.edit_message_text(
-            text=message_text,
-            reply_markup=generate_categories_keyboard(context)
-        )
+    message_text = "Выбери категорию:"
+    if selected_source:
+        message_text = f"Источник: {selected_source} (Валюта: {derived_currency})\n{message_text}"
+    else:
+        message_text = f"Источник не выбран. Валюта не определена.\n{message_text}"
 
-    elif data == "sms_back":
-        context.user_data.pop('sms_mode', None)
-        message_text = "Выбери категорию:"
-        if selected_source:
-            message_text = f"Источник: {selected_source} (Валюта: {derived_currency})\n{message_text}"
-        else:
-            message_text = f"Источник не выбран. Валюта не определена.\n{message_text}"
-        await query.edit_message_text(
-            text=message_text,
-            reply_markup=generate_categories_keyboard(context)
-        )
+    await query.edit_message_text(
+        text=message_text,
+        reply_markup=generate_categories_keyboard(tenant, context)
+    )
 
-    elif data.startswith("sub_"):
-        subcategory_name = data[4:]
-        context.user_data['subcategory'] = subcategory_name
-        category = context.user_data.get('category', 'Не выбрана')
-        if not selected_source:
-            await query.edit_message_text(
-                text=f"Ошибка: Источник не выбран. Пожалуйста, вернитесь и выберите источник.",
-                reply_markup=generate_categories_keyboard(context)
-            )
-            return
-        prompt_text = (f"Источник: {selected_source}\n"
-                       f"Категория: {category}\n"
-                       f"Подкатегория: {subcategory_name}\n"
-                       f"Валюта: {derived_currency}\n\n"
-                       f"ВНЕСИТЕ СУММУ И КОММЕНТАРИЙ (ЧЕРЕЗ ПРОБЕЛ):")
+
+async def _on_sms_back(query, context: ContextTypes.DEFAULT_TYPE, tenant: Tenant, version: str, ids: list[int]):
+    selected_source, derived_currency = _selected_source_and_currency(context)
+    context.user_data.pop('sms_mode', None)
+    message_text = "Выбери категорию:"
+    if selected_source:
+        message_text = f"Источник: {selected_source} (Валюта: {derived_currency})\n{message_text}"
+    else:
+        message_text = f"Источник не выбран. Валюта не определена.\n{message_text}"
+    await query.edit_message_text(
+        text=message_text,
+        reply_markup=generate_categories_keyboard(tenant, context)
+    )
+
+
+async def _on_subcategory(query, context: ContextTypes.DEFAULT_TYPE, tenant: Tenant, version: str, ids: list[int]):
+    selected_source, derived_currency = _selected_source_and_currency(context)
+    category, subcategory_name = tenant.callback_index.resolve(version, ids, callbacks.ACTION_SUBCATEGORY)
+    context.user_data['category'] = category
+    context.user_data['subcategory'] = subcategory_name
+    if not selected_source:
         await query.edit_message_text(
-            text=prompt_text,
-            reply_markup=generate_subcategories_keyboard(category) # Здесь остаётся клавиатура подкатегорий для навигации "Назад"
+            text=f"Ошибка: Источник не выбран. Пожалуйста, вернитесь и выберите источник.",
+            reply_markup=generate_categories_keyboard(tenant, context)
         )
+        return
+    prompt_text = (f"Источник: {selected_source}\n"
+                   f"Категория: {category}\n"
+                   f"Подкатегория: {subcategory_name}\n"
+                   f"Валюта: {derived_currency}\n\n"
+                   f"ВНЕСИТЕ СУММУ И КОММЕНТАРИЙ (ЧЕРЕЗ ПРОБЕЛ):")
+    await query.edit_message_text(
+        text=prompt_text,
+        reply_markup=generate_subcategories_keyboard(tenant, category) # Здесь остаётся клавиатура подкатегорий для навигации "Назад"
+    )
 
-    elif data == "change_source":
-        if not SOURCES:
-            await query.edit_message_text(
-                text="Список источников пуст. Невозможно выбрать источник. Заполните Google Таблицу.",
-                reply_markup=generate_categories_keyboard(context)
-            )
-            return
+
+async def _on_change_source(query, context: ContextTypes.DEFAULT_TYPE, tenant: Tenant, version: str, ids: list[int]):
+    if not tenant.sources:
         await query.edit_message_text(
-            text="Выберите источник:",
-            reply_markup=generate_sources_keyboard()
+            text="Список источников пуст. Невозможно выбрать источник. Заполните Google Таблицу.",
+            reply_markup=generate_categories_keyboard(tenant, context)
         )
+        return
+    await query.edit_message_text(
+        text="Выберите источник:",
+        reply_markup=generate_sources_keyboard(tenant)
+    )
+
+
+async def _on_set_source(query, context: ContextTypes.DEFAULT_TYPE, tenant: Tenant, version: str, ids: list[int]):
+    source_name = tenant.callback_index.resolve(version, ids, callbacks.ACTION_SET_SOURCE)
+    context.user_data['source'] = source_name
+    new_derived_currency = get_currency_from_source(source_name)
+    context.user_data.pop('category', None)
+    context.user_data.pop('subcategory', None)
+    await query.edit_message_text(
+        text=f"Источник '{source_name}' выбран (Валюта: {new_derived_currency}).\nВыбери категорию:",
+        reply_markup=generate_categories_keyboard(tenant, context)
+    )
+
 
-    elif data.startswith("set_source_"):
-        source_name = data[len("set_source_"):]
-        context.user_data['source'] = source_name
-        new_derived_currency = get_currency_from_source(source_name)
-        context.user_data.pop('category', None)
-        context.user_data.pop('subcategory', None)
+async def _on_sms(query, context: ContextTypes.DEFAULT_TYPE, tenant: Tenant, version: str, ids: list[int]):
+    selected_source, derived_currency = _selected_source_and_currency(context)
+    if not selected_source:
         await query.edit_message_text(
-            text=f"Источник '{source_name}' выбран (Валюта: {new_derived_currency}).\nВыбери категорию:",
-            reply_markup=generate_categories_keyboard(context)
+            text=f"Пожалуйста, сначала выберите ИСТОЧНИК.\nЗатем нажмите кнопку 'СМС' снова.",
+            reply_markup=generate_categories_keyboard(tenant, context)
         )
+        return
+    context.user_data['sms_mode'] = True
+    await query.edit_message_text(
+        text=f"Источник: {selected_source} (Валюта: {derived_currency})\nВставьте скопированные СМС или отправьте выгрузку файлом (.txt / .csv):",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(text="⬅️ Назад", callback_data=callbacks.ACTION_SMS_BACK)]
+        ])
+    )
 
-    elif data == "sms":
-        if not selected_source:
-            await query.edit_message_text(
-                text=f"Пожалуйста, сначала выберите ИСТОЧНИК.\nЗатем нажмите кнопку 'СМС' снова.",
-                reply_markup=generate_categories_keyboard(context)
-            )
-            return
-        context.user_data['sms_mode'] = True
+
+# Код действия из callback_data -> обработчик
+CALLBACK_HANDLERS = {
+    callbacks.ACTION_CATEGORY: _on_category,
+    callbacks.ACTION_SUBCATEGORY: _on_subcategory,
+    callbacks.ACTION_SET_SOURCE: _on_set_source,
+    callbacks.ACTION_CHANGE_SOURCE: _on_change_source,
+    callbacks.ACTION_BACK_TO_CATEGORIES: _on_back_to_categories,
+    callbacks.ACTION_BACK_FROM_SOURCES: _on_back_to_categories,
+    callbacks.ACTION_SMS: _on_sms,
+    callbacks.ACTION_SMS_BACK: _on_sms_back,
+}
+
+
+@instrument_handler("button_handler")
+@releases_tenants
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    tenant = await tenant_for_update(update, context)
+    if not tenant:
+        return
+
+    try:
+        action, version, ids = callbacks.decode(query.data)
+        handler = CALLBACK_HANDLERS.get(action)
+        if not handler:
+            raise StaleCallbackError(query.data)
+        await handler(query, context, tenant, version, ids)
+    except StaleCallbackError:
+        # Кнопка из сообщения, отправленного до обновления справочников - показываем актуальное меню
+        selected_source, derived_currency = _selected_source_and_currency(context)
+        message_text = "Меню устарело: справочники обновились. Выбери категорию:"
+        if selected_source:
+            message_text = f"Источник: {selected_source} (Валюта: {derived_currency})\n{message_text}"
         await query.edit_message_text(
-            text=f"Источник: {selected_source} (Валюта: {derived_currency})\nВставьте скопированные СМС:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(text="⬅️ Назад", callback_data="sms_back")]
-            ])
+            text=message_text,
+            reply_markup=generate_categories_keyboard(tenant, context)
         )
 
 
+@instrument_handler("text_handler")
+@releases_tenants
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global client, sheet # Объявляем client и sheet глобальными для возможного переподключения
-
-    if not sheet: # Проверяем sheet в начале
+    tenant = await tenant_for_update(update, context)
+    if not tenant:
+        return
+    if not await ensure_sheet(tenant, PRIORITY_USER): # Проверяем sheet в начале
         await update.message.reply_text(
             'Ошибка: Не удалось подключиться к Google Sheets. Данные не могут быть обработаны.')
         return
@@ -545,7 +947,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(
             "Ошибка: Источник не выбран. Пожалуйста, выберите источник через меню.",
-            reply_markup=generate_categories_keyboard(context)
+            reply_markup=generate_categories_keyboard(tenant, context)
         )
         return
 
@@ -564,122 +966,50 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     message_text_sms_fail = f"Источник: {user_selected_source} (Валюта: {transaction_currency})\n{message_text_sms_fail}"
                 await update.message.reply_text(
                     message_text_sms_fail,
-                    reply_markup=generate_categories_keyboard(context)
+                    reply_markup=generate_categories_keyboard(tenant, context)
                 )
                 return
         except Exception as e:
             await update.message.reply_text(f"Ошибка при разборе СМС: {e}")
             return
 
-        fact_sheet = None
-        num_existing_rows = 0
-        try:
-            fact_sheet = sheet.worksheet("fact")
-            all_values_before_sms = fact_sheet.get_all_values() # Получаем все значения для определения последней строки
-            num_existing_rows = len(all_values_before_sms)
-        except (ConnectionError, gspread.exceptions.APIError) as e:
-            print(f"Ошибка соединения/API при доступе к листу 'fact' (SMS): {e}. Попытка переподключения...")
-            try:
-                if GOOGLE_APPLICATION_CREDENTIALS_PATH and os.path.exists(GOOGLE_APPLICATION_CREDENTIALS_PATH):
-                    client = gspread.service_account(filename=GOOGLE_APPLICATION_CREDENTIALS_PATH)
-                elif GOOGLE_PRIVATE_KEY and GOOGLE_SERVICE_ACCOUNT_EMAIL:
-                    print("Попытка пересоздать аутентификацию gspread для SMS...")
-                    creds_info_retry_sms = {
-                        "type": "service_account",
-                        "private_key": GOOGLE_PRIVATE_KEY,
-                        "client_email": GOOGLE_SERVICE_ACCOUNT_EMAIL,
-                        # ... остальные поля creds_info
-                        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                        "token_uri": "https://oauth2.googleapis.com/token",
-                        "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-                        "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{GOOGLE_SERVICE_ACCOUNT_EMAIL.replace('@', '%40')}"
-
-                    }
-                    creds_retry_sms = Credentials.from_service_account_info(creds_info_retry_sms, scopes=["https://www.googleapis.com/auth/spreadsheets"])
-                    client = gspread.authorize(creds_retry_sms)
-                else:
-                    # Если нет учетных данных, используем google.auth.default()
-                    import google.auth
-                    scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive.file"]
-                    creds_retry_sms, _ = google.auth.default(scopes=scopes)
-                    client = gspread.authorize(creds_retry_sms)
-
-
-                if client and SPREADSHEET_ID:
-                    sheet = client.open_by_key(SPREADSHEET_ID) # Переоткрываем всю таблицу
-                    fact_sheet = sheet.worksheet("fact") # Получаем лист заново
-                    all_values_before_sms = fact_sheet.get_all_values()
-                    num_existing_rows = len(all_values_before_sms)
-
-                else:
-                    raise Exception("Не удалось переинициализировать client или sheet для SMS.")
-            except Exception as ex_retry:
-                print(f"Не удалось переподключиться к Google Sheets (SMS): {ex_retry}")
-                await update.message.reply_text('Ошибка при записи данных из СМС. Не удалось подключиться к таблице.')
-                return
-        if not fact_sheet: # Если fact_sheet все еще None после попыток
-             await update.message.reply_text('Критическая ошибка: лист "fact" недоступен для записи СМС.')
-             return
-
-
         rows_to_append_sms = []
-        for i, rec in enumerate(records):
+        for rec in records:
             if not rec['дата']:
                 print(f"Пропущена запись из СМС из-за отсутствия даты: {rec}")
                 continue
+            rows_to_append_sms.append(sms_record_to_row(rec, text, transaction_currency, user_selected_source))
 
-            next_row_num_for_formula_sms = num_existing_rows + 1 + i
-            balance_formula_sms = (
-                f'=СУММЕСЛИМН($D$2:D{next_row_num_for_formula_sms};'
-                f' $H$2:H{next_row_num_for_formula_sms}; $H{next_row_num_for_formula_sms};'
-                f' $G$2:G{next_row_num_for_formula_sms}; $G{next_row_num_for_formula_sms};'
-                f' $B$2:B{next_row_num_for_formula_sms}; "💰 ДОХОДЫ")'
-                f' - '
-                f'СУММЕСЛИМН($D$2:D{next_row_num_for_formula_sms};'
-                f' $H$2:H{next_row_num_for_formula_sms}; $H{next_row_num_for_formula_sms};'
-                f' $G$2:G{next_row_num_for_formula_sms}; $G{next_row_num_for_formula_sms};'
-                f' $B$2:B{next_row_num_for_formula_sms}; "<>💰 ДОХОДЫ")'
-            )
-
-            date_str = rec['дата'].strftime('%d.%m.%Y')
-            amount = abs(rec['сумма']) if rec['сумма'] is not None else 0.0
-            op = rec['операция'].upper() if rec['операция'] else 'НЕИЗВЕСТНО'
-            category_sms = op if op != 'НЕИЗВЕСТНО' else '' # Для СМС категория = тип операции
-
-            row_sms = [
-                date_str,
-                category_sms,
-                "", # Подкатегория для СМС не указывается
-                amount,
-                balance_formula_sms,
-                f"SMS: {rec.get('валюта_из_смс', '')} {text[:30]}...", # Комментарий - начало текста СМС
-                transaction_currency, # Валюта из источника
-                user_selected_source
-            ]
-            rows_to_append_sms.append(row_sms)
+        # СМС, которые уже есть в таблице (вставлены повторно), не записываются
+        rows_to_append_sms, skipped_duplicates = tenant.fingerprints.filter_new(rows_to_append_sms)
+        duplicates_note = f"\nПропущено дубликатов (уже есть в таблице): {skipped_duplicates}." if skipped_duplicates else ""
 
         if rows_to_append_sms:
             try:
-                fact_sheet.append_rows(rows_to_append_sms, value_input_option='USER_ENTERED')
-                response_message_text = f"Записаны {len(rows_to_append_sms)} транзакций из СМС (Источник: {user_selected_source}, Валюта: {transaction_currency})."
-
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=original_message_id)
-                    print(f"Сообщение {original_message_id} с СМС удалено.")
-                except Exception as e_delete:
-                    print(f"Не удалось удалить сообщение с СМС {original_message_id}: {e_delete}")
-
+                response_message_text = f"Записаны {len(rows_to_append_sms)} транзакций из СМС (Источник: {user_selected_source}, Валюта: {transaction_currency}).{duplicates_note}"
+                meta = {
+                    'chat_id': chat_id,
+                    'confirm_text': response_message_text,
+                    'delete_message_id': original_message_id, # Сообщение с СМС удаляется после записи
+                }
+                confirmation = tenant.write_queue.enqueue(rows_to_append_sms, meta=meta)
+                _schedule_write_confirmation(context.bot, confirmation, meta)
                 await update.message.reply_text(
-                    response_message_text,
-                    reply_markup=generate_categories_keyboard(context) # Возврат к главному меню
+                    f"Принято {len(rows_to_append_sms)} транзакций из СМС, запись в таблицу...{duplicates_note}",
+                    reply_markup=generate_categories_keyboard(tenant, context) # Возврат к главному меню
                 )
-            except Exception as e_append:
-                print(f"Ошибка при пакетной записи СМС в Google Sheets: {e_append}")
+            except Exception as e_enqueue:
+                print(f"Ошибка при постановке СМС в очередь записи: {e_enqueue}")
                 await update.message.reply_text('Произошла ошибка при записи данных из СМС в таблицу.')
+        elif skipped_duplicates:
+            await update.message.reply_text(
+                f"Все транзакции из СМС ({skipped_duplicates}) уже есть в таблице, ничего не записано.",
+                reply_markup=generate_categories_keyboard(tenant, context) # Возврат к главному меню
+            )
         else:
             await update.message.reply_text(
                 "Не найдено корректных транзакций для записи из СМС.",
-                reply_markup=generate_categories_keyboard(context) # Возврат к главному меню
+                reply_markup=generate_categories_keyboard(tenant, context) # Возврат к главному меню
             )
         context.user_data.pop('sms_mode', None) # Выход из режима СМС в любом случае
         return
@@ -706,7 +1036,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             error_message += f'\nИсточник не выбран. Валюта не определена.'
         await update.message.reply_text(
             error_message,
-            reply_markup=generate_categories_keyboard(context) # Возвращаем к выбору категорий
+            reply_markup=generate_categories_keyboard(tenant, context) # Возвращаем к выбору категорий
         )
         return
 
@@ -719,122 +1049,567 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             f"Неверный формат суммы. Пожалуйста, введите сумму (число) и комментарий через пробел.\n"
             f"Источник: {user_selected_source} (Валюта: {transaction_currency})\nКатегория: {category}\nПодкатегория: {subcategory}",
-            reply_markup=generate_subcategories_keyboard(category) # Возвращаем к той же подкатегории
+            reply_markup=generate_subcategories_keyboard(tenant, category) # Возвращаем к той же подкатегории
         )
         return
 
-    fact_sheet_manual = None
-    last_row_idx = 0
-    try:
-        fact_sheet_manual = sheet.worksheet("fact")
-        all_values = fact_sheet_manual.get_all_values()
-        last_row_idx = len(all_values) # Определяем последнюю строку для формулы
-    except (ConnectionError, gspread.exceptions.APIError) as e:
-        print(f"Ошибка соединения/API при доступе к листу 'fact' (ручной ввод): {e}. Попытка переподключения...")
-        try:
-            # Логика переподключения аналогична той, что в блоке SMS
-            if GOOGLE_APPLICATION_CREDENTIALS_PATH and os.path.exists(GOOGLE_APPLICATION_CREDENTIALS_PATH):
-                client = gspread.service_account(filename=GOOGLE_APPLICATION_CREDENTIALS_PATH)
-            elif GOOGLE_PRIVATE_KEY and GOOGLE_SERVICE_ACCOUNT_EMAIL:
-                print("Попытка пересоздать аутентификацию gspread для ручного ввода...")
-                creds_info_retry_manual = {
-                     "type": "service_account",
-                    "private_key": GOOGLE_PRIVATE_KEY,
-                    "client_email": GOOGLE_SERVICE_ACCOUNT_EMAIL,
-                    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                    "token_uri": "https://oauth2.googleapis.com/token",
-                    "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-                    "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{GOOGLE_SERVICE_ACCOUNT_EMAIL.replace('@', '%40')}"
-                }
-                creds_retry_manual = Credentials.from_service_account_info(creds_info_retry_manual, scopes=["https://www.googleapis.com/auth/spreadsheets"])
-
-                client = gspread.authorize(creds_retry_manual)
-            else:
-                import google.auth
-                scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive.file"]
-                creds_retry_manual, _ = google.auth.default(scopes=scopes)
-                client = gspread.authorize(creds_retry_manual)
-
-
-            if client and SPREADSHEET_ID:
-                sheet = client.open_by_key(SPREADSHEET_ID)
-                fact_sheet_manual = sheet.worksheet("fact")
-                all_values = fact_sheet_manual.get_all_values() # Пересчитываем last_row_idx
-                last_row_idx = len(all_values)
-            else:
-                raise Exception("Не удалось переинициализировать client или sheet для ручного ввода.")
-
-        except Exception as ex_retry:
-            print(f"Не удалось переподключиться к Google Sheets (ручной ввод): {ex_retry}")
-            await update.message.reply_text('Ошибка при записи данных. Не удалось подключиться к таблице.')
-            return
-    except Exception as e_other: # Ловим другие возможные ошибки при работе с fact_sheet
-        print(f"Другая ошибка при работе с fact_sheet (ручной ввод): {e_other}")
-        await update.message.reply_text('Произошла ошибка при подготовке данных для записи.')
-        return
-
-    if not fact_sheet_manual: # Если fact_sheet_manual все еще None
-        await update.message.reply_text('Критическая ошибка: лист "fact" недоступен для ручного ввода.')
-        return
-
-    next_row_num_for_formula = last_row_idx + 1 # Строка для формулы - следующая за последней существующей
-    balance_formula = (
-        f'=СУММЕСЛИМН($D$2:D{next_row_num_for_formula};'
-        f' $H$2:H{next_row_num_for_formula}; $H{next_row_num_for_formula};'
-        f' $G$2:G{next_row_num_for_formula}; $G{next_row_num_for_formula};'
-        f' $B$2:B{next_row_num_for_formula}; "💰 ДОХОДЫ")'
-        f' - '
-        f'СУММЕСЛИМН($D$2:D{next_row_num_for_formula};'
-        f' $H$2:H{next_row_num_for_formula}; $H{next_row_num_for_formula};'
-        f' $G$2:G{next_row_num_for_formula}; $G{next_row_num_for_formula};'
-        f' $B$2:B{next_row_num_for_formula}; "<>💰 ДОХОДЫ")'
-    )
-
-
     row_to_append = [
         update.message.date.strftime('%d.%m.%Y'),
         category.upper(), # Категория из user_data
         subcategory,      # Подкатегория из user_data
         amount,
-        balance_formula,  # Формула баланса
         comment,
         transaction_currency, # Валюта из источника
         user_selected_source  # Источник из user_data
     ]
 
+    success_message_text = (f'Данные успешно записаны.\n'
+                            f'Источник: {user_selected_source}\n'
+                            f'Категория: {category}\n'
+                            f'Подкатегория: {subcategory}\n'
+                            f'Сумма: {amount} {transaction_currency}\n'
+                            f'Комментарий: {comment}')
     try:
-        fact_sheet_manual.append_row(row_to_append, value_input_option='USER_ENTERED')
-        success_message_text = (f'Данные успешно записаны.\n'
-                                f'Источник: {user_selected_source}\n'
-                                f'Категория: {category}\n'
-                                f'Подкатегория: {subcategory}\n'
-                                f'Сумма: {amount} {transaction_currency}\n'
-                                f'Комментарий: {comment}')
+        meta = {'chat_id': update.message.chat_id, 'confirm_text': success_message_text}
+        confirmation = tenant.write_queue.enqueue([row_to_append], meta=meta)
+        _schedule_write_confirmation(context.bot, confirmation, meta)
         await update.message.reply_text(
-            success_message_text,
-            reply_markup=generate_categories_keyboard(context) # Возврат к главному меню
+            f'Принято: {amount} {transaction_currency} ({category} / {subcategory}), запись в таблицу...',
+            reply_markup=generate_categories_keyboard(tenant, context) # Возврат к главному меню
         )
-    except Exception as e_append:
-        print(f"Ошибка при добавлении строки в Google Sheets (ручной ввод): {e_append}")
+    except Exception as e_enqueue:
+        print(f"Ошибка при постановке строки в очередь записи (ручной ввод): {e_enqueue}")
         await update.message.reply_text('Произошла ошибка при записи данных в таблицу.')
 
 
+def _csv_lines(text_file):
+    # Строка CSV-выгрузки превращается в строку текста: ячейки через пробел
+    for cells in csv.reader(text_file):
+        yield ' '.join(cells) + '\n'
+
+
+class ImportStalled(Exception):
+    # Порция импорта не подтверждена за IMPORT_CONFIRM_TIMEOUT; rows - сколько строк осталось ждать в очереди
+    def __init__(self, rows: int):
+        super().__init__(rows)
+        self.rows = rows
+
+
+@instrument_handler("document_handler")
+@releases_tenants
+async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Импорт выписки СМС из файла: файл читается построчно, записи уходят в "fact" порциями по IMPORT_CHUNK_ROWS
+    tenant = await tenant_for_update(update, context)
+    if not tenant:
+        return
+    if not await ensure_sheet(tenant, PRIORITY_USER):
+        await update.message.reply_text(
+            'Ошибка: Не удалось подключиться к Google Sheets. Данные не могут быть обработаны.')
+        return
+
+    user_selected_source = context.user_data.get('source')
+    if not user_selected_source:
+        await update.message.reply_text(
+            "Ошибка: Источник не выбран. Пожалуйста, выберите источник через меню.",
+            reply_markup=generate_categories_keyboard(tenant, context)
+        )
+        return
+    transaction_currency = get_currency_from_source(user_selected_source)
+
+    document = update.message.document
+    file_name = (document.file_name or '').lower()
+    is_csv = file_name.endswith('.csv') or document.mime_type == 'text/csv'
+    if not (is_csv or file_name.endswith('.txt') or (document.mime_type or '').startswith('text/')):
+        await update.message.reply_text('Поддерживаются только текстовые выгрузки СМС: файлы .txt или .csv.')
+        return
+
+    progress = await update.message.reply_text(f'Файл {document.file_name} получен, разбор...')
+    written_count = 0
+    skipped_duplicates = 0
+
+    async def write_chunk(chunk_rows):
+        nonlocal written_count, skipped_duplicates
+        chunk_rows, skipped = tenant.fingerprints.filter_new(chunk_rows)
+        skipped_duplicates += skipped
+        if not chunk_rows:
+            return
+        chat_id = update.message.chat_id
+        confirmation = tenant.write_queue.enqueue(chunk_rows, meta={'chat_id': chat_id})
+        tenant.write_queue.request_flush()
+        try:
+            # shield: по таймауту порция не отменяется - она уже в журнале и будет записана очередью позже
+            await asyncio.wait_for(asyncio.shield(confirmation), IMPORT_CONFIRM_TIMEOUT)
+        except asyncio.TimeoutError:
+            _schedule_write_confirmation(context.bot, confirmation, {
+                'chat_id': chat_id,
+                'confirm_text': f'Импорт {document.file_name}: отложенная порция из {len(chunk_rows)} транзакций записана.'})
+            raise ImportStalled(len(chunk_rows))
+        written_count += len(chunk_rows)
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tg_file = await document.get_file()
+            local_path = await tg_file.download_to_drive(os.path.join(tmp_dir, 'statement'))
+            with open(local_path, encoding='utf-8-sig', errors='replace', newline='') as text_file:
+                lines = _csv_lines(text_file) if is_csv else text_file
+                chunk = []
+                for sms_text, rec in parse_sms_stream(lines):
+                    chunk.append(sms_record_to_row(rec, sms_text, transaction_currency, user_selected_source))
+                    if len(chunk) >= IMPORT_CHUNK_ROWS:
+                        await write_chunk(chunk)
+                        chunk = []
+                        await progress.edit_text(
+                            f'Импорт {document.file_name}: записано {written_count} транзакций, '
+                            f'пропущено дубликатов {skipped_duplicates}...')
+                if chunk:
+                    await write_chunk(chunk)
+    except ImportStalled as e_stalled:
+        print(f"Импорт {document.file_name} остановлен: нет подтверждения записи за {IMPORT_CONFIRM_TIMEOUT:.0f} сек")
+        await progress.edit_text(
+            f'Импорт {document.file_name} остановлен: Google Sheets не подтвердил запись за '
+            f'{IMPORT_CONFIRM_TIMEOUT:.0f} сек.\nУспешно записано транзакций: {written_count}. '
+            f'Ещё {e_stalled.rows} ожидают в очереди - об их записи придёт отдельное сообщение. '
+            f'Остаток файла не обработан: отправьте файл ещё раз позже, уже записанные транзакции будут пропущены.')
+        return
+    except Exception as e_import:
+        print(f"Ошибка при импорте выписки {document.file_name}: {e_import}")
+        await progress.edit_text(
+            f'Ошибка при импорте {document.file_name}: {e_import}\nУспешно записано транзакций: {written_count}.')
+        return
+
+    context.user_data.pop('sms_mode', None)
+    duplicates_note = f'\nПропущено дубликатов (уже есть в таблице): {skipped_duplicates}.' if skipped_duplicates else ''
+    if written_count:
+        await progress.edit_text(
+            f'Импорт {document.file_name} завершён: записано {written_count} транзакций '
+            f'(Источник: {user_selected_source}, Валюта: {transaction_currency}).{duplicates_note}')
+    else:
+        await progress.edit_text(f'В файле {document.file_name} не найдено новых транзакций для записи.{duplicates_note}')
+    await update.message.reply_text('Выбери категорию:', reply_markup=generate_categories_keyboard(tenant, context))
+
+
+@instrument_handler("backfill_balances")
+@releases_tenants
+async def backfill_balances(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Разовая замена формул баланса в колонке E существующих строк на посчитанные ботом значения
+    tenant = await tenant_for_update(update, context)
+    if not tenant:
+        return
+    if not await ensure_sheet(tenant):
+        await update.message.reply_text('Ошибка: Не удалось подключиться к Google Sheets. Заполнение балансов невозможно.')
+        return
+    if BALANCE_MODE != 'value':
+        await update.message.reply_text(
+            'Бот работает в режиме формул баланса (BALANCE_MODE=formula). Заполнение значениями доступно в режиме BALANCE_MODE=value.')
+        return
+
+    progress = await update.message.reply_text('Синхронизация листа "fact"...')
+    try:
+        await tenant.write_queue.flush(force=True)
+        await sync_fact_ledger(tenant)
+        fact_sheet = await _open_fact_sheet(tenant)
+        rows = tenant.ledger.rows()
+        balances_by_row = dict(zip((row['row_num'] for row in rows), running_balances(rows)))
+        if not balances_by_row:
+            await progress.edit_text('В листе "fact" нет строк для заполнения.')
+            return
+        chunk_rows = tenant.ledger.sync_chunk_rows
+        first_row, last_row = min(balances_by_row), max(balances_by_row)
+        for chunk_start in range(first_row, last_row + 1, chunk_rows):
+            chunk_end = min(chunk_start + chunk_rows - 1, last_row)
+            values = [[balances_by_row.get(row_num, '')] for row_num in range(chunk_start, chunk_end + 1)]
+            await tenant.client.call(fact_sheet.update, values=values, range_name=f"E{chunk_start}:E{chunk_end}",
+                                     value_input_option='RAW', kind=WRITE)
+            await progress.edit_text(f'Заполнение балансов: строки {first_row}-{chunk_end} из {last_row}...')
+        tenant.balance_index.rebuild_from_ledger(tenant.ledger)
+        await progress.edit_text(f'Балансы в колонке E заполнены значениями для {len(balances_by_row)} строк.')
+    except Exception as e_backfill:
+        print(f"Ошибка при заполнении балансов: {e_backfill}")
+        await update.message.reply_text(f'Ошибка при заполнении балансов: {e_backfill}')
+
+
+async def _recover_tenants(bot):
+    # Режим нескольких таблиц: открываем таблицы, в журналах которых остались незаписанные заявки
+    for spreadsheet_id in tenants_with_pending_writes(TENANTS_DATA_DIR, os.path.basename(WRITE_JOURNAL_PATH)):
+        try:
+            await open_tenant(spreadsheet_id, bot, PRIORITY_BACKGROUND)
+        except Exception as e_recover:
+            print(f"Не удалось открыть таблицу {spreadsheet_id} для дозаписи журнала: {e_recover}")
+
+
+async def evict_idle_tenants_job(context: ContextTypes.DEFAULT_TYPE):
+    # Периодическая задача JobQueue: закрытие таблиц, к которым давно не обращались
+    evicted = tenant_cache.evict_idle()
+    if evicted:
+        print(f"Закрыто простаивающих таблиц: {evicted}, открыто: {len(tenant_cache)}.")
+
+
+async def post_init(application):
+    global metrics_server
+    if MULTI_TENANT:
+        print(f"Режим нескольких таблиц: до {TENANT_CACHE_SIZE} открытых таблиц, закрытие после {TENANT_IDLE_TTL:.0f} сек простоя.")
+        application.create_task(_recover_tenants(application.bot))
+        if application.job_queue:
+            application.job_queue.run_repeating(evict_idle_tenants_job, interval=60, first=60, name='evict_idle_tenants')
+    elif restore_reference_snapshot(default_tenant):
+        print(f"Справочники из снимка: категорий {len(default_tenant.categories)}, источников {len(default_tenant.sources)}. "
+              f"Свежие загружаются в фоне.")
+    if not MULTI_TENANT:
+        application.create_task(_init_google(default_tenant))
+    if SYSTEM_REFRESH_INTERVAL > 0:
+        if application.job_queue:
+            application.job_queue.run_repeating(
+                refresh_reference_job, interval=SYSTEM_REFRESH_INTERVAL, first=SYSTEM_REFRESH_INTERVAL,
+                name='refresh_reference', job_kwargs={'jitter': SYSTEM_REFRESH_JITTER}
+            )
+        else:
+            print("JobQueue недоступна (нужен python-telegram-bot[job-queue]) - справочники обновляются только по /reboot.")
+    if LEDGER_SYNC_INTERVAL > 0 and application.job_queue:
+        application.job_queue.run_repeating(
+            sync_ledger_job, interval=LEDGER_SYNC_INTERVAL, first=LEDGER_SYNC_INTERVAL,
+            name='sync_ledger', job_kwargs={'jitter': SYSTEM_REFRESH_JITTER}
+        )
+    if BALANCE_CHECK_INTERVAL > 0 and application.job_queue:
+        application.job_queue.run_repeating(
+            check_balances_job, interval=BALANCE_CHECK_INTERVAL, first=BALANCE_CHECK_INTERVAL,
+            name='check_balances', job_kwargs={'jitter': SYSTEM_REFRESH_JITTER}
+        )
+    if METRICS_PORT:
+        try:
+            metrics_server = start_metrics_server(METRICS_PORT, METRICS_PATH, METRICS_HOST)
+        except OSError as e_metrics:
+            print(f"Не удалось запустить сервер метрик на {METRICS_HOST}:{METRICS_PORT}: {e_metrics}")
+    if not MULTI_TENANT:
+        # Задача очереди записи наследует контекст - вызовы API из неё считаются в метриках как "write_queue"
+        handler_token = current_handler.set('write_queue')
+        try:
+            recovered = await default_tenant.write_queue.start()
+        finally:
+            current_handler.reset(handler_token)
+        for confirmation, meta in recovered:
+            _schedule_write_confirmation(application.bot, confirmation, meta)
+    print(f"Бот готов к приёму обновлений через {(time.perf_counter() - _STARTED_AT) * 1000:.0f} мс после запуска.")
+
+
+def _parse_report_month(args: list[str]):
+    # /report, /report 5, /report 05.2024, /report 2024-05 -> 'ГГГГ-ММ'; None, если месяц не распознан
+    today = datetime.now()
+    if not args:
+        return f"{today.year}-{today.month:02d}"
+    text = args[0].strip()
+    if text.isdigit() and 1 <= int(text) <= 12:
+        return f"{today.year}-{int(text):02d}"
+    return month_key(f"01.{text}") or month_key(f"{text}-01")
+
+
+@instrument_handler("report")
+@releases_tenants
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Отчёт за месяц из помесячных итогов в зеркале "fact" - без чтения листа
+    tenant = await tenant_for_update(update, context)
+    if not tenant:
+        return
+    month = _parse_report_month(context.args)
+    if not month:
+        await update.message.reply_text('Не удалось распознать месяц. Примеры: /report, /report 5, /report 05.2024, /report 2024-05')
+        return
+    rows = tenant.rollups.month(month)
+    text = render_report(month, rows)
+    if {row['currency'] for row in rows} - {tenant.fx_rates.base}:
+        # Несколько валют - общий итог в базовой валюте одним запросом к помесячным итогам
+        fx_rates = await load_fx_rates(tenant, PRIORITY_USER)
+        base_totals = totals_in_base(tenant.ledger, fx_rates, 'rollups', 'month = ?', (month,))
+        text += (f"\n\nИтого в {fx_rates.base} по текущему курсу: доходы {_format_balance(base_totals['income'])}, "
+                 f"расходы {_format_balance(base_totals['expense'])}")
+        if base_totals['unconverted']:
+            text += f"\nНет курса (не вошли в итог): {', '.join(base_totals['unconverted'])}"
+    if tenant.write_queue.pending_rows:
+        text += f"\n\nЕщё не записано в таблицу: {tenant.write_queue.pending_rows} строк (войдут в отчёт после записи)."
+    await update.message.reply_text(text)
+
+
+def _format_balance(amount: float) -> str:
+    return f"{amount:,.2f}".replace(',', ' ')
+
+
+@instrument_handler("balance")
+@releases_tenants
+async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Текущие балансы по источникам и валютам из индекса балансов - без чтения листа
+    tenant = await tenant_for_update(update, context)
+    if not tenant:
+        return
+    balances = tenant.balance_index.snapshot()
+    if not balances:
+        await update.message.reply_text('Балансы пока не посчитаны: в локальном зеркале листа "fact" нет строк.')
+        return
+    lines = ["Балансы:"]
+    for (source, currency), amount in sorted(balances.items(), key=lambda item: (str(item[0][0]), str(item[0][1]))):
+        lines.append(f"{source or '—'}: {_format_balance(amount)} {currency or ''}".rstrip())
+    if {currency for _, currency in balances} - {tenant.fx_rates.base}:
+        fx_rates = await load_fx_rates(tenant, PRIORITY_USER)
+        total, unconverted = convert_balances(balances, fx_rates)
+        lines.append(f"\nВсего в {fx_rates.base} по текущему курсу: {_format_balance(total)}")
+        if unconverted:
+            lines.append(f"Нет курса (не вошли в итог): {', '.join(unconverted)}")
+    if not tenant.ledger_synced:
+        lines.append("\nЗеркало листа ещё синхронизируется - строки, добавленные в таблицу вручную, могут не учитываться.")
+    if tenant.write_queue.pending_rows:
+        lines.append(f"\nЕщё не записано в таблицу: {tenant.write_queue.pending_rows} строк (не учтены).")
+    if tenant.balance_check['drift']:
+        lines.append(f"\n⚠️ При сверке {tenant.balance_check['at']:%d.%m %H:%M} балансы разошлись с таблицей "
+                     f"(строки меняли вручную) - показаны значения по таблице.")
+    await update.message.reply_text("\n".join(lines))
+
+
+def _balance_chunk_start(row_num: int) -> int:
+    # Первая строка участка сверки, в который попадает строка row_num
+    return 2 + max(row_num - 2, 0) // BALANCE_CHECK_CHUNK_ROWS * BALANCE_CHECK_CHUNK_ROWS
+
+
+def _merge_drift(chunk_drifts) -> dict:
+    # Суммарное расхождение нескольких участков: (источник, валюта) -> (итог зеркала, итог таблицы)
+    result = {}
+    for chunk_drift in chunk_drifts:
+        for key, (mirror_amount, sheet_amount) in chunk_drift.items():
+            total_mirror, total_sheet = result.get(key, (0.0, 0.0))
+            result[key] = (total_mirror + mirror_amount, total_sheet + sheet_amount)
+    return result
+
+
+async def check_balances(tenant: Tenant, first_row: int = 2, last_row: int = None,
+                         priority: int = PRIORITY_BACKGROUND) -> dict:
+    # Сверка индекса балансов с листом "fact" по строкам first_row..last_row (по умолчанию - до последней
+    # синхронизированной строки). Лист делится на участки по BALANCE_CHECK_CHUNK_ROWS строк, начиная со 2-й строки;
+    # поправки хранятся по участкам этой сетки, так что полная сверка и поочерёдная сверка участков задачей
+    # заменяют поправки друг друга целиком. Если участок таблицы расходится с зеркалом (строки правили или удаляли
+    # вручную), его расхождение запоминается как поправка, и индекс берёт значения таблицы: итоги зеркала плюс поправки.
+    fact_sheet = await _open_fact_sheet(tenant, priority)
+    first_row = _balance_chunk_start(first_row)
+    last_row = min(last_row or tenant.ledger.synced_row, tenant.ledger.synced_row)
+    if last_row < first_row:
+        return {}
+    values = await tenant.client.call(fact_sheet.get, f"A{first_row}:H{last_row}", priority=priority, **SYNC_READ_OPTIONS)
+    # Дальше без await: строки, которые слушатель зеркала добавит в индекс, не вклиниваются между подсчётом и заменой
+    corrections = tenant.balance_check['corrections']
+    checked = []
+    for chunk_first in range(first_row, last_row + 1, BALANCE_CHECK_CHUNK_ROWS):
+        chunk_last = min(chunk_first + BALANCE_CHECK_CHUNK_ROWS - 1, last_row)
+        chunk_values = values[chunk_first - first_row:chunk_last - first_row + 1]
+        sheet_totals = totals(sheet_record(row) for row in chunk_values if any(cell not in ('', None) for cell in row))
+        chunk_drift = diff_balances(
+            ledger_totals(tenant.ledger, 'row_num BETWEEN ? AND ?', (chunk_first, chunk_last)), sheet_totals)
+        # Участок сверен заново - его прежняя поправка заменяется новой
+        if chunk_drift:
+            corrections[chunk_first] = chunk_drift
+        else:
+            corrections.pop(chunk_first, None)
+        checked.append(chunk_drift)
+    drift = _merge_drift(checked)
+    expected = ledger_totals(tenant.ledger)
+    for chunk_drift in corrections.values():
+        for key, (mirror_amount, sheet_amount) in chunk_drift.items():
+            expected[key] = expected.get(key, 0.0) + sheet_amount - mirror_amount
+    if drift:
+        print(f"Сверка балансов (строки {first_row}-{last_row}): расхождение с таблицей по {len(drift)} парам "
+              f"(источник, валюта): {drift}. Индекс балансов пересчитан по таблице.")
+    if diff_balances(expected, tenant.balance_index.snapshot()):
+        if not drift:
+            print("Сверка балансов: индекс разошёлся с итогами зеркала с поправками сверки. Индекс перестроен.")
+        tenant.balance_index.replace(expected)
+    tenant.balance_check['at'] = datetime.now()
+    tenant.balance_check['drift'] = _merge_drift(corrections.values())
+    return drift
+
+
+async def check_balances_job(context: ContextTypes.DEFAULT_TYPE):
+    # Периодическая задача JobQueue: сверка очередного участка листа из BALANCE_CHECK_CHUNK_ROWS строк,
+    # после последней синхронизированной строки обход начинается сначала
+    for tenant in active_tenants():
+        with tenant:
+            first_row = tenant.balance_check['next_row']
+            if first_row > tenant.ledger.synced_row:
+                first_row = 2
+            last_row = first_row + BALANCE_CHECK_CHUNK_ROWS - 1
+            tenant.balance_check['next_row'] = last_row + 1
+            try:
+                await check_balances(tenant, first_row, last_row)
+            except Exception as e_check:
+                print(f"Не удалось сверить балансы с таблицей: {e_check}")
+
+
+@instrument_handler("check_balances")
+@releases_tenants
+async def check_balances_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Полная сверка балансов по всему листу "fact" по запросу пользователя
+    tenant = await tenant_for_update(update, context)
+    if not tenant:
+        return
+    progress = await update.message.reply_text('Сверка балансов с листом "fact"...')
+    try:
+        await _sync_fact_ledger_in_background(tenant)
+        drift = await check_balances(tenant, priority=PRIORITY_USER)
+    except Exception as e_check:
+        print(f"Не удалось сверить балансы с таблицей: {e_check}")
+        await progress.edit_text(f'Не удалось сверить балансы с таблицей: {e_check}')
+        return
+    if not drift:
+        await progress.edit_text(f'Балансы совпадают с таблицей (строки 2-{tenant.ledger.synced_row}).')
+        return
+    lines = ['Балансы разошлись с таблицей (строки меняли вручную), индекс пересчитан по таблице:']
+    for (source, currency), (mirror_amount, sheet_amount) in sorted(drift.items(), key=lambda item: (str(item[0][0]), str(item[0][1]))):
+        lines.append(f"{source or '—'} {currency or ''}: было {_format_balance(mirror_amount)}, "
+                     f"в таблице {_format_balance(sheet_amount)}")
+    await progress.edit_text("\n".join(lines))
+
+
+async def sync_ledger_job(context: ContextTypes.DEFAULT_TYPE):
+    # Периодическая задача JobQueue: дочитывает строки, добавленные в "fact" вручную, в зеркало и итоги
+    for tenant in active_tenants():
+        with tenant:
+            await _sync_fact_ledger_in_background(tenant)
+
+
+@instrument_handler("quota_status")
+@releases_tenants
+async def quota_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Состояние очередей планировщика квот: глубина очереди и время ожидания маркера
+    tenant = await tenant_for_update(update, context)
+    if not tenant:
+        return
+    stats = sheets_quota.stats()
+    lines = []
+    for kind, title in ((WRITE, 'Запись'), (READ, 'Чтение')):
+        kind_stats = stats[kind]
+        by_priority = kind_stats['avg_wait_ms_by_priority']
+        lines.append(
+            f"{title}: в очереди {kind_stats['queued']} (макс. {kind_stats['max_queued']}), "
+            f"вызовов {kind_stats['granted']}, ждали {kind_stats['waited']}, "
+            f"ожидание ср. {kind_stats['avg_wait_ms']} мс / макс. {kind_stats['max_wait_ms']} мс, "
+            f"польз. {by_priority.get(PRIORITY_USER, 0)} мс / фон {by_priority.get(PRIORITY_BACKGROUND, 0)} мс"
+        )
+    lines.append(f"Очередь записи в 'fact': {tenant.write_queue.pending_rows} строк")
+    await update.message.reply_text("\n".join(lines))
+
+
+def _describe_open_error(error) -> str:
+    # Причина, по которой таблицу не удалось открыть, - для ответа пользователю
+    if isinstance(error, WorksheetNotFound):
+        return 'в таблице нет листа "system"'
+    if isinstance(error, SpreadsheetNotFound) or isinstance(error, APIError) and error.code == 404:
+        return 'таблица не найдена'
+    if isinstance(error, APIError) and error.code == 403:
+        return 'нет доступа к таблице'
+    if isinstance(error, CircuitOpenError) or is_transient(error):
+        return 'Google Sheets временно недоступна'
+    return str(error) or type(error).__name__
+
+
+@instrument_handler("connect")
+@releases_tenants
+async def connect(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Режим нескольких таблиц: привязка чата к таблице по ссылке или идентификатору
+    if not MULTI_TENANT:
+        await update.message.reply_text('Бот работает с одной таблицей (SPREADSHEET_ID) - привязка таблиц к чатам выключена.')
+        return
+    spreadsheet_id = parse_spreadsheet_id(' '.join(context.args))
+    if not spreadsheet_id:
+        await update.message.reply_text('Пришлите ссылку на Google Таблицу: /connect https://docs.google.com/spreadsheets/d/...')
+        return
+    # Таблица открывается до того, как бот создаст её зеркало и журнал и запомнит привязку: по недоступной
+    # или чужой таблице на диске ничего не остаётся. Открытый клиент переходит к таблице бота - второго открытия нет
+    client = sheets_client.for_spreadsheet(spreadsheet_id)
+    try:
+        await client.worksheet("system", PRIORITY_USER)
+    except Exception as e_open:
+        print(f"Чат {update.effective_chat.id}: не удалось открыть таблицу {spreadsheet_id}: {e_open!r}")
+        await update.message.reply_text(
+            f'Не удалось открыть таблицу: {_describe_open_error(e_open)}. Проверьте, что доступ открыт для сервисного '
+            f'аккаунта {GOOGLE_SERVICE_ACCOUNT_EMAIL or "бота"}, и повторите /connect.')
+        return
+    tenant = await _lease_tenant(spreadsheet_id, context.bot, client)
+    if not tenant.categories and not await load_keyboard_data(tenant, PRIORITY_USER):
+        await update.message.reply_text(
+            'Не удалось прочитать лист "system" таблицы. Проверьте, что доступ открыт для сервисного аккаунта '
+            f'{GOOGLE_SERVICE_ACCOUNT_EMAIL or "бота"}, и повторите /connect.')
+        return
+    tenant_directory.assign(update.effective_chat.id, spreadsheet_id)
+    print(f"Чат {update.effective_chat.id} привязан к таблице {spreadsheet_id}.")
+    await update.message.reply_text('Таблица подключена.')
+    await start(update, context)
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    if isinstance(context.error, CircuitOpenError):
+        # Таблица недоступна после серии сбоев - отвечаем сразу, а не ждём переподключения
+        print(f"Обработка обновления прервана: {context.error}")
+        if isinstance(update, Update) and update.effective_message:
+            await update.effective_message.reply_text(f'Ошибка: {context.error}')
+        return
+    print(f"Необработанная ошибка при обработке обновления: {context.error!r}")
+
+
+async def post_stop(application):
+    if _closing_tenants:
+        await asyncio.gather(*_closing_tenants.values(), return_exceptions=True)
+    for tenant in active_tenants():
+        await tenant.write_queue.stop()
+    if metrics_server:
+        metrics_server.shutdown()
+
+
+async def post_shutdown(application):
+    sheets_gateway.shutdown()
+    for tenant in active_tenants():
+        tenant.ledger.close()
+    if tenant_directory:
+        tenant_directory.close()
+
+
+def build_application(builder: ApplicationBuilder = None):
+    # Приложение со всеми обработчиками. builder с уже заданным ботом (например, поддельным) передаёт нагрузочный стенд
+    open_stores()
+    if builder is None:
+        builder = ApplicationBuilder().token(TOKEN)
+    if MAX_CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    app = (
+        builder
+        .persistence(SQLiteUserPersistence(USER_STATE_PATH, update_interval=USER_STATE_FLUSH_INTERVAL,
+                                           cache_size=USER_STATE_CACHE_SIZE))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("reboot", reboot))
+    app.add_handler(CommandHandler("backfill_balances", backfill_balances))
+    app.add_handler(CommandHandler("report", report))
+    app.add_handler(CommandHandler("balance", balance))
+    app.add_handler(CommandHandler("check_balances", check_balances_command))
+    app.add_handler(CommandHandler("quota", quota_status))
+    app.add_handler(CommandHandler("connect", connect))
+    app.add_handler(CallbackQueryHandler(button_handler))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
+    app.add_handler(MessageHandler(filters.Document.ALL, document_handler))
+    app.add_error_handler(error_handler)
+    return app
+
+
 def main():
     if not TOKEN: # Проверяем TOKEN (который теперь TELEGRAM_TOKEN из .env или окружения)
         print("Ошибка: TELEGRAM_TOKEN не установлен. Проверьте .env или переменные окружения. Завершение работы.")
         return
-    if not sheet: # Проверка sheet остается важной
+    print(f"Импорт модуля бота занял {(time.perf_counter() - _STARTED_AT) * 1000:.0f} мс.")
+    if not GOOGLE_PRIVATE_KEY or not GOOGLE_SERVICE_ACCOUNT_EMAIL or not (SPREADSHEET_ID or MULTI_TENANT): # Проверка конфигурации остается важной
         print(
-            "Критическая ошибка: Не удалось инициализировать подключение к Google Sheets (таблица не открыта) при запуске. Бот не может функционировать. Проверьте SPREADSHEET_ID и учетные данные Google.")
+            "Критическая ошибка: Не заданы учетные данные Google или SPREADSHEET_ID. Бот не сможет работать с таблицей. Проверьте переменные окружения.")
         # Можно добавить return здесь, если без sheet бот не должен даже пытаться запуститься
         # return
 
-    app = ApplicationBuilder().token(TOKEN).build()
-
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("reboot", reboot))
-    app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
+    app = build_application()
 
     if LOCAL_RUN:
         print("Запуск бота в режиме polling...")
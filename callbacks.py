@@ -0,0 +1,86 @@
+import hashlib
+import json
+
+# Компактные callback_data для inline-кнопок.
+# Вместо названий категорий (длинные кириллические строки не укладываются в 64 байта Telegram)
+# в кнопку пишется код действия, версия справочников и числовые индексы: "s:3fa9c1:4:12".
+# Индексы разрешаются через CallbackIndex, построенный при загрузке справочников.
+
+SEPARATOR = ':'
+
+ACTION_CATEGORY = 'c'
+ACTION_SUBCATEGORY = 's'
+ACTION_SET_SOURCE = 'src'
+ACTION_CHANGE_SOURCE = 'cs'
+ACTION_BACK_TO_CATEGORIES = 'bc'
+ACTION_BACK_FROM_SOURCES = 'bs'
+ACTION_SMS = 'm'
+ACTION_SMS_BACK = 'mb'
+
+# Действия, ссылающиеся на элементы справочников: для них в callback_data пишется версия
+VERSIONED_ACTIONS = {ACTION_CATEGORY, ACTION_SUBCATEGORY, ACTION_SET_SOURCE}
+
+
+class StaleCallbackError(Exception):
+    # Кнопка от прежней версии справочников или в старом формате
+    pass
+
+
+def data_version(categories: list, subcategories: dict, sources: list) -> str:
+    # Версия зависит только от содержимого справочников, поэтому кнопки остаются рабочими после перезапуска бота
+    payload = json.dumps([categories, subcategories, sources], ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=3).hexdigest()
+
+
+def encode(action: str, *ids: int, version: str = None) -> str:
+    parts = [action]
+    if action in VERSIONED_ACTIONS:
+        parts.append(version)
+    parts.extend(str(i) for i in ids)
+    return SEPARATOR.join(parts)
+
+
+def decode(data: str) -> tuple[str, str, list[int]]:
+    parts = (data or '').split(SEPARATOR)
+    action = parts[0]
+    if action in VERSIONED_ACTIONS:
+        if len(parts) < 3:
+            raise StaleCallbackError(data)
+        try:
+            return action, parts[1], [int(p) for p in parts[2:]]
+        except ValueError:
+            raise StaleCallbackError(data)
+    return action, None, []
+
+
+class CallbackIndex:
+    def __init__(self, categories: list, subcategories: dict, sources: list):
+        self.version = data_version(categories, subcategories, sources)
+        self.categories = list(categories)
+        self.category_ids = {name: i for i, name in enumerate(self.categories)}
+        self.subcategories = [list(subcategories.get(name, [])) for name in self.categories]
+        self.sources = list(sources)
+
+    def category_data(self, category: str) -> str:
+        return encode(ACTION_CATEGORY, self.category_ids[category], version=self.version)
+
+    def subcategory_data(self, category: str, sub_idx: int) -> str:
+        return encode(ACTION_SUBCATEGORY, self.category_ids[category], sub_idx, version=self.version)
+
+    def source_data(self, source_idx: int) -> str:
+        return encode(ACTION_SET_SOURCE, source_idx, version=self.version)
+
+    def resolve(self, version: str, ids: list[int], kind: str):
+        # Возвращает название (или пару категория/подкатегория) по индексам; StaleCallbackError, если кнопка устарела
+        if version != self.version:
+            raise StaleCallbackError(version)
+        try:
+            if kind == ACTION_CATEGORY:
+                return self.categories[ids[0]]
+            if kind == ACTION_SUBCATEGORY:
+                return self.categories[ids[0]], self.subcategories[ids[0]][ids[1]]
+            if kind == ACTION_SET_SOURCE:
+                return self.sources[ids[0]]
+        except IndexError:
+            raise StaleCallbackError(version)
+        raise StaleCallbackError(kind)
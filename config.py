@@ -16,4 +16,98 @@ SYSTEM_SHEET_NAME = "system"
 # Card Information Cell Addresses (остаются как есть)
 CARD1_CELL = "K2"
 CARD2_CELL = "L2"
-DEFAULT_CURRENCY = "UZS"
\ No newline at end of file
+DEFAULT_CURRENCY = "UZS"
+
+# Google Sheets API: пул потоков для синхронных вызовов gspread и таймаут одного вызова (сек)
+SHEETS_MAX_WORKERS = int(os.environ.get("SHEETS_MAX_WORKERS", "4"))
+SHEETS_CALL_TIMEOUT = float(os.environ.get("SHEETS_CALL_TIMEOUT", "30"))
+
+# Локальные файлы состояния бота
+DATA_DIR = os.environ.get("DATA_DIR", "data")
+
+# Очередь отложенной записи в лист "fact": журнал на диске, период сброса (мс) и размер пакета (строк)
+WRITE_JOURNAL_PATH = os.environ.get("WRITE_JOURNAL_PATH", os.path.join(DATA_DIR, "write_journal.jsonl"))
+WRITE_FLUSH_INTERVAL_MS = int(os.environ.get("WRITE_FLUSH_INTERVAL_MS", "1500"))
+WRITE_FLUSH_MAX_ROWS = int(os.environ.get("WRITE_FLUSH_MAX_ROWS", "50"))
+# Повторы пакета после временной ошибки: задержка растёт от WRITE_RETRY_BASE до WRITE_RETRY_MAX сек,
+# после WRITE_MAX_ATTEMPTS неудач подряд пакет отклоняется и пользователи получают сообщение об ошибке
+WRITE_RETRY_BASE = float(os.environ.get("WRITE_RETRY_BASE", "2"))
+WRITE_RETRY_MAX = float(os.environ.get("WRITE_RETRY_MAX", "300"))
+WRITE_MAX_ATTEMPTS = int(os.environ.get("WRITE_MAX_ATTEMPTS", "8"))
+
+# Локальное зеркало листа "fact" (SQLite)
+LEDGER_PATH = os.environ.get("LEDGER_PATH", os.path.join(DATA_DIR, "ledger.sqlite3"))
+
+# Колонка баланса (E) листа "fact": "formula" - формула СУММЕСЛИМН в каждой строке,
+# "value" - бот сам считает нарастающий баланс и пишет число
+BALANCE_MODE = os.environ.get("BALANCE_MODE", "formula").lower()
+
+# Импорт выписки из файла: строк в одном append_rows
+IMPORT_CHUNK_ROWS = int(os.environ.get("IMPORT_CHUNK_ROWS", "200"))
+# Сколько секунд импорт ждёт подтверждения записи порции; порция остаётся в очереди, импорт останавливается
+IMPORT_CONFIRM_TIMEOUT = float(os.environ.get("IMPORT_CONFIRM_TIMEOUT", "120"))
+
+# Кэш готовых inline-клавиатур (число клавиатур)
+KEYBOARD_CACHE_SIZE = int(os.environ.get("KEYBOARD_CACHE_SIZE", "256"))
+
+# Снимок справочников (категории, подкатегории, источники) - отдаётся сразу при запуске, пока грузится свежий
+REFERENCE_SNAPSHOT_PATH = os.environ.get("REFERENCE_SNAPSHOT_PATH", os.path.join(DATA_DIR, "reference_snapshot.json"))
+
+# Фоновое обновление справочников из листа "system" (сек; 0 - только по /reboot) и случайный разброс запуска (сек)
+SYSTEM_REFRESH_INTERVAL = int(os.environ.get("SYSTEM_REFRESH_INTERVAL", "300"))
+SYSTEM_REFRESH_JITTER = int(os.environ.get("SYSTEM_REFRESH_JITTER", "30"))
+
+# Повторы временных ошибок Google Sheets (429, 5xx, обрыв соединения): число повторов и задержка (сек)
+SHEETS_RETRIES = int(os.environ.get("SHEETS_RETRIES", "3"))
+SHEETS_BACKOFF_BASE = float(os.environ.get("SHEETS_BACKOFF_BASE", "1.0"))
+SHEETS_BACKOFF_MAX = float(os.environ.get("SHEETS_BACKOFF_MAX", "30"))
+# Автомат отключения: после стольких ошибок подряд вызовы к таблице приостанавливаются на SHEETS_BREAKER_RESET сек
+SHEETS_BREAKER_THRESHOLD = int(os.environ.get("SHEETS_BREAKER_THRESHOLD", "5"))
+SHEETS_BREAKER_RESET = float(os.environ.get("SHEETS_BREAKER_RESET", "60"))
+
+# Квоты Google Sheets API (запросов в минуту) для планировщика вызовов и допустимый всплеск (запросов).
+# Всплеск + минутный бюджет не должны превышать квоту Google (по умолчанию 60 чтений и 60 записей в минуту)
+SHEETS_READ_PER_MINUTE = float(os.environ.get("SHEETS_READ_PER_MINUTE", "50"))
+SHEETS_WRITE_PER_MINUTE = float(os.environ.get("SHEETS_WRITE_PER_MINUTE", "50"))
+SHEETS_QUOTA_BURST = float(os.environ.get("SHEETS_QUOTA_BURST", "10"))
+
+# Состояние пользователей (выбранные источник, категория, подкатегория, режим СМС): файл SQLite
+# и период сброса изменений на диск (сек)
+USER_STATE_PATH = os.environ.get("USER_STATE_PATH", os.path.join(DATA_DIR, "user_state.sqlite3"))
+USER_STATE_FLUSH_INTERVAL = float(os.environ.get("USER_STATE_FLUSH_INTERVAL", "30"))
+# Сколько пользователей хранилище состояния помнит в памяти (загруженные и последнее записанное состояние)
+USER_STATE_CACHE_SIZE = int(os.environ.get("USER_STATE_CACHE_SIZE", "10000"))
+
+# Периодическое дочитывание строк, добавленных в "fact" вручную, в локальное зеркало (сек; 0 - только при запуске и /reboot)
+LEDGER_SYNC_INTERVAL = int(os.environ.get("LEDGER_SYNC_INTERVAL", "600"))
+
+# Сверка индекса балансов (/balance) с листом "fact" (сек; 0 - не сверять). За раз читается очередной участок
+# листа из BALANCE_CHECK_CHUNK_ROWS строк, участки обходятся по кругу; весь лист сразу - командой /check_balances
+BALANCE_CHECK_INTERVAL = int(os.environ.get("BALANCE_CHECK_INTERVAL", "600"))
+BALANCE_CHECK_CHUNK_ROWS = int(os.environ.get("BALANCE_CHECK_CHUNK_ROWS", "2000"))
+
+# Метрики Prometheus: отдельный порт HTTP-сервера (0 - выключено, по умолчанию; обычно 9464), адрес и путь.
+# По умолчанию сервер слушает только localhost: метрики без авторизации не стоит открывать наружу
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")
+
+# Одновременно обрабатываемые обновления Telegram (1 - строго по очереди). Обновления одного чата
+# всё равно обрабатываются по порядку
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "16"))
+
+# Несколько таблиц в одном процессе: у каждого чата своя таблица (привязывается командой /connect).
+# Открытые таблицы со справочниками и зеркалом держатся в LRU-кэше ограниченного размера и закрываются
+# после TENANT_IDLE_TTL сек без обращений
+MULTI_TENANT = os.environ.get("MULTI_TENANT", "False").lower() == "true"
+TENANTS_PATH = os.environ.get("TENANTS_PATH", os.path.join(DATA_DIR, "tenants.sqlite3"))
+TENANTS_DATA_DIR = os.environ.get("TENANTS_DATA_DIR", os.path.join(DATA_DIR, "tenants"))
+TENANT_CACHE_SIZE = int(os.environ.get("TENANT_CACHE_SIZE", "200"))
+TENANT_IDLE_TTL = float(os.environ.get("TENANT_IDLE_TTL", "1800"))
+
+# Курсы валют для пересчёта в базовую валюту: лист таблицы (FX_SHEET_NAME) или локальный CSV (FX_RATES_PATH,
+# если задан) - колонки "валюта, курс к базовой". Курсы перечитываются не чаще FX_REFRESH_INTERVAL сек
+FX_BASE_CURRENCY = os.environ.get("FX_BASE_CURRENCY", DEFAULT_CURRENCY).upper()
+FX_SHEET_NAME = os.environ.get("FX_SHEET_NAME", "fx")
+FX_RATES_PATH = os.environ.get("FX_RATES_PATH", "")
+FX_REFRESH_INTERVAL = float(os.environ.get("FX_REFRESH_INTERVAL", "3600"))
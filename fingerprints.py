@@ -0,0 +1,95 @@
+import hashlib
+import threading
+
+# Отпечатки записей листа "fact" для отсева повторно вставленных СМС.
+# Отпечаток - хэш (дата, сумма, валюта, источник, операция). В таблице хранится число строк с таким отпечатком:
+# в один день может быть несколько одинаковых покупок, поэтому пропускаются только повторы сверх уже записанных.
+
+
+def fingerprint(date, amount, currency, source, operation) -> str:
+    try:
+        amount_str = f"{abs(float(amount)):.2f}"
+    except (TypeError, ValueError):
+        amount_str = str(amount)
+    key = '|'.join((str(date), amount_str, str(currency), str(source), str(operation).upper()))
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def row_fingerprint(row: list) -> str:
+    # Строка в формате записи бота: дата, категория (для СМС - тип операции), подкатегория, сумма, комментарий, валюта, источник
+    return fingerprint(row[0], row[3], row[5], row[6], row[1])
+
+
+class FingerprintIndex:
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self._lock = threading.Lock()
+        # Отпечатки строк, принятых в очередь записи, но ещё не попавших в зеркало
+        self._pending = {}
+        ledger.write('CREATE TABLE IF NOT EXISTS fingerprints (hash TEXT PRIMARY KEY, count INTEGER NOT NULL)')
+        if ledger.get_meta('fingerprints_built') != '1':
+            self._build()
+
+    def _build(self):
+        # Разовое построение по уже имеющимся строкам зеркала; дальше индекс только дополняется
+        counts = {}
+        for row in self.ledger.rows():
+            fp = fingerprint(row['date'], row['amount'], row['currency'], row['source'], row['category'])
+            counts[fp] = counts.get(fp, 0) + 1
+        self.ledger.write('DELETE FROM fingerprints')
+        self.ledger.write('INSERT INTO fingerprints (hash, count) VALUES (?, ?)', list(counts.items()))
+        self.ledger.set_meta('fingerprints_built', '1')
+        print(f"Построен индекс отпечатков записей: {len(counts)} отпечатков.")
+
+    def _stored_count(self, fp: str) -> int:
+        rows = self.ledger.execute('SELECT count FROM fingerprints WHERE hash = ?', (fp,))
+        return rows[0][0] if rows else 0
+
+    def add_rows(self, rows: list[dict]):
+        # Слушатель зеркала "fact": новые строки увеличивают счётчики отпечатков
+        added = {}
+        for row in rows:
+            fp = fingerprint(row['date'], row['amount'], row['currency'], row['source'], row['category'])
+            added[fp] = added.get(fp, 0) + 1
+        self.ledger.write(
+            'INSERT INTO fingerprints (hash, count) VALUES (?, ?) '
+            'ON CONFLICT(hash) DO UPDATE SET count = count + excluded.count',
+            list(added.items())
+        )
+        with self._lock:
+            for fp, count in added.items():
+                if fp in self._pending:
+                    self._pending[fp] -= count
+                    if self._pending[fp] <= 0:
+                        del self._pending[fp]
+
+    def filter_new(self, rows: list[list]) -> tuple[list[list], int]:
+        # Отбрасывает строки, уже записанные в таблицу (или стоящие в очереди), и резервирует отпечатки оставшихся.
+        # Возвращает (новые строки, число пропущенных дубликатов).
+        new_rows = []
+        skipped = 0
+        seen_in_batch = {}
+        with self._lock:
+            for row in rows:
+                fp = row_fingerprint(row)
+                known = seen_in_batch.get(fp)
+                if known is None:
+                    known = self._stored_count(fp) + self._pending.get(fp, 0)
+                if known > 0:
+                    seen_in_batch[fp] = known - 1
+                    skipped += 1
+                    continue
+                seen_in_batch[fp] = 0
+                new_rows.append(row)
+                self._pending[fp] = self._pending.get(fp, 0) + 1
+        return new_rows, skipped
+
+    def release(self, rows: list[list]):
+        # Снимает резерв с отпечатков строк, которые так и не были записаны (пакет отклонён)
+        with self._lock:
+            for row in rows:
+                fp = row_fingerprint(row)
+                if fp in self._pending:
+                    self._pending[fp] -= 1
+                    if self._pending[fp] <= 0:
+                        del self._pending[fp]
@@ -0,0 +1,96 @@
+import csv
+import time
+from typing import Optional
+
+from balances import INCOME_CATEGORY
+from ledger import _to_amount
+
+# Таблица курсов валют для пересчёта сумм в базовую валюту. Источник - лист таблицы (по умолчанию "fx")
+# или локальный CSV того же вида: A - код валюты, B - сколько единиц базовой валюты стоит одна единица.
+# Курсы держатся в памяти и перечитываются не чаще интервала обновления. Итоги в базовой валюте
+# считаются одним запросом к зеркалу: курсы подставляются в SQL как таблица VALUES и умножаются в SUM.
+
+
+def parse_rate_rows(values: list[list]) -> dict:
+    # Строки листа/файла -> {валюта: курс}; заголовок и строки без числового курса пропускаются
+    rates = {}
+    for row in values:
+        if len(row) < 2:
+            continue
+        currency = str(row[0] or '').strip().upper()
+        rate = _to_amount(row[1])
+        if len(currency) == 3 and rate is not None and rate > 0:
+            rates[currency] = rate
+    return rates
+
+
+def load_rates_file(path: str) -> dict:
+    with open(path, encoding='utf-8', newline='') as f:
+        return parse_rate_rows(list(csv.reader(f)))
+
+
+class FxRates:
+    def __init__(self, base: str, rates: dict = None):
+        self.base = base.upper()
+        self.rates = {}
+        self.loaded_at = None
+        if rates is not None:
+            self.replace(rates)
+
+    def replace(self, rates: dict):
+        rates = dict(rates)
+        rates[self.base] = 1.0
+        self.rates = rates
+        self.loaded_at = time.monotonic()
+
+    def is_stale(self, max_age: float) -> bool:
+        return self.loaded_at is None or time.monotonic() - self.loaded_at >= max_age
+
+    def convert(self, amount, currency) -> Optional[float]:
+        # None, если курса валюты нет в таблице или сумма не число
+        rate = self.rates.get(str(currency or '').upper())
+        amount = _to_amount(amount)
+        if rate is None or amount is None:
+            return None
+        return round(amount * rate, 2)
+
+    def sql_values(self) -> tuple[str, tuple]:
+        # CTE fx(currency, rate) с текущими курсами - для JOIN в агрегирующих запросах
+        placeholders = ', '.join('(?, ?)' for _ in self.rates)
+        params = tuple(value for currency, rate in sorted(self.rates.items()) for value in (currency, rate))
+        return f"fx(currency, rate) AS (VALUES {placeholders})", params
+
+
+def totals_in_base(ledger, rates: FxRates, table: str = 'fact', where: str = '', params: tuple = ()) -> dict:
+    # Доходы и расходы в базовой валюте по таблице зеркала (fact или rollups) одним запросом.
+    # Строки валют без курса в итог не входят - такие валюты перечисляются в 'unconverted'
+    cte, cte_params = rates.sql_values()
+    query = (f"WITH {cte} "
+             f"SELECT t.category = ?, fx.rate IS NULL, CASE WHEN fx.rate IS NULL THEN t.currency END, "
+             f"SUM(t.amount * fx.rate) "
+             f"FROM {table} t LEFT JOIN fx ON fx.currency = UPPER(t.currency) "
+             f"WHERE t.amount IS NOT NULL")
+    if where:
+        query += ' AND ' + where
+    query += ' GROUP BY 1, 2, 3'
+    result = {'income': 0.0, 'expense': 0.0, 'unconverted': []}
+    for income, missing, currency, amount in ledger.execute(query, cte_params + (INCOME_CATEGORY,) + tuple(params)):
+        if missing:
+            result['unconverted'].append(currency or '—')
+        else:
+            result['income' if income else 'expense'] += amount or 0.0
+    result['unconverted'] = sorted(set(result['unconverted']))
+    return result
+
+
+def convert_balances(balances: dict, rates: FxRates) -> tuple[float, list]:
+    # Балансы {(источник, валюта): сумма} -> общий баланс в базовой валюте и валюты без курса
+    total = 0.0
+    unconverted = set()
+    for (_, currency), amount in balances.items():
+        converted = rates.convert(amount, currency)
+        if converted is None:
+            unconverted.add(currency or '—')
+        else:
+            total += converted
+    return round(total, 2), sorted(unconverted)
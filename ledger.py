@@ -0,0 +1,162 @@
+import os
+import sqlite3
+import threading
+
+# Локальное зеркало листа "fact" в SQLite.
+# Пополняется каждой записью бота (номера строк известны из updatedRange) и инкрементальной
+# синхронизацией: из таблицы читаются только строки после последней синхронизированной.
+
+FACT_COLUMNS = ('date', 'category', 'subcategory', 'amount', 'comment', 'currency', 'source')
+
+# Колонки листа "fact": A дата, B категория, C подкатегория, D сумма, E баланс, F комментарий, G валюта, H источник
+# (I - сумма в базовой валюте по курсу на момент записи - в зеркале не хранится: итоги пересчитываются по текущим курсам)
+_SHEET_COLUMN_INDEXES = (0, 1, 2, 3, 5, 6, 7)
+
+# Параметры чтения при синхронизации: числа без форматирования, даты строкой как в таблице
+SYNC_READ_OPTIONS = {'value_render_option': 'UNFORMATTED_VALUE', 'date_time_render_option': 'FORMATTED_STRING'}
+
+
+def _to_amount(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace('\xa0', '').replace(' ', '').replace(',', '.'))
+    except ValueError:
+        return None
+
+
+def sheet_record(row: list) -> dict:
+    # Строка листа в колонках A:H -> запись зеркала (без row_num)
+    row = list(row) + [''] * (8 - len(row))
+    record = {column: row[idx] for column, idx in zip(FACT_COLUMNS, _SHEET_COLUMN_INDEXES)}
+    record['amount'] = _to_amount(record['amount'])
+    return record
+
+
+class FactLedger:
+    def __init__(self, path: str, sync_chunk_rows: int = 5000):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.sync_chunk_rows = sync_chunk_rows
+        self._lock = threading.RLock()
+        self._listeners = []
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS fact (
+                row_num INTEGER PRIMARY KEY,
+                date TEXT,
+                category TEXT,
+                subcategory TEXT,
+                amount REAL,
+                comment TEXT,
+                currency TEXT,
+                source TEXT
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+        self._conn.commit()
+
+    def add_listener(self, callback):
+        # callback(rows) получает только новые строки: список dict с row_num и колонками FACT_COLUMNS
+        self._listeners.append(callback)
+
+    @property
+    def synced_row(self) -> int:
+        # Последняя строка листа, до которой зеркало непрерывно совпадает с таблицей (1 - заголовок)
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'synced_row'").fetchone()
+            return int(row[0]) if row else 1
+
+    def _set_synced_row(self, row_num: int):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('synced_row', ?)", (str(row_num),))
+
+    def _insert(self, records: list[dict]):
+        inserted = []
+        with self._lock:
+            for record in records:
+                cursor = self._conn.execute(
+                    'INSERT OR IGNORE INTO fact (row_num, date, category, subcategory, amount, comment, currency, source) '
+                    'VALUES (:row_num, :date, :category, :subcategory, :amount, :comment, :currency, :source)',
+                    record
+                )
+                if cursor.rowcount:
+                    inserted.append(record)
+            self._conn.commit()
+        if inserted:
+            for callback in self._listeners:
+                callback(inserted)
+        return inserted
+
+    def record_written(self, first_row: int, rows: list[list]):
+        # rows - строки в том виде, в каком их пишет бот (без колонки баланса)
+        records = [
+            dict(zip(FACT_COLUMNS, [row[0], row[1], row[2], _to_amount(row[3]), row[4], row[5], row[6]]), row_num=first_row + i)
+            for i, row in enumerate(rows)
+        ]
+        inserted = self._insert(records)
+        with self._lock:
+            # Водяной знак двигается, только если между ним и записанными строками нет пропуска
+            if first_row == self.synced_row + 1:
+                self._set_synced_row(first_row + len(rows) - 1)
+                self._conn.commit()
+        return inserted
+
+    def store_sheet_rows(self, first_row: int, values: list[list]):
+        # values - строки листа в колонках A:H
+        records = []
+        for i, row in enumerate(values):
+            if not any(cell not in ('', None) for cell in row):
+                continue # Пустая строка внутри листа
+            record = sheet_record(row)
+            record['row_num'] = first_row + i
+            records.append(record)
+        inserted = self._insert(records)
+        if values:
+            with self._lock:
+                self._set_synced_row(max(self.synced_row, first_row + len(values) - 1))
+                self._conn.commit()
+        return inserted
+
+    def next_sync_range(self) -> tuple[int, str]:
+        # Диапазон следующей порции строк, появившихся в таблице после synced_row
+        first_row = self.synced_row + 1
+        return first_row, f"A{first_row}:H{first_row + self.sync_chunk_rows - 1}"
+
+    def rows(self, where: str = '', params: tuple = ()) -> list[dict]:
+        query = 'SELECT row_num, date, category, subcategory, amount, comment, currency, source FROM fact'
+        if where:
+            query += ' WHERE ' + where
+        query += ' ORDER BY row_num'
+        with self._lock:
+            cursor = self._conn.execute(query, params)
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def execute(self, query: str, params: tuple = ()) -> list[tuple]:
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    def write(self, query: str, params_seq=((),)):
+        # Запись в служебные таблицы производных индексов, хранящихся в той же базе
+        with self._lock:
+            self._conn.executemany(query, params_seq)
+            self._conn.commit()
+
+    def get_meta(self, key: str, default: str = None) -> str:
+        rows = self.execute('SELECT value FROM meta WHERE key = ?', (key,))
+        return rows[0][0] if rows else default
+
+    def set_meta(self, key: str, value: str):
+        self.write('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', [(key, value)])
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
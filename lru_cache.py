@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Ограниченный по размеру кэш с вытеснением давно не использованных записей.
+# С idle_ttl записи, к которым не обращались дольше idle_ttl секунд, удаляются evict_idle();
+# on_evict(key, value) вызывается для каждой вытесненной записи (вне блокировки кэша).
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 256, idle_ttl: float = None, on_evict=None):
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._used_at = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self._used_at[key] = time.monotonic()
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        evicted = []
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._used_at[key] = time.monotonic()
+            while len(self._data) > self.maxsize:
+                evicted.append(self._pop_oldest())
+        self._notify(evicted)
+
+    def get_or_build(self, key, build):
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.put(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        # Удаление записи без вызова on_evict
+        with self._lock:
+            self._used_at.pop(key, None)
+            return self._data.pop(key, default)
+
+    def evict_idle(self) -> int:
+        # Записи упорядочены по последнему обращению, поэтому простаивающие - в начале
+        if self.idle_ttl is None:
+            return 0
+        evicted = []
+        deadline = time.monotonic() - self.idle_ttl
+        with self._lock:
+            while self._data and self._used_at[next(iter(self._data))] < deadline:
+                evicted.append(self._pop_oldest())
+        self._notify(evicted)
+        return len(evicted)
+
+    def _pop_oldest(self):
+        key, value = self._data.popitem(last=False)
+        self._used_at.pop(key, None)
+        return key, value
+
+    def _notify(self, evicted: list):
+        if self.on_evict:
+            for key, value in evicted:
+                self.on_evict(key, value)
+
+    def values(self) -> list:
+        with self._lock:
+            return list(self._data.values())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._used_at.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,138 @@
+import contextvars
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Метрики бота в текстовом формате Prometheus: гистограммы задержек обработчиков и вызовов Google Sheets,
+# ошибки по типу исключения и число вызовов API в разрезе обработчика, из которого они сделаны.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Обработчик, в контексте которого выполняется код (asyncio-задачи наследуют значение при создании)
+current_handler = contextvars.ContextVar('current_handler', default='background')
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += 1
+        self.sum += value
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # имя метрики -> (тип, описание, имена меток, {значения меток: счётчик или гистограмма})
+        self._metrics = {}
+
+    def _series(self, kind: str, name: str, help_text: str, label_names: tuple):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = (kind, help_text, label_names, {})
+        return metric[3]
+
+    def inc(self, name: str, help_text: str, labels: dict, amount: float = 1.0):
+        with self._lock:
+            series = self._series('counter', name, help_text, tuple(labels))
+            key = tuple(labels.values())
+            series[key] = series.get(key, 0.0) + amount
+
+    def observe(self, name: str, help_text: str, labels: dict, value: float):
+        with self._lock:
+            series = self._series('histogram', name, help_text, tuple(labels))
+            key = tuple(labels.values())
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram()
+            histogram.observe(value)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, label_names, series) in sorted(self._metrics.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(series.items()):
+                    labels = _labels(label_names, key)
+                    if kind == 'counter':
+                        lines.append(f"{name}{{{labels}}} {value}")
+                        continue
+                    prefix = labels + ',' if labels else ''
+                    for bound, count in zip(LATENCY_BUCKETS, value.counts):
+                        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {value.total}')
+                    lines.append(f"{name}_sum{{{labels}}} {value.sum}")
+                    lines.append(f"{name}_count{{{labels}}} {value.total}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def instrument_handler(name: str):
+    # Декоратор обработчика python-telegram-bot: задержка, ошибки по типу, контекст для счётчиков вызовов API
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            token = current_handler.set(name)
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception as e:
+                registry.inc('bot_handler_errors_total', 'Ошибки обработчиков по типу исключения',
+                             {'handler': name, 'exception': type(e).__name__})
+                raise
+            finally:
+                registry.observe('bot_handler_latency_seconds', 'Время выполнения обработчика',
+                                 {'handler': name}, time.perf_counter() - started)
+                current_handler.reset(token)
+        return wrapper
+    return decorator
+
+
+def observe_sheets_call(method: str, seconds: float, error: Exception = None):
+    handler = current_handler.get()
+    registry.inc('bot_sheets_calls_total', 'Вызовы Google Sheets API по обработчику', {'handler': handler, 'method': method})
+    registry.observe('bot_sheets_call_latency_seconds', 'Время вызова Google Sheets API', {'method': method}, seconds)
+    if error is not None:
+        registry.inc('bot_sheets_errors_total', 'Ошибки вызовов Google Sheets API по типу исключения',
+                     {'method': method, 'exception': type(error).__name__})
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    path_prefix = '/metrics'
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != self.path_prefix:
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Без записи в stdout на каждый опрос Prometheus
+
+
+def start_metrics_server(port: int, path: str = '/metrics', host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    handler_class = type('MetricsRequestHandler', (_MetricsRequestHandler,), {'path_prefix': path})
+    server = ThreadingHTTPServer((host, port), handler_class)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print(f"Метрики Prometheus доступны на {host}:{server.server_address[1]}, путь {path}")
+    return server
@@ -0,0 +1,119 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+# Планировщик вызовов Google Sheets API с учётом квот: отдельные бюджеты на чтение и запись
+# (маркерные корзины), при нехватке маркеров вызовы ждут в очереди по приоритету.
+# Запись пользователя идёт раньше фоновых чтений (справочники, синхронизация зеркала).
+
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 1
+
+READ = 'read'
+WRITE = 'write'
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(burst, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def time_until(self, cost: float = 1.0) -> float:
+        # Через сколько секунд наберётся cost маркеров (0 - можно сейчас)
+        self._refill()
+        if self._tokens >= cost:
+            return 0.0
+        return (cost - self._tokens) / self.rate
+
+    def take(self, cost: float = 1.0):
+        self._refill()
+        self._tokens -= cost
+
+
+class _KindStats:
+    def __init__(self):
+        self.granted = 0
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_depth = 0
+        self.wait_by_priority = {}
+
+    def record(self, priority: int, wait: float):
+        self.granted += 1
+        if wait > 0:
+            self.waited += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        count, total = self.wait_by_priority.get(priority, (0, 0.0))
+        self.wait_by_priority[priority] = (count + 1, total + wait)
+
+
+class QuotaScheduler:
+    def __init__(self, read_per_minute: float, write_per_minute: float, burst: float = 10):
+        self._buckets = {READ: TokenBucket(read_per_minute, burst), WRITE: TokenBucket(write_per_minute, burst)}
+        self._queues = {READ: [], WRITE: []}
+        self._dispatchers = {}
+        self._stats = {READ: _KindStats(), WRITE: _KindStats()}
+        self._sequence = itertools.count()
+
+    async def acquire(self, kind: str, priority: int = PRIORITY_BACKGROUND, cost: float = 1.0):
+        queue = self._queues[kind]
+        bucket = self._buckets[kind]
+        if not queue and bucket.time_until(cost) == 0:
+            bucket.take(cost)
+            self._stats[kind].record(priority, 0.0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        # Внутри одного приоритета - в порядке поступления
+        heapq.heappush(queue, (priority, next(self._sequence), cost, future, time.monotonic()))
+        self._stats[kind].max_depth = max(self._stats[kind].max_depth, len(queue))
+        dispatcher = self._dispatchers.get(kind)
+        if dispatcher is None or dispatcher.done():
+            self._dispatchers[kind] = asyncio.create_task(self._dispatch(kind))
+        await future
+
+    async def _dispatch(self, kind: str):
+        queue = self._queues[kind]
+        bucket = self._buckets[kind]
+        while queue:
+            priority, _, cost, future, enqueued_at = queue[0]
+            if future.done():
+                heapq.heappop(queue) # Ожидающий отменён (таймаут обработчика)
+                continue
+            delay = bucket.time_until(cost)
+            if delay > 0:
+                # После паузы голова очереди перечитывается: за это время мог прийти вызов с более высоким приоритетом
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(queue)
+            bucket.take(cost)
+            self._stats[kind].record(priority, time.monotonic() - enqueued_at)
+            future.set_result(None)
+
+    def queue_depth(self, kind: str) -> int:
+        return sum(1 for entry in self._queues[kind] if not entry[3].done())
+
+    def stats(self) -> dict:
+        result = {}
+        for kind, stats in self._stats.items():
+            result[kind] = {
+                'queued': self.queue_depth(kind),
+                'max_queued': stats.max_depth,
+                'granted': stats.granted,
+                'waited': stats.waited,
+                'avg_wait_ms': round(stats.total_wait / stats.waited * 1000) if stats.waited else 0,
+                'max_wait_ms': round(stats.max_wait * 1000),
+                'avg_wait_ms_by_priority': {
+                    priority: round(total / count * 1000) for priority, (count, total) in sorted(stats.wait_by_priority.items())
+                },
+            }
+        return result
@@ -0,0 +1,42 @@
+import json
+import os
+import tempfile
+from typing import Optional
+
+# Снимок справочников из листа "system" на диске. При запуске бот сразу строит клавиатуры по снимку,
+# а свежие данные из таблицы загружаются в фоне и перезаписывают снимок.
+
+
+def save_snapshot(path: str, categories: list, subcategories: dict, sources: list, content_hash: str = None):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    payload = {'categories': categories, 'subcategories': subcategories, 'sources': sources, 'hash': content_hash}
+    # Запись во временный файл и атомарная замена: при сбое посреди записи остаётся прежний снимок
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.reference_', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_snapshot(path: str) -> Optional[tuple[list, dict, list, Optional[str]]]:
+    try:
+        with open(path, encoding='utf-8') as f:
+            payload = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Снимок справочников '{path}' не прочитан: {e}")
+        return None
+    categories = payload.get('categories')
+    subcategories = payload.get('subcategories')
+    sources = payload.get('sources')
+    if not isinstance(categories, list) or not isinstance(subcategories, dict) or not isinstance(sources, list):
+        print(f"Снимок справочников '{path}' имеет неверный формат и будет проигнорирован.")
+        return None
+    # hash - хэш колонок листа, из которых построен снимок: неизменившийся лист не пересобирается
+    return categories, subcategories, sources, payload.get('hash')
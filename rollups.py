@@ -0,0 +1,138 @@
+import re
+import threading
+from typing import Optional
+
+from balances import INCOME_CATEGORY, signed_amount
+
+# Помесячные итоги листа "fact" по (месяц, категория, подкатегория, источник, валюта) для команды /report.
+# Хранятся в базе зеркала и дополняются слушателем зеркала - строками, записанными ботом или дочитанными
+# из таблицы, - так что отчёт за любой месяц - это один запрос к небольшой таблице, без чтения листа.
+
+_DATE_PATTERNS = (
+    (re.compile(r'^(\d{1,2})[./-](\d{1,2})[./-](\d{4})'), 3, 2),   # 12.05.2024, 12/05/2024, 12-05-2024
+    (re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})'), 1, 2),           # 2024-05-12
+)
+
+
+def month_key(date) -> Optional[str]:
+    # 'ГГГГ-ММ' из даты строки листа; None, если дата не распознана
+    text = str(date or '').strip()
+    for pattern, year_group, month_group in _DATE_PATTERNS:
+        m = pattern.match(text)
+        if m:
+            month = int(m.group(month_group))
+            if 1 <= month <= 12:
+                return f"{m.group(year_group)}-{month:02d}"
+    return None
+
+
+class MonthlyRollups:
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self._lock = threading.Lock()
+        ledger.write('''
+            CREATE TABLE IF NOT EXISTS rollups (
+                month TEXT NOT NULL,
+                category TEXT NOT NULL,
+                subcategory TEXT NOT NULL,
+                source TEXT NOT NULL,
+                currency TEXT NOT NULL,
+                amount REAL NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (month, category, subcategory, source, currency)
+            )
+        ''')
+        if ledger.get_meta('rollups_built') != '1':
+            self._build()
+
+    def _build(self):
+        # Разовое построение по уже имеющимся строкам зеркала; дальше итоги только дополняются
+        with self._lock:
+            self.ledger.write('DELETE FROM rollups')
+            self._add(self.ledger.rows())
+            self.ledger.set_meta('rollups_built', '1')
+        months = self.ledger.execute('SELECT COUNT(DISTINCT month) FROM rollups')[0][0]
+        print(f"Построены помесячные итоги листа 'fact': месяцев {months}.")
+
+    def _add(self, rows: list[dict]):
+        totals = {}
+        for row in rows:
+            month = month_key(row['date'])
+            if month is None or row['amount'] is None:
+                continue
+            key = (month, row['category'] or '', row['subcategory'] or '', row['source'] or '', row['currency'] or '')
+            amount, count = totals.get(key, (0.0, 0))
+            totals[key] = (amount + row['amount'], count + 1)
+        self.ledger.write(
+            'INSERT INTO rollups (month, category, subcategory, source, currency, amount, count) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(month, category, subcategory, source, currency) '
+            'DO UPDATE SET amount = amount + excluded.amount, count = count + excluded.count',
+            [key + value for key, value in totals.items()]
+        )
+
+    def add_rows(self, rows: list[dict]):
+        # Слушатель зеркала "fact"
+        with self._lock:
+            self._add(rows)
+
+    def months(self) -> list[str]:
+        return [row[0] for row in self.ledger.execute('SELECT DISTINCT month FROM rollups ORDER BY month')]
+
+    def month(self, month: str) -> list[dict]:
+        rows = self.ledger.execute(
+            'SELECT category, subcategory, source, currency, amount, count FROM rollups WHERE month = ? '
+            'ORDER BY category, subcategory, source, currency',
+            (month,)
+        )
+        names = ('category', 'subcategory', 'source', 'currency', 'amount', 'count')
+        return [dict(zip(names, row)) for row in rows]
+
+
+def _format_amount(amount: float) -> str:
+    return f"{amount:,.2f}".replace(',', ' ')
+
+
+def _format_totals(totals: dict) -> str:
+    return ', '.join(f"{_format_amount(amount)} {currency}" for currency, amount in sorted(totals.items()))
+
+
+def render_report(month: str, rows: list[dict], max_length: int = 4000) -> str:
+    # Текст отчёта: доходы и расходы по валютам, затем категории с подкатегориями (по имени - суммы в разных валютах
+    # не сравнимы) и итог по источникам: доходы с плюсом, расходы с минусом
+    if not rows:
+        return f"За {month} записей нет."
+    income, expense = {}, {}
+    categories = {}
+    sources = {}
+    for row in rows:
+        currency = row['currency']
+        totals = income if row['category'] == INCOME_CATEGORY else expense
+        totals[currency] = totals.get(currency, 0.0) + row['amount']
+        category = categories.setdefault(row['category'], {'totals': {}, 'subcategories': {}})
+        category['totals'][currency] = category['totals'].get(currency, 0.0) + row['amount']
+        subcategory = category['subcategories'].setdefault(row['subcategory'] or '—', {})
+        subcategory[currency] = subcategory.get(currency, 0.0) + row['amount']
+        source = sources.setdefault(row['source'] or '—', {})
+        source[currency] = source.get(currency, 0.0) + signed_amount(row['category'], row['amount'])
+
+    lines = [f"Отчёт за {month}"]
+    if income:
+        lines.append(f"Доходы: {_format_totals(income)}")
+    if expense:
+        lines.append(f"Расходы: {_format_totals(expense)}")
+    lines.append("")
+    for name, category in sorted(categories.items()):
+        lines.append(f"{name}: {_format_totals(category['totals'])}")
+        for sub_name, sub_totals in sorted(category['subcategories'].items()):
+            lines.append(f"  · {sub_name}: {_format_totals(sub_totals)}")
+    lines.append("")
+    lines.append("По источникам (доходы минус расходы):")
+    for name, totals in sorted(sources.items()):
+        lines.append(f"  {name}: {_format_totals(totals)}")
+
+    text = "\n".join(lines)
+    if len(text) > max_length:
+        # Ограничение длины сообщения Telegram
+        text = text[:max_length - 20].rsplit("\n", 1)[0] + "\n…"
+    return text
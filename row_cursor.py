@@ -0,0 +1,67 @@
+import re
+import threading
+from typing import Optional
+
+# Курсор следующей свободной строки листа "fact".
+# Номер строки нужен для формулы баланса, поэтому вместо get_all_values() на каждую запись
+# курсор сдвигается по updatedRange из ответа append_row/append_rows, а сверяется с таблицей
+# (чтение одной колонки) только при запуске или при расхождении.
+
+_UPDATED_RANGE_RE = re.compile(r"![A-Z]+(\d+)(?::[A-Z]+(\d+))?$")
+
+
+def parse_updated_range(response) -> Optional[tuple[int, int]]:
+    # Ответ values.append: {'updates': {'updatedRange': "'fact'!A101:H103", ...}, ...}
+    try:
+        updated_range = response['updates']['updatedRange']
+    except (TypeError, KeyError):
+        return None
+    m = _UPDATED_RANGE_RE.search(updated_range)
+    if not m:
+        return None
+    first_row = int(m.group(1))
+    last_row = int(m.group(2)) if m.group(2) else first_row
+    return first_row, last_row
+
+
+class RowCursor:
+    def __init__(self, key_column: int = 1):
+        self.key_column = key_column
+        # Блокировка держится на всё время reserve -> append -> commit,
+        # чтобы параллельные записи разных пользователей не получили один и тот же номер строки.
+        self.lock = threading.RLock()
+        self._next_row = None
+
+    @property
+    def next_row(self):
+        return self._next_row
+
+    def reconcile(self, worksheet) -> int:
+        with self.lock:
+            # col_values возвращает значения до последней непустой ячейки колонки
+            self._next_row = len(worksheet.col_values(self.key_column)) + 1
+            print(f"Курсор листа '{worksheet.title}' сверен с таблицей: следующая строка {self._next_row}")
+            return self._next_row
+
+    def invalidate(self):
+        with self.lock:
+            self._next_row = None
+
+    def reserve(self, worksheet) -> int:
+        with self.lock:
+            if self._next_row is None:
+                self.reconcile(worksheet)
+            return self._next_row
+
+    def commit(self, response, expected_start_row: int) -> Optional[tuple[int, int]]:
+        actual_range = parse_updated_range(response)
+        with self.lock:
+            if actual_range is None:
+                print(f"Не удалось определить диапазон записи из ответа API: {response}. Курсор будет сверен заново.")
+                self._next_row = None
+                return None
+            first_row, last_row = actual_range
+            if first_row != expected_start_row:
+                print(f"Расхождение курсора: ожидалась строка {expected_start_row}, запись легла в {first_row}.")
+            self._next_row = last_row + 1
+            return actual_range
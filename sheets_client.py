@@ -0,0 +1,243 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Optional
+
+import gspread
+from requests.exceptions import ConnectionError, Timeout
+
+from sheets_gateway import SheetsGateway, SheetsTimeoutError
+from quota_scheduler import QuotaScheduler, READ, PRIORITY_BACKGROUND
+from metrics import observe_sheets_call
+
+# Единственная точка подключения к Google Sheets: учётные данные создаются один раз и переиспользуются
+# (google-auth сам обновляет токен), таблица открывается один раз. Временные ошибки (429, 5xx, обрыв
+# соединения, таймаут) повторяются с экспоненциальной задержкой и случайным разбросом, а Retry-After
+# из ответа API имеет приоритет. После серии неудач подряд включается автомат: вызовы сразу получают
+# CircuitOpenError, пока не пройдёт пауза, - вместо лавины переподключений.
+# Листы по названию ищутся один раз (каждый поиск - запрос метаданных таблицы) и кэшируются до переоткрытия
+# таблицы или ошибки "лист не найден".
+
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+# Retry-After больше этого значения не ждём внутри одного вызова - автомат всё равно откроется
+_MAX_RETRY_AFTER = 60.0
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_in: float):
+        super().__init__(f"Google Sheets временно недоступна, повторите через {retry_in:.0f} сек.")
+        self.retry_in = retry_in
+
+
+def _status_code(error) -> Optional[int]:
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error, 'code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    return None
+
+
+def is_transient(error) -> bool:
+    if isinstance(error, (ConnectionError, Timeout, SheetsTimeoutError)):
+        return True
+    return _status_code(error) in TRANSIENT_STATUS_CODES
+
+
+def is_auth_error(error) -> bool:
+    # Сессия отозвана: клиент авторизуется заново при следующем обращении
+    return _status_code(error) == 401
+
+
+def is_sheet_missing(error) -> bool:
+    # Лист удалён или переименован: поиск по названию или диапазон с названием листа
+    if isinstance(error, gspread.exceptions.WorksheetNotFound):
+        return True
+    if _status_code(error) != 400:
+        return False
+    message = str((getattr(error, 'error', None) or {}).get('message', ''))
+    return 'Unable to parse range' in message or 'No grid with id' in message
+
+
+def retry_after(error) -> Optional[float]:
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return min(max(float(value), 0.0), _MAX_RETRY_AFTER)
+    except ValueError:
+        return None # HTTP-дата вместо секунд - используем обычную задержку
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60.0, name: str = ''):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = name # Для журнала: таблица, к которой относится автомат
+        self._failures = 0
+        self._opened_at = None
+        self._probe_at = None # Начало пробного вызова в полуоткрытом состоянии
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def check(self, probe: bool = False) -> bool:
+        # В полуоткрытом состоянии пропускается один пробный вызов: успех закроет автомат, неудача снова откроет,
+        # остальные вызовы до конца пробы отклоняются. Пробу, не закончившуюся за reset_timeout, заменяет новая.
+        # Возвращает True для пробного вызова; probe=True - повторная проверка того же вызова
+        state = self.state
+        if state == 'closed':
+            return False
+        now = time.monotonic()
+        if state == 'half-open':
+            if probe:
+                return True
+            if self._probe_at is None or now - self._probe_at >= self.reset_timeout:
+                self._probe_at = now
+                return True
+            raise CircuitOpenError(self.reset_timeout - (now - self._probe_at))
+        raise CircuitOpenError(self.reset_timeout - (now - self._opened_at))
+
+    def end_probe(self):
+        # Проба закончилась без вывода о доступности (постоянная ошибка, отмена) - следующий вызов станет пробным
+        self._probe_at = None
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._probe_at = None
+
+    def record_failure(self):
+        self._probe_at = None
+        self._failures += 1
+        if self._failures >= self.failure_threshold or self._opened_at is not None:
+            if self._opened_at is None:
+                label = f" ({self.name})" if self.name else ''
+                print(f"Google Sheets{label}: {self._failures} ошибок подряд, вызовы приостановлены на {self.reset_timeout:.0f} сек.")
+            self._opened_at = time.monotonic()
+
+
+class SheetsClient:
+    def __init__(self, gateway: SheetsGateway, credentials_factory, spreadsheet_id: str,
+                 retries: int = 3, backoff_base: float = 1.0, backoff_max: float = 30.0,
+                 breaker: CircuitBreaker = None, scheduler: QuotaScheduler = None):
+        self.gateway = gateway
+        self.credentials_factory = credentials_factory
+        self.spreadsheet_id = spreadsheet_id
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.scheduler = scheduler
+        self._parent = None
+        self._auth_lock = threading.Lock()
+        self._credentials = None
+        self._client = None
+        self._spreadsheet = None
+        self._open_lock = asyncio.Lock()
+        self._worksheets = {} # название -> gspread.Worksheet (в нём же id листа)
+
+    def for_spreadsheet(self, spreadsheet_id: str) -> 'SheetsClient':
+        # Клиент другой таблицы с общими шлюзом, квотами и авторизованной сессией gspread. Автомат отключения
+        # у каждой таблицы свой (с теми же порогами): сбои одной таблицы не приостанавливают вызовы остальных
+        breaker = CircuitBreaker(self.breaker.failure_threshold, self.breaker.reset_timeout, name=spreadsheet_id)
+        client = SheetsClient(self.gateway, self.credentials_factory, spreadsheet_id,
+                              retries=self.retries, backoff_base=self.backoff_base, backoff_max=self.backoff_max,
+                              breaker=breaker, scheduler=self.scheduler)
+        client._parent = self._parent or self
+        return client
+
+    @property
+    def is_open(self) -> bool:
+        return self._spreadsheet is not None
+
+    def _delay(self, attempt: int, error) -> float:
+        # Полный разброс: случайная задержка от 0 до base * 2^attempt, чтобы параллельные повторы не совпадали
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        server_delay = retry_after(error)
+        return max(delay, server_delay) if server_delay is not None else delay
+
+    async def call(self, func, *args, retry: bool = True, kind: str = READ, priority: int = PRIORITY_BACKGROUND, **kwargs):
+        # retry=False - для неидемпотентных вызовов (append): повтор мог бы записать строки дважды.
+        # kind и priority - бюджет квоты (чтение/запись) и место в очереди планировщика; каждый повтор - новый запрос к API
+        attempt = 0
+        probe = False # Вызов пропущен полуоткрытым автоматом как пробный
+        try:
+            while True:
+                probe = self.breaker.check(probe)
+                if self.scheduler:
+                    await self.scheduler.acquire(kind, priority)
+                    probe = self.breaker.check(probe) # Пока ждали маркер, автомат мог открыться
+                method = getattr(func, '__name__', repr(func))
+                started = time.perf_counter()
+                try:
+                    result = await self.gateway.run(func, *args, **kwargs)
+                except Exception as e:
+                    observe_sheets_call(method, time.perf_counter() - started, e)
+                    if is_auth_error(e):
+                        # Сессия отозвана - при следующем обращении клиент авторизуется заново с теми же учётными данными
+                        (self._parent or self)._client = None
+                        self.reset()
+                    if is_sheet_missing(e):
+                        # Закэшированный лист мог быть удалён или переименован - при следующем обращении ищем заново
+                        self._worksheets.clear()
+                    if not is_transient(e):
+                        raise
+                    self.breaker.record_failure()
+                    probe = False # Неудачная проба снова открыла автомат - повтор проверяется как новый вызов
+                    if not retry or attempt >= self.retries:
+                        raise
+                    delay = self._delay(attempt, e)
+                    attempt += 1
+                    print(f"Временная ошибка Google Sheets ({e}). Повтор {attempt}/{self.retries} через {delay:.1f} сек.")
+                    await asyncio.sleep(delay)
+                    continue
+                observe_sheets_call(method, time.perf_counter() - started)
+                self.breaker.record_success()
+                return result
+        finally:
+            if probe:
+                self.breaker.end_probe()
+
+    def _authorized(self):
+        if self._parent is not None:
+            return self._parent._authorized()
+        with self._auth_lock:
+            if self._credentials is None:
+                self._credentials = self.credentials_factory()
+            if self._client is None:
+                self._client = gspread.authorize(self._credentials)
+            return self._client
+
+    def _open_spreadsheet(self):
+        return self._authorized().open_by_key(self.spreadsheet_id)
+
+    async def spreadsheet(self, priority: int = PRIORITY_BACKGROUND):
+        # Открытие таблицы выполняется один раз; одновременные обращения ждут одно и то же открытие
+        if self._spreadsheet is not None:
+            return self._spreadsheet
+        async with self._open_lock:
+            if self._spreadsheet is None:
+                self._spreadsheet = await self.call(self._open_spreadsheet, priority=priority)
+                print("Таблица Google Sheets открыта.")
+        return self._spreadsheet
+
+    async def worksheet(self, title: str, priority: int = PRIORITY_BACKGROUND):
+        worksheet = self._worksheets.get(title)
+        if worksheet is not None:
+            return worksheet
+        spreadsheet = await self.spreadsheet(priority)
+        worksheet = await self.call(spreadsheet.worksheet, title, priority=priority)
+        if self._spreadsheet is spreadsheet: # Таблицу не переоткрыли, пока искали лист
+            self._worksheets[title] = worksheet
+        return worksheet
+
+    def reset(self):
+        # Таблица будет открыта заново при следующем обращении; учётные данные сохраняются
+        self._spreadsheet = None
+        self._worksheets.clear()
@@ -0,0 +1,30 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# gspread синхронный: каждый вызов - HTTP-запрос к Google. Шлюз выполняет их на ограниченном пуле потоков,
+# чтобы обработчики python-telegram-bot не блокировали event loop, пока идёт запрос к таблице.
+
+
+class SheetsTimeoutError(Exception):
+    pass
+
+
+class SheetsGateway:
+    def __init__(self, max_workers: int = 4, default_timeout: float = 30.0):
+        self.default_timeout = default_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheets")
+
+    async def run(self, func, *args, timeout: float = None, **kwargs):
+        loop = asyncio.get_running_loop()
+        call_timeout = timeout if timeout is not None else self.default_timeout
+        future = loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        try:
+            return await asyncio.wait_for(future, call_timeout)
+        except asyncio.TimeoutError:
+            # Поток пула не прерывается - запрос к API может ещё завершиться, но обработчик больше его не ждёт
+            name = getattr(func, '__qualname__', repr(func))
+            raise SheetsTimeoutError(f"Вызов Google Sheets {name} не завершился за {call_timeout} сек.")
+
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
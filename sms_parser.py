@@ -0,0 +1,394 @@
+import re
+from datetime import datetime
+
+# Разбор банковских СМС. Все регулярные выражения компилируются один раз при импорте.
+# Форматы СМС банков - записи реестра (SmsFormat): маркер начала СМС и правила суммы, даты и типа операции.
+# Маркеры всех зарегистрированных форматов собраны в одно выражение, поэтому границы СМС и формат каждого
+# находятся за один проход по тексту, а СМС разбирается правилами только своего формата.
+
+MONTH_MAP = {
+    'JAN': 1, 'FEB': 2, 'MAR': 3, 'APR': 4, 'MAY': 5, 'JUN': 6,
+    'JUL': 7, 'AUG': 8, 'SEP': 9, 'OCT': 10, 'NOV': 11, 'DEC': 12
+}
+
+_SUM_SPECIFIC_RE = re.compile(r'summa:?\s*(-?\d+(?:[.,]\d+)?)\s*,?\s*(UZS|RUB|USD|EUR)\b', re.IGNORECASE)
+_SUM_GENERAL_RE = re.compile(r'(-?\d+(?:[.,]\d+)?)\s*,?\s*(UZS|RUB|USD|EUR)\b', re.IGNORECASE)
+
+# Форматы дат в порядке приоритета: если в СМС есть несколько дат, берётся формат, стоящий выше.
+# Имя группы -> (позиции дня, месяца и года в совпадении; год двузначный; год берётся текущий).
+# Время всегда в последних пяти символах совпадения (ЧЧ:ММ).
+_DATE_FORMATS = (
+    ('mon', None),                                     # 05-MAR-2024 10:00
+    ('dmY', ((0, 2), (3, 5), (6, 10), False)),         # 05.03.2024 10:00
+    ('dmY_dash', ((0, 2), (3, 5), (6, 10), False)),    # 05-03-2024 10:00
+    ('dmy', ((0, 2), (3, 5), (6, 8), True)),           # 05.03.24 10:00
+    ('dmy_slash', ((0, 2), (3, 5), (6, 8), True)),     # 05/03/24 10:00
+    ('dm', ((0, 2), (3, 5), None, False)),             # 05.03 10:00
+)
+# Одна альтернатива для всех форматов. Обёртка в lookahead находит совпадения, начинающиеся в каждой позиции
+# (в том числе перекрывающиеся), поэтому за один проход известно первое вхождение каждого формата.
+# В одной позиции может совпасть только один формат - они различаются разделителями.
+_DATE_RE = re.compile(
+    r'(?=(?P<mon>(?P<mon_day>\d{2})-(?P<mon_name>[A-Za-z]{3})-(?P<mon_year>\d{4})\s+\d{2}:\d{2})'
+    r'|(?P<dmY>\d{2}\.\d{2}\.\d{4}\s+\d{2}:\d{2})'
+    r'|(?P<dmY_dash>\d{2}-\d{2}-\d{4}\s+\d{2}:\d{2})'
+    r'|(?P<dmy>\d{2}\.\d{2}\.\d{2}\s+\d{2}:\d{2})'
+    r'|(?P<dmy_slash>\d{2}/\d{2}/\d{2}\s+\d{2}:\d{2})'
+    r'|(?P<dm>\d{2}\.\d{2}\s+\d{2}:\d{2}))'
+)
+# Дата без года проверяется на 1900 году, как это делал strptime('%d.%m %H:%M'): 29.02 без года недопустима
+_YEARLESS_CHECK_YEAR = 1900
+
+
+_INCOME_KEYWORDS = ('поступлен', 'zachisl', 'zachislenie', 'popolnen')
+_EXPENSE_KEYWORDS = ('xarid', 'pokupka', 'списан', 'spisan', 'oplata', 'platezh')
+_CANCEL_KEYWORD = 'otmena'
+_TRANSFER_KEYWORD = 'perevod na kartu'
+_KEYWORD_CLASSES = {keyword: 'income' for keyword in _INCOME_KEYWORDS}
+_KEYWORD_CLASSES.update({keyword: 'expense' for keyword in _EXPENSE_KEYWORDS})
+_KEYWORD_CLASSES[_CANCEL_KEYWORD] = 'cancel'
+_KEYWORD_CLASSES[_TRANSFER_KEYWORD] = 'transfer'
+# Длинные ключевые слова раньше коротких, чтобы 'zachislenie' не обрезалось до 'zachisl'
+_KEYWORDS_RE = re.compile('|'.join(re.escape(k) for k in sorted(_KEYWORD_CLASSES, key=len, reverse=True)))
+
+def _parse_date(text: str, current_year: int, date_formats: tuple = None):
+    # date_formats - имена допустимых форматов даты (None - все)
+    first_matches = {}
+    for m in _DATE_RE.finditer(text):
+        # lastgroup - внешняя именованная группа сработавшего формата
+        if m.lastgroup not in first_matches:
+            first_matches[m.lastgroup] = m
+            if len(first_matches) == len(_DATE_FORMATS):
+                break
+
+    for name, layout in _DATE_FORMATS:
+        if date_formats is not None and name not in date_formats:
+            continue
+        m = first_matches.get(name)
+        if not m:
+            continue
+        matched = m.group(name)
+        # Дата собирается из цифр напрямую, без strptime; недопустимые значения (31.02, 24:00) дают ValueError,
+        # и тогда, как и раньше, пробуется следующий формат
+        yearless = False
+        try:
+            if layout is None:
+                month_num = MONTH_MAP.get(m.group('mon_name').upper())
+                if not month_num:
+                    continue
+                day, year = int(m.group('mon_day')), int(m.group('mon_year'))
+            else:
+                (day_from, day_to), (month_from, month_to), year_span, short_year = layout
+                day, month_num = int(matched[day_from:day_to]), int(matched[month_from:month_to])
+                if year_span is None:
+                    yearless = True
+                    year = _YEARLESS_CHECK_YEAR
+                else:
+                    year = int(matched[year_span[0]:year_span[1]])
+                    if short_year:
+                        year += 1900 if year >= 69 else 2000
+            parsed = datetime(year, month_num, day, int(matched[-5:-3]), int(matched[-2:]))
+            if yearless:
+                return parsed.replace(year=current_year)
+            return parsed
+        except ValueError:
+            continue
+    return None
+
+
+def classify_operation(text: str, amount: float) -> str:
+    # Тип операции по знаку суммы и ключевым словам - общее правило встроенных форматов
+    found = {_KEYWORD_CLASSES[k] for k in _KEYWORDS_RE.findall(text.lower())}
+    if 'cancel' in found:
+        return 'доход' if amount > 0 else ('расход' if amount < 0 else 'неизвестно')
+    if amount < 0:
+        return 'расход'
+    if 'income' in found:
+        return 'доход'
+    if 'expense' in found or 'transfer' in found:
+        # "perevod na kartu" без явного зачисления - перевод с карты, т.е. расход
+        return 'расход'
+    if amount > 0:
+        return 'доход'
+    return 'неизвестно'
+
+
+class SmsFormat:
+    # Формат СМС банка: start - регулярное выражение маркера начала СМС (без именованных групп);
+    # amount_patterns - выражения суммы (группа 1 - сумма, группа 2 - валюта), пробуются по порядку;
+    # date_formats - имена допустимых форматов даты из _DATE_FORMATS (None - все);
+    # operation(text, amount) -> 'доход' / 'расход' / 'неизвестно'
+    def __init__(self, name: str, start: str, amount_patterns: tuple = (_SUM_SPECIFIC_RE, _SUM_GENERAL_RE),
+                 date_formats: tuple = None, operation=classify_operation):
+        self.name = name
+        self.start = start
+        self.amount_patterns = amount_patterns
+        self.date_formats = date_formats
+        self.operation = operation
+
+    def parse(self, sms_text: str, current_year: int) -> dict:
+        res = {'дата': None, 'сумма': None, 'валюта_из_смс': None, 'операция': 'неизвестно'}
+        text = sms_text.strip()
+
+        for pattern in self.amount_patterns:
+            m_sum = pattern.search(text)
+            if m_sum:
+                try:
+                    res['сумма'] = float(m_sum.group(1).replace(',', '.'))
+                    res['валюта_из_смс'] = m_sum.group(2).upper()
+                except ValueError:
+                    pass
+                break
+
+        res['дата'] = _parse_date(text, current_year, self.date_formats)
+
+        if res['сумма'] is not None:
+            res['операция'] = self.operation(text, res['сумма'])
+        return res
+
+
+_REGEX_META = set('.^$*+?{}[]|()\\')
+
+
+_GLOBAL_FLAGS_RE = re.compile(r'\(\?([aiLmsux]+)\)')
+
+
+def _has_top_level_alternation(pattern: str) -> bool:
+    # Есть ли в выражении '|' вне групп и классов символов ('A|B' - да, 'A(?:B|C)' - нет)
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            i += 2
+            continue
+        if char == '[':
+            i += 1
+            if pattern[i:i + 1] == '^':
+                i += 1
+            if pattern[i:i + 1] == ']':
+                i += 1 # ']' сразу после '[' - буква, а не конец класса
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def _scoped_pattern(pattern: str) -> str:
+    # Маркер для вставки в общее выражение: в незахватывающей группе, чтобы его '|' не захватил соседние маркеры.
+    # Глобальные флаги в начале маркера ('(?i)pokupka:') становятся флагами этой группы
+    m = _GLOBAL_FLAGS_RE.match(pattern)
+    if m:
+        return f"(?{m.group(1)}:{pattern[m.end():]})"
+    return f"(?:{pattern})"
+
+
+def _literal_prefix(pattern: str) -> str:
+    # Буквальное начало регулярного выражения маркера ('Karta\s+\*\d{4}' -> 'Karta'); '' - если его нет.
+    # У выражения с '|' верхнего уровня ('Karta...|Card...') общего начала нет, у выражения с группой
+    # или флагами в начале ('(?i)pokupka:') буквальное начало не выделяется - такие маркеры проверяются целиком
+    if _has_top_level_alternation(pattern):
+        return ''
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                break # \s, \d и т.п. - класс символов, а не буква
+            literal, step = pattern[i + 1], 2
+        elif char in _REGEX_META:
+            break
+        else:
+            literal, step = char, 1
+        if pattern[i + step:i + step + 1] in ('?', '*', '{'):
+            break # Символ с квантификатором может отсутствовать
+        prefix.append(literal)
+        i += step
+    return ''.join(prefix)
+
+
+def _trie_pattern(words) -> str:
+    # Выражение-дерево по общим началам слов: в каждой позиции текста проверяется первая буква, а не все слова подряд
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node) -> str:
+        if '' in node:
+            return '' # Более короткое слово уже отмечает кандидата - продолжение не нужно
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items())]
+        return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+    return build(trie)
+
+
+class SmsFormatRegistry:
+    def __init__(self, fallback: SmsFormat):
+        # fallback - правила для текста без маркера (начало вставки до первого распознанного СМС)
+        self.fallback = fallback
+        self._formats = []
+        self._scan_re = None
+        self._marker_re = None
+        self._by_group = {}
+
+    def register(self, sms_format: SmsFormat):
+        if any(existing.name == sms_format.name for existing in self._formats):
+            raise ValueError(f"Формат СМС '{sms_format.name}' уже зарегистрирован")
+        # Некорректный маркер отклоняется здесь, иначе он сломал бы общее выражение и разбор всех форматов
+        try:
+            marker = re.compile(_scoped_pattern(sms_format.start))
+        except re.error as e:
+            raise ValueError(f"Маркер формата СМС '{sms_format.name}' - некорректное выражение: {e}")
+        if marker.groupindex:
+            raise ValueError(f"Маркер формата СМС '{sms_format.name}' не должен содержать именованных групп")
+        if marker.match(''):
+            raise ValueError(f"Маркер формата СМС '{sms_format.name}' совпадает с пустой строкой")
+        self._formats.append(sms_format)
+        self._scan_re = None # Общие выражения маркеров пересобираются при следующем разборе
+
+    def formats(self) -> list[SmsFormat]:
+        return list(self._formats)
+
+    def _compile(self):
+        # Один проход по тексту ищет кандидатов - позиции, где начинается буквальное начало какого-либо маркера
+        # ('Karta', 'Pokupka:'); начала собраны в дерево, поэтому цена прохода почти не зависит от числа форматов.
+        # Маркеры без буквального начала входят в проход целиком. В позиции кандидата второе выражение -
+        # именованная группа на каждый маркер - проверяет маркер полностью и определяет формат СМС.
+        # При совпадении нескольких маркеров в одной позиции побеждает зарегистрированный раньше
+        self._by_group = {f"f{i}": sms_format for i, sms_format in enumerate(self._formats)}
+        self._marker_re = re.compile(
+            '|'.join(f"(?P<{group}>{_scoped_pattern(sms_format.start)})" for group, sms_format in self._by_group.items())
+        )
+        prefixes = [(_literal_prefix(sms_format.start), sms_format) for sms_format in self._formats]
+        alternatives = [_scoped_pattern(sms_format.start) for prefix, sms_format in prefixes if not prefix]
+        if any(prefix for prefix, _ in prefixes):
+            alternatives.insert(0, _trie_pattern(prefix for prefix, _ in prefixes if prefix))
+        self._scan_re = re.compile(r'(?=' + '|'.join(alternatives) + r')') if alternatives else re.compile(r'(?!)')
+
+    def segments(self, text: str) -> list[tuple[str, SmsFormat]]:
+        # Текст -> куски от маркера до следующего маркера (без обрезки пробелов) с форматом каждого куска
+        if self._scan_re is None:
+            self._compile()
+        marker_match = self._marker_re.match
+        segments = []
+        position, sms_format = 0, self.fallback
+        for candidate in self._scan_re.finditer(text):
+            start = candidate.start()
+            marker = marker_match(text, start)
+            if marker is None:
+                continue # Совпало только буквальное начало маркера
+            segments.append((text[position:start], sms_format))
+            position, sms_format = start, self._by_group[marker.lastgroup]
+        segments.append((text[position:], sms_format))
+        return segments
+
+    def find_marker(self, text: str, position: int = 0):
+        # Первый маркер в text, начинающийся не раньше position -> (позиция, формат) или None
+        if self._scan_re is None:
+            self._compile()
+        for candidate in self._scan_re.finditer(text, position):
+            marker = self._marker_re.match(text, candidate.start())
+            if marker is not None:
+                return candidate.start(), self._by_group[marker.lastgroup]
+        return None
+
+    def detect(self, sms_text: str) -> SmsFormat:
+        if self._scan_re is None:
+            self._compile()
+        m = self._marker_re.match(sms_text.strip())
+        return self._by_group[m.lastgroup] if m else self.fallback
+
+
+# Встроенные форматы: маркеры в порядке приоритета, общие правила суммы, даты и типа операции
+registry = SmsFormatRegistry(SmsFormat('unknown', ''))
+for _name, _start in (
+    ('karta', r'Karta\s+\*\d{4}'),
+    ('schet_po_karte', r'Schet\s+po\s+karte\s+\*\d{4}'),
+    ('otmena_ecom', r'OTMENA\s+E-Com\s+oplata:'),
+    ('pokupka', r'Pokupka:'),
+    ('ecom', r'E-Com\s+oplata:'),
+    ('platezh', r'Platezh:'),
+    ('perevod', r'Perevod na kartu:'),
+):
+    registry.register(SmsFormat(_name, _start))
+
+
+def register_format(sms_format: SmsFormat):
+    # Подключение формата нового банка: его маркер войдёт в общее выражение разделения СМС
+    registry.register(sms_format)
+
+
+# Потоковый разбор: запас при поиске маркера, начатого в конце предыдущей строки, и предел длины одного СМС
+SMS_MARKER_LOOKBACK = 64
+SMS_MAX_CHARS = 16384
+
+
+def _parse_one_sms(sms_text: str, current_year: int, sms_format: SmsFormat = None) -> dict:
+    return (sms_format or registry.detect(sms_text)).parse(sms_text, current_year)
+
+
+def _split(input_text: str) -> list[tuple[str, SmsFormat]]:
+    return [(sms.strip(), sms_format) for sms, sms_format in registry.segments(input_text) if sms and sms.strip()]
+
+
+def split_sms(input_text: str) -> list[str]:
+    return [sms for sms, _ in _split(input_text)]
+
+
+def iter_sms(lines):
+    # Потоковый аналог split_sms: в памяти держится только текущее (ещё не завершённое) СМС.
+    # Граница СМС - начало следующего маркера, поэтому последний кусок буфера ждёт следующих строк.
+    # Маркеры ищутся только в дописанном хвосте (с запасом SMS_MARKER_LOOKBACK на маркер, начатый в прошлой
+    # строке), так что каждая строка просматривается один раз. Буфер без маркеров длиннее SMS_MAX_CHARS -
+    # не СМС: он выдаётся как есть, чтобы память не росла на мусорном файле. Выдаёт пары (текст СМС, формат)
+    buffer, buffer_format = '', registry.fallback
+    scan_from = 0 # Позиции буфера до scan_from уже проверены; 0 - буфер ещё не начинается с маркера
+    for line in lines:
+        if buffer:
+            scan_from = max(scan_from, len(buffer) - SMS_MARKER_LOOKBACK)
+        buffer += line
+        while (found := registry.find_marker(buffer, scan_from)) is not None:
+            start, sms_format = found
+            if buffer[:start].strip():
+                yield buffer[:start].strip(), buffer_format
+            buffer, buffer_format, scan_from = buffer[start:], sms_format, 1
+        if len(buffer) > SMS_MAX_CHARS:
+            cut = len(buffer) - SMS_MARKER_LOOKBACK
+            if buffer[:cut].strip():
+                yield buffer[:cut].strip(), buffer_format
+            buffer, buffer_format, scan_from = buffer[cut:], registry.fallback, 0
+    if buffer.strip():
+        yield buffer.strip(), buffer_format
+
+
+def _unique_records(messages, current_year: int):
+    # messages - пары (текст СМС, формат)
+    seen_keys = set()
+    for message, sms_format in messages:
+        record = sms_format.parse(message, current_year)
+        if record['дата'] and record['сумма'] is not None:
+            record_key = (record['дата'], record['сумма'], record['операция'])
+            if record_key not in seen_keys:
+                seen_keys.add(record_key)
+                yield message, record
+
+
+def parse_sms_by_date(input_text: str) -> list[dict]:
+    current_year = datetime.now().year
+    return [record for _, record in _unique_records(_split(input_text), current_year)]
+
+
+def parse_sms_stream(lines):
+    # Разбор выгрузки построчно с той же дедупликацией, что и parse_sms_by_date; выдаёт пары (текст СМС, запись)
+    current_year = datetime.now().year
+    yield from _unique_records(iter_sms(lines), current_year)
@@ -0,0 +1,176 @@
+import asyncio
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from balances import BalanceIndex
+from callbacks import CallbackIndex
+from fingerprints import FingerprintIndex
+from fx_rates import FxRates
+from ledger import FactLedger
+from rollups import MonthlyRollups
+from row_cursor import RowCursor
+from write_queue import WriteBehindQueue
+
+# Состояние бота для одной таблицы: подключение, справочники листа "system", курсор и локальное зеркало
+# листа "fact" с индексами поверх него (балансы, отпечатки, помесячные итоги) и очередь записи.
+# В обычном режиме такая таблица одна; в режиме нескольких таблиц у каждого чата своя, а открытые
+# таблицы держатся в LRU-кэше и закрываются после простоя.
+
+_SPREADSHEET_URL_RE = re.compile(r'/spreadsheets/d/([a-zA-Z0-9_-]+)')
+_SPREADSHEET_ID_RE = re.compile(r'^[a-zA-Z0-9_-]{20,}$')
+
+
+def parse_spreadsheet_id(text: str) -> Optional[str]:
+    # Ссылка на таблицу или её идентификатор -> идентификатор; None, если не похоже ни на то, ни на другое
+    text = (text or '').strip()
+    m = _SPREADSHEET_URL_RE.search(text)
+    if m:
+        return m.group(1)
+    return text if _SPREADSHEET_ID_RE.match(text) else None
+
+
+class Tenant:
+    def __init__(self, key: str, client, ledger_path: str, journal_path: str, snapshot_path: str,
+                 writer, verifier, flush_interval_ms: int, flush_max_rows: int, base_currency: str,
+                 is_transient=None, retry_base: float = 2.0, retry_max: float = 300.0, max_attempts: int = 8):
+        # writer(tenant, rows, on_begin) и verifier(tenant, rows, start_row) - корутины записи и проверки пакета;
+        # is_transient(error) - можно ли повторить пакет после ошибки
+        self.key = key
+        self.client = client
+        self.snapshot_path = snapshot_path
+
+        # Справочники листа "system" и индекс callback_data кнопок
+        self.categories = []
+        self.subcategories = {}
+        self.sources = []
+        self.callback_index = CallbackIndex([], {}, [])
+        self.reference_hash = None
+
+        # Курсор следующей свободной строки листа "fact" (номер строки нужен для формулы баланса)
+        self.row_cursor = RowCursor()
+
+        # Локальное зеркало листа "fact" и индексы, которые обновляются каждой новой строкой зеркала
+        self.ledger = FactLedger(ledger_path)
+        self.ledger_synced = False
+        self.balance_index = BalanceIndex()
+        self.balance_index.rebuild_from_ledger(self.ledger)
+        self.ledger.add_listener(self.balance_index.apply_rows)
+        self.fingerprints = FingerprintIndex(self.ledger)
+        self.ledger.add_listener(self.fingerprints.add_rows)
+        self.rollups = MonthlyRollups(self.ledger)
+        self.ledger.add_listener(self.rollups.add_rows)
+        # Курсы валют к базовой валюте (загружаются при первой записи или отчёте и обновляются по интервалу)
+        self.fx_rates = FxRates(base_currency)
+        # Сверка балансов с таблицей: время последней сверки, расхождения {(источник, валюта): (зеркало, таблица)},
+        # поправки по участкам листа {первая строка участка: расхождения} и начало следующего участка
+        self.balance_check = {'at': None, 'drift': {}, 'corrections': {}, 'next_row': 2}
+        # Обработчики, которые сейчас работают с таблицей: вытесненная из кэша таблица закрывается после них
+        self.leases = 0
+        self.closing = False
+        self._released = None
+
+        self.write_queue = WriteBehindQueue(
+            journal_path,
+            writer=functools.partial(writer, self),
+            verifier=functools.partial(verifier, self),
+            flush_interval_ms=flush_interval_ms,
+            flush_max_rows=flush_max_rows,
+            is_transient=is_transient,
+            # Отклонённые строки не записаны - их отпечатки больше не считаются дубликатами
+            on_failed=lambda rows, error: self.fingerprints.release(rows),
+            on_verified=self._rows_verified,
+            retry_base=retry_base,
+            retry_max=retry_max,
+            max_attempts=max_attempts,
+        )
+
+    def apply_reference_data(self, categories: list, subcategories: dict, sources: list, content_hash: str = None):
+        self.reference_hash = content_hash
+        self.categories = categories
+        self.subcategories = subcategories
+        self.sources = sources
+        # Клавиатуры в кэше ключуются версией индекса - хэшем содержимого справочников, поэтому клавиатуры прежних
+        # справочников (в том числе прежнего экземпляра той же таблицы, вытесненного и открытого заново)
+        # больше не используются и вытесняются
+        self.callback_index = CallbackIndex(categories, subcategories, sources)
+
+    def _rows_verified(self, rows: list[list]):
+        # Пакет найден в таблице проверкой после сбоя: строки записаны, но не попали в зеркало. Резерв отпечатков
+        # снимается, а зеркало дочитывается заново при следующей синхронизации - строки войдут в счётчики отпечатков
+        self.fingerprints.release(rows)
+        self.ledger_synced = False
+
+    def acquire(self):
+        self.leases += 1
+
+    def release(self):
+        self.leases -= 1
+        if self.leases == 0 and self._released:
+            self._released.set()
+
+    def __enter__(self):
+        # with tenant: - таблица не закрывается, пока блок не завершится (фоновые задачи)
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def close(self):
+        # Незаписанные строки остаются в журнале и дописываются при следующем открытии таблицы
+        while self.leases:
+            self._released = asyncio.Event()
+            await self._released.wait()
+        self.closing = True
+        await self.write_queue.stop()
+        self.ledger.close()
+
+
+def tenant_data_dir(base_dir: str, spreadsheet_id: str) -> str:
+    return os.path.join(base_dir, spreadsheet_id)
+
+
+def tenants_with_pending_writes(base_dir: str, journal_name: str) -> list[str]:
+    # Таблицы, у которых в журнале остались заявки (процесс остановился до их записи)
+    if not os.path.isdir(base_dir):
+        return []
+    pending = []
+    for name in sorted(os.listdir(base_dir)):
+        journal_path = os.path.join(base_dir, name, journal_name)
+        if os.path.isfile(journal_path) and os.path.getsize(journal_path) > 0:
+            pending.append(name)
+    return pending
+
+
+class TenantDirectory:
+    # Привязка чатов к таблицам: chat_id -> идентификатор таблицы
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS tenants (chat_id INTEGER PRIMARY KEY, spreadsheet_id TEXT NOT NULL, updated_at REAL)'
+        )
+        self._conn.commit()
+
+    def get(self, chat_id: int) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute('SELECT spreadsheet_id FROM tenants WHERE chat_id = ?', (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def assign(self, chat_id: int, spreadsheet_id: str):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO tenants (chat_id, spreadsheet_id, updated_at) VALUES (?, ?, ?)',
+                               (chat_id, spreadsheet_id, time.time()))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+from balances import INCOME_CATEGORY, totals
+from ledger import sheet_record
+
+# Сверка балансов с листом "fact": поправки хранятся по участкам одной сетки, поэтому сверка участка задачей
+# не стирает поправки других участков, найденные полной сверкой, и наоборот.
+
+CHUNK_ROWS = 3
+
+
+class FakeSheet:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get(self, range_name, **kwargs):
+        first, last = (int(cell[1:]) for cell in range_name.split(':'))
+        return [list(row) for row in self.rows[first - 2:last - 1]]
+
+
+class FakeClient:
+    async def call(self, func, *args, priority=None, **kwargs):
+        return func(*args, **kwargs)
+
+
+def fact_row(amount, category='Еда', source='Карта'):
+    return ['01.01.2024', category, '', amount, '', '', 'RUB', source]
+
+
+@pytest.fixture
+def tenant(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'BALANCE_CHECK_CHUNK_ROWS', CHUNK_ROWS)
+    tenant = bot._create_tenant('sheet-1', bot.sheets_client, str(tmp_path / 'ledger.sqlite3'),
+                                str(tmp_path / 'write_journal.jsonl'), str(tmp_path / 'reference_snapshot.json'))
+    rows = [fact_row(100 + i) for i in range(8)] + [fact_row(5000, INCOME_CATEGORY)]
+    tenant.ledger.store_sheet_rows(2, rows)
+    tenant.sheet = FakeSheet([list(row) for row in rows])
+    tenant.client = FakeClient()
+
+    async def open_fact_sheet(tenant, priority=None):
+        return tenant.sheet
+
+    monkeypatch.setattr(bot, '_open_fact_sheet', open_fact_sheet)
+    yield tenant
+    tenant.ledger.close()
+
+
+def sheet_totals(tenant) -> dict:
+    return totals(sheet_record(row) for row in tenant.sheet.rows)
+
+
+def assert_index_matches_sheet(tenant):
+    expected = sheet_totals(tenant)
+    actual = tenant.balance_index.snapshot()
+    assert set(actual) == set(expected)
+    for key, amount in expected.items():
+        assert actual[key] == pytest.approx(amount)
+
+
+def test_full_check_keeps_per_chunk_corrections(tenant):
+    tenant.sheet.rows[1][3] = 1 # Строка 3 - участок 2..4
+    tenant.sheet.rows[6][3] = 2 # Строка 8 - участок 8..10
+    drift = asyncio.run(bot.check_balances(tenant))
+    assert set(tenant.balance_check['corrections']) == {2, 8}
+    mirror_amount, sheet_amount = drift[('Карта', 'RUB')]
+    assert sheet_amount - mirror_amount == pytest.approx((101 - 1) + (106 - 2))
+    assert_index_matches_sheet(tenant)
+
+
+def test_chunk_check_does_not_drop_corrections_of_other_chunks(tenant):
+    tenant.sheet.rows[1][3] = 1
+    tenant.sheet.rows[6][3] = 2
+    asyncio.run(bot.check_balances(tenant))
+    # Задача сверяет первый участок: поправка участка 8..10 из полной сверки остаётся
+    asyncio.run(bot.check_balances(tenant, 2, 2 + CHUNK_ROWS - 1))
+    assert set(tenant.balance_check['corrections']) == {2, 8}
+    assert_index_matches_sheet(tenant)
+    # Строку 3 исправили в таблице: уходит только поправка её участка
+    tenant.sheet.rows[1][3] = 101
+    asyncio.run(bot.check_balances(tenant, 2, 2 + CHUNK_ROWS - 1))
+    assert set(tenant.balance_check['corrections']) == {8}
+    assert_index_matches_sheet(tenant)
+
+
+def test_full_check_replaces_chunk_corrections(tenant):
+    tenant.sheet.rows[4][3] = 7 # Строка 6 - участок 5..7
+    asyncio.run(bot.check_balances(tenant, 5, 5 + CHUNK_ROWS - 1))
+    assert set(tenant.balance_check['corrections']) == {5}
+    tenant.sheet.rows[4][3] = 104
+    tenant.sheet.rows[8][3] = 4000
+    asyncio.run(bot.check_balances(tenant))
+    assert set(tenant.balance_check['corrections']) == {8}
+    assert tenant.balance_check['drift'] == {('Карта', 'RUB'): pytest.approx((5000 - 106 - 107, 4000 - 106 - 107))}
+    assert_index_matches_sheet(tenant)
+
+
+def test_unaligned_range_is_checked_from_chunk_start(tenant):
+    tenant.sheet.rows[2][3] = 0 # Строка 4 - участок 2..4
+    asyncio.run(bot.check_balances(tenant, 3, 4))
+    assert set(tenant.balance_check['corrections']) == {2}
+    assert_index_matches_sheet(tenant)
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+from quota_scheduler import PRIORITY_USER, READ, WRITE
+
+# Запись пакета в лист "fact": сверка курсора строк с таблицей - отдельное чтение через планировщик квот,
+# а внутри вызова записи к таблице идёт только append_rows.
+
+ROW = ['01.01.2024', 'Еда', 'Кафе', 100, '', 'RUB', 'Карта']
+
+
+class FakeSheet:
+    title = 'fact'
+
+    def __init__(self, filled_rows):
+        self.filled_rows = filled_rows
+        self.calls = []
+
+    def col_values(self, column):
+        self.calls.append('col_values')
+        return ['date'] * self.filled_rows
+
+    def append_rows(self, values, value_input_option=None):
+        self.calls.append('append_rows')
+        first_row = self.filled_rows + 1
+        self.filled_rows += len(values)
+        return {'updates': {'updatedRange': f"'fact'!A{first_row}:I{self.filled_rows}"}}
+
+
+class FakeClient:
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.calls = []
+
+    async def call(self, func, *args, retry=True, kind=READ, priority=None, **kwargs):
+        before = len(self.sheet.calls)
+        result = func(*args, **kwargs)
+        self.calls.append((kind, priority, self.sheet.calls[before:]))
+        return result
+
+
+class FakeRates:
+    def convert(self, amount, currency):
+        return amount
+
+
+@pytest.fixture
+def tenant(tmp_path, monkeypatch):
+    tenant = bot._create_tenant('sheet-1', bot.sheets_client, str(tmp_path / 'ledger.sqlite3'),
+                                str(tmp_path / 'write_journal.jsonl'), str(tmp_path / 'reference_snapshot.json'))
+    tenant.sheet = FakeSheet(filled_rows=3)
+    tenant.client = FakeClient(tenant.sheet)
+
+    async def open_fact_sheet(tenant, priority=None):
+        return tenant.sheet
+
+    async def load_fx_rates(tenant, priority=None):
+        return FakeRates()
+
+    monkeypatch.setattr(bot, '_open_fact_sheet', open_fact_sheet)
+    monkeypatch.setattr(bot, 'load_fx_rates', load_fx_rates)
+    monkeypatch.setattr(bot, 'BALANCE_MODE', 'formula')
+    yield tenant
+    tenant.ledger.close()
+
+
+def test_cursor_reconcile_is_a_separate_read(tenant):
+    begun = []
+    assert asyncio.run(bot._write_fact_rows(tenant, [ROW, ROW], begun.append)) == (4, 5)
+    assert begun == [4]
+    assert tenant.client.calls == [(READ, PRIORITY_USER, ['col_values']), (WRITE, PRIORITY_USER, ['append_rows'])]
+    # Курсор сдвинут по updatedRange - следующая запись обходится без чтения
+    assert asyncio.run(bot._write_fact_rows(tenant, [ROW], begun.append)) == (6, 6)
+    assert tenant.client.calls[2:] == [(WRITE, PRIORITY_USER, ['append_rows'])]
+
+
+def test_cursor_is_reconciled_through_scheduler_after_unknown_range(tenant):
+    tenant.row_cursor.reconcile(tenant.sheet)
+    tenant.row_cursor.commit({}, 4) # Ответ без updatedRange - курсор сброшен
+    tenant.sheet.calls.clear()
+    assert asyncio.run(bot._write_fact_rows(tenant, [ROW], lambda start_row: None)) == (4, 4)
+    assert tenant.client.calls == [(READ, PRIORITY_USER, ['col_values']), (WRITE, PRIORITY_USER, ['append_rows'])]
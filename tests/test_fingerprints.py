@@ -0,0 +1,95 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fingerprints import FingerprintIndex, fingerprint, row_fingerprint
+from ledger import FactLedger
+from tenants import Tenant
+
+# Отпечатки записей для отсева повторно вставленных СМС: счётчики по зеркалу и резерв строк,
+# стоящих в очереди записи.
+
+PURCHASE = ['12.05.2024', 'Pokupka', '', 350.0, 'SMS', 'RUB', 'Карта']
+
+
+def sheet_row(row: list) -> list:
+    # Строка бота -> строка листа A:H (колонка E - баланс)
+    return row[:4] + [''] + row[4:7]
+
+
+def test_fingerprint_ignores_amount_sign_and_operation_case():
+    assert fingerprint('12.05.2024', -350, 'RUB', 'Карта', 'pokupka') == fingerprint('12.05.2024', '350.00', 'RUB',
+                                                                                      'Карта', 'POKUPKA')
+    assert fingerprint('12.05.2024', 350, 'RUB', 'Карта', 'Pokupka') != fingerprint('13.05.2024', 350, 'RUB',
+                                                                                    'Карта', 'Pokupka')
+
+
+def test_filter_new_skips_only_repeats_beyond_written(tmp_path):
+    ledger = FactLedger(str(tmp_path / 'ledger.sqlite3'))
+    ledger.store_sheet_rows(2, [sheet_row(PURCHASE)])
+    index = FingerprintIndex(ledger)
+    ledger.add_listener(index.add_rows)
+    # Одна такая покупка уже в таблице, вторая в тот же день - новая
+    new_rows, skipped = index.filter_new([PURCHASE, PURCHASE])
+    assert (new_rows, skipped) == ([PURCHASE], 1)
+    # Строка в очереди тоже считается записанной
+    assert index.filter_new([PURCHASE]) == ([], 1)
+    # Запись в зеркало снимает резерв, счётчик переходит в базу
+    ledger.record_written(3, [PURCHASE])
+    assert index._pending == {}
+    assert index.filter_new([PURCHASE, PURCHASE, PURCHASE]) == ([PURCHASE], 2)
+    ledger.close()
+
+
+def test_release_drops_reservation_of_rejected_rows(tmp_path):
+    ledger = FactLedger(str(tmp_path / 'ledger.sqlite3'))
+    index = FingerprintIndex(ledger)
+    assert index.filter_new([PURCHASE]) == ([PURCHASE], 0)
+    index.release([PURCHASE])
+    assert index._pending == {}
+    assert index.filter_new([PURCHASE]) == ([PURCHASE], 0)
+    ledger.close()
+
+
+def test_verified_batch_releases_reservations(tmp_path):
+    # Запись упала по таймауту, но строки легли в таблицу: пакет завершается без диапазона,
+    # writer не записал строки в зеркало - резерв всё равно должен сняться
+    sheet = []
+
+    async def writer(tenant, rows, on_begin):
+        on_begin(2)
+        sheet.extend(rows)
+        raise TimeoutError('таймаут ответа')
+
+    async def verifier(tenant, rows, start_row):
+        return sheet[start_row - 2:start_row - 2 + len(rows)] == rows
+
+    async def scenario():
+        tenant = Tenant('sheet-1', None, str(tmp_path / 'ledger.sqlite3'), str(tmp_path / 'journal.jsonl'),
+                        str(tmp_path / 'reference_snapshot.json'), writer=writer, verifier=verifier,
+                        flush_interval_ms=60000, flush_max_rows=50, base_currency='RUB')
+        await tenant.write_queue.start()
+        tenant.ledger_synced = True
+        new_rows, _ = tenant.fingerprints.filter_new([PURCHASE])
+        future = tenant.write_queue.enqueue(new_rows)
+        await tenant.write_queue.flush()
+        assert await future is None
+        assert tenant.fingerprints._pending == {}
+        # Зеркало дочитает записанные строки при следующей синхронизации
+        assert not tenant.ledger_synced
+        await tenant.write_queue.stop()
+        tenant.ledger.close()
+
+    asyncio.run(scenario())
+    assert sheet == [PURCHASE]
+
+
+def test_row_fingerprint_matches_mirror_record(tmp_path):
+    ledger = FactLedger(str(tmp_path / 'ledger.sqlite3'))
+    ledger.record_written(2, [PURCHASE])
+    [record] = ledger.rows()
+    assert row_fingerprint(PURCHASE) == fingerprint(record['date'], record['amount'], record['currency'],
+                                                    record['source'], record['category'])
+    ledger.close()
@@ -0,0 +1,109 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+import callbacks
+from callbacks import CallbackIndex, StaleCallbackError
+
+# Индекс callback_data кнопок и кэш готовых клавиатур: кнопки кэшированной клавиатуры должны разрешаться
+# текущим индексом таблицы, в том числе после того, как таблицу вытеснили из кэша и открыли заново.
+
+CATEGORIES = ['Еда', 'Транспорт', '💰 ДОХОДЫ']
+SUBCATEGORIES = {'Еда': ['Кафе', 'Магазин'], 'Транспорт': ['Такси']}
+SOURCES = ['Карта', 'Наличные']
+
+
+def open_tenant(tmp_path, key='sheet-1'):
+    return bot._create_tenant(key, bot.sheets_client, str(tmp_path / 'ledger.sqlite3'),
+                              str(tmp_path / 'write_journal.jsonl'), str(tmp_path / 'reference_snapshot.json'))
+
+
+def button_texts(markup) -> list[str]:
+    return [button.text for row in markup.inline_keyboard for button in row]
+
+
+def category_buttons(markup) -> list:
+    return [button for row in markup.inline_keyboard for button in row
+            if button.callback_data.startswith(callbacks.ACTION_CATEGORY + callbacks.SEPARATOR)]
+
+
+@pytest.fixture(autouse=True)
+def clear_keyboard_cache():
+    bot.keyboard_cache.clear()
+    yield
+    bot.keyboard_cache.clear()
+
+
+def test_callback_data_round_trip():
+    index = CallbackIndex(CATEGORIES, SUBCATEGORIES, SOURCES)
+    action, version, ids = callbacks.decode(index.subcategory_data('Еда', 1))
+    assert action == callbacks.ACTION_SUBCATEGORY
+    assert index.resolve(version, ids, action) == ('Еда', 'Магазин')
+    action, version, ids = callbacks.decode(index.source_data(1))
+    assert index.resolve(version, ids, action) == 'Наличные'
+    assert all(len(index.category_data(category).encode('utf-8')) <= 64 for category in CATEGORIES)
+
+
+def test_callback_version_depends_only_on_content():
+    assert CallbackIndex(CATEGORIES, SUBCATEGORIES, SOURCES).version == CallbackIndex(
+        list(CATEGORIES), dict(SUBCATEGORIES), list(SOURCES)).version
+    assert CallbackIndex(CATEGORIES, SUBCATEGORIES, SOURCES).version != CallbackIndex(
+        CATEGORIES + ['Новая'], SUBCATEGORIES, SOURCES).version
+
+
+def test_stale_callback_is_rejected():
+    old = CallbackIndex(CATEGORIES, SUBCATEGORIES, SOURCES)
+    new = CallbackIndex(['Другая'], {}, SOURCES)
+    action, version, ids = callbacks.decode(old.category_data('Транспорт'))
+    with pytest.raises(StaleCallbackError):
+        new.resolve(version, ids, action)
+    with pytest.raises(StaleCallbackError):
+        callbacks.decode('c:abc')
+    with pytest.raises(StaleCallbackError):
+        new.resolve(new.version, [5], callbacks.ACTION_CATEGORY)
+
+
+def test_keyboard_is_cached_per_reference_version(tmp_path):
+    tenant = open_tenant(tmp_path)
+    tenant.apply_reference_data(CATEGORIES, SUBCATEGORIES, SOURCES)
+    first = bot.generate_categories_keyboard(tenant)
+    assert bot.generate_categories_keyboard(tenant) is first
+    tenant.apply_reference_data(CATEGORIES + ['Новая'], SUBCATEGORIES, SOURCES)
+    assert 'Новая' in button_texts(bot.generate_categories_keyboard(tenant))
+    tenant.ledger.close()
+
+
+def test_reopened_tenant_with_changed_reference_gets_fresh_keyboard(tmp_path):
+    # Прежний экземпляр таблицы вытеснен из кэша таблиц, а его клавиатуры остались в кэше клавиатур
+    old_tenant = open_tenant(tmp_path / 'old')
+    old_tenant.apply_reference_data(['Old1'], {}, SOURCES)
+    assert 'Old1' in button_texts(bot.generate_categories_keyboard(old_tenant))
+    old_tenant.ledger.close()
+
+    tenant = open_tenant(tmp_path / 'new')
+    tenant.apply_reference_data(CATEGORIES, SUBCATEGORIES, SOURCES)
+    markup = bot.generate_categories_keyboard(tenant)
+    assert 'Old1' not in button_texts(markup)
+    # Каждая кнопка новой клавиатуры разрешается текущим индексом таблицы, а не ведёт в "меню устарело"
+    for button in category_buttons(markup):
+        action, version, ids = callbacks.decode(button.callback_data)
+        assert tenant.callback_index.resolve(version, ids, action) == button.text
+    subcategories = bot.generate_subcategories_keyboard(tenant, 'Еда')
+    assert button_texts(subcategories)[:2] == ['Кафе', 'Магазин']
+    assert button_texts(bot.generate_sources_keyboard(tenant))[:2] == SOURCES
+    tenant.ledger.close()
+
+
+def test_source_button_text_follows_user_choice(tmp_path):
+    class Context:
+        user_data = {'source': 'Карта'}
+
+    tenant = open_tenant(tmp_path)
+    tenant.apply_reference_data(CATEGORIES, SUBCATEGORIES, SOURCES)
+    assert 'Источник: Карта' in button_texts(bot.generate_categories_keyboard(tenant, Context()))
+    assert 'Источник (не выбран)' in button_texts(bot.generate_categories_keyboard(tenant))
+    tenant.ledger.close()
@@ -0,0 +1,67 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from balances import INCOME_CATEGORY
+from ledger import FactLedger
+from rollups import MonthlyRollups, month_key, render_report
+
+# Помесячные итоги для /report: построение по зеркалу, дополнение слушателем и текст отчёта.
+
+
+def fact_row(date, category, subcategory, amount, currency='RUB', source='Карта'):
+    return [date, category, subcategory, amount, '', '', currency, source]
+
+
+def report_row(category, amount, currency='RUB', source='Карта', subcategory=''):
+    return {'category': category, 'subcategory': subcategory, 'source': source, 'currency': currency,
+            'amount': amount, 'count': 1}
+
+
+def test_month_key():
+    assert month_key('12.05.2024') == '2024-05'
+    assert month_key('2024-5-12') == '2024-05'
+    assert month_key('12/13/2024') is None
+    assert month_key('') is None
+
+
+def test_rollups_are_built_and_extended_by_listener(tmp_path):
+    ledger = FactLedger(str(tmp_path / 'ledger.sqlite3'))
+    ledger.store_sheet_rows(2, [fact_row('01.05.2024', 'Еда', 'Кафе', 100),
+                                fact_row('02.05.2024', 'Еда', 'Кафе', 50),
+                                fact_row('01.06.2024', 'Еда', 'Кафе', 10)])
+    rollups = MonthlyRollups(ledger)
+    ledger.add_listener(rollups.add_rows)
+    ledger.record_written(5, [['03.05.2024', 'Еда', 'Кафе', 25, '', 'RUB', 'Карта']])
+    assert rollups.months() == ['2024-05', '2024-06']
+    [may] = rollups.month('2024-05')
+    assert (may['amount'], may['count']) == (175, 3)
+    # Повторное открытие не перестраивает итоги
+    assert MonthlyRollups(ledger).month('2024-06')[0]['amount'] == 10
+    ledger.close()
+
+
+def test_report_source_totals_are_signed():
+    text = render_report('2024-05', [report_row(INCOME_CATEGORY, 1000), report_row('Еда', 300),
+                                     report_row('Еда', 50, source='Наличные')])
+    assert "Доходы: 1 000.00 RUB" in text
+    assert "Расходы: 350.00 RUB" in text
+    assert "  Карта: 700.00 RUB" in text
+    assert "  Наличные: -50.00 RUB" in text
+
+
+def test_report_categories_are_sorted_by_name():
+    # Суммы в разных валютах не сравниваются: 90 USD не "больше" 5000 RUB
+    text = render_report('2024-05', [report_row('Транспорт', 5000), report_row('Еда', 90, 'USD'),
+                                     report_row('Аренда', 100, 'EUR')])
+    lines = text.split('\n')
+    assert [line.split(':')[0] for line in lines if line.split(':')[0] in ('Аренда', 'Еда', 'Транспорт')] == [
+        'Аренда', 'Еда', 'Транспорт']
+
+
+def test_report_is_truncated_to_message_limit():
+    rows = [report_row(f'Категория {i}', i) for i in range(500)]
+    text = render_report('2024-05', rows, max_length=1000)
+    assert len(text) <= 1000 and text.endswith('…')
+    assert render_report('2024-05', []) == "За 2024-05 записей нет."
@@ -0,0 +1,221 @@
+import os
+import random
+import re
+import sys
+from datetime import datetime
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import legacy_sms_parser
+import sms_parser
+from bench_sms_parser import GOLDEN_SMS, _golden_inputs
+from sms_corpus import generate_paste
+
+# Эталон - прежний парсер (benchmarks/legacy_sms_parser.py): новый должен давать те же записи
+# на эталонном наборе бенчмарка и на сгенерированном корпусе, в том числе при потоковом разборе.
+
+CURRENT_YEAR = datetime.now().year
+
+_LEGACY_START_PATTERNS = (
+    r'Karta\s+\*\d{4}', r'Schet\s+po\s+karte\s+\*\d{4}',
+    r'OTMENA\s+E-Com\s+oplata:', r'Pokupka:', r'E-Com\s+oplata:',
+    r'Platezh:', r'Perevod na kartu:',
+)
+
+
+def legacy_split(text: str) -> list[str]:
+    # Разделение СМС по маркерам прежнего parse_sms_by_date. Там группа в lookahead была захватывающей, и re.split
+    # добавлял сами маркеры отдельными кусками (они отсеивались при разборе) - здесь группа незахватывающая
+    parts = re.split(r'(?=(?:' + '|'.join(_LEGACY_START_PATTERNS) + r'))', text)
+    return [sms.strip() for sms in parts if sms and sms.strip()]
+
+
+def chunked(text: str, rng: random.Random, max_size: int = 40) -> list[str]:
+    # Текст кусками произвольной длины - маркеры и даты рвутся между "строками" потока
+    chunks, position = [], 0
+    while position < len(text):
+        size = rng.randint(1, max_size)
+        chunks.append(text[position:position + size])
+        position += size
+    return chunks
+
+
+def stream_records(lines) -> list[dict]:
+    return [record for _, record in sms_parser.parse_sms_stream(lines)]
+
+
+@pytest.mark.parametrize('sms', GOLDEN_SMS)
+def test_parse_one_sms_matches_legacy(sms):
+    assert sms_parser._parse_one_sms(sms, CURRENT_YEAR) == legacy_sms_parser._parse_one_sms(sms, CURRENT_YEAR)
+
+
+@pytest.mark.parametrize('text', _golden_inputs())
+def test_parse_sms_by_date_matches_legacy(text):
+    assert sms_parser.parse_sms_by_date(text) == legacy_sms_parser.parse_sms_by_date(text)
+
+
+def test_parse_sms_by_date_matches_legacy_on_corpus():
+    paste = generate_paste(2000)
+    assert sms_parser.parse_sms_by_date(paste) == legacy_sms_parser.parse_sms_by_date(paste)
+
+
+@pytest.mark.parametrize('text', _golden_inputs() + [generate_paste(500)])
+def test_split_matches_legacy(text):
+    assert sms_parser.split_sms(text) == legacy_split(text)
+
+
+@pytest.mark.parametrize('text', _golden_inputs() + [generate_paste(500)])
+def test_parse_sms_stream_by_lines_matches_by_date(text):
+    assert stream_records(text.splitlines(keepends=True)) == sms_parser.parse_sms_by_date(text)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_parse_sms_stream_with_markers_split_across_chunks(seed):
+    text = " ".join(GOLDEN_SMS) + "\n" + generate_paste(300, seed=seed)
+    assert stream_records(chunked(text, random.Random(seed))) == legacy_sms_parser.parse_sms_by_date(text)
+
+
+def test_iter_sms_keeps_formats_of_split():
+    text = "мусор перед СМС " + generate_paste(200)
+    streamed = [(sms, sms_format.name) for sms, sms_format in sms_parser.iter_sms(chunked(text, random.Random(7)))]
+    assert streamed == [(sms, sms_format.name) for sms, sms_format in sms_parser._split(text)]
+    assert streamed[0] == ("мусор перед СМС", 'unknown')
+
+
+def test_iter_sms_caps_buffer_without_markers():
+    junk = ['x' * 80 + '\n'] * 2000
+    pieces = list(sms_parser.iter_sms(junk))
+    assert len(pieces) > 1
+    assert max(len(sms) for sms, _ in pieces) <= sms_parser.SMS_MAX_CHARS
+    assert sum(len(sms.replace('\n', '')) for sms, _ in pieces) == 80 * 2000
+
+
+def test_iter_sms_after_junk_still_finds_sms():
+    sms = "Schet po karte *5678 zachislenie 1500000 UZS 15-04-2024 18:30"
+    lines = ['x' * 80 + '\n'] * 500 + [sms + '\n']
+    assert list(sms_parser.iter_sms(lines))[-1] == (sms, sms_parser.registry.detect(sms))
+
+
+def test_duplicates_are_dropped_in_paste_and_stream():
+    sms = "Karta *1234 Pokupka: 150000.00 UZS 12.05.2024 10:15 KORZINKA TASHKENT"
+    text = "\n".join([sms, sms, sms])
+    assert len(sms_parser.parse_sms_by_date(text)) == 1
+    assert len(stream_records(text.splitlines(keepends=True))) == 1
+
+
+def test_invalid_date_falls_through_to_next_format():
+    record = sms_parser._parse_one_sms("Karta *6666 oplata 15000 UZS 31.02.2024 10:00 26.05.24 11:00", CURRENT_YEAR)
+    assert record['дата'] == datetime(2024, 5, 26, 11, 0)
+
+
+def test_date_without_year_is_validated_against_1900():
+    # 29 февраля без года недопустимо: проверка идёт по невисокосному 1900 году
+    assert sms_parser._parse_one_sms("Pokupka: 1 UZS 29.02 10:00", 2024)['дата'] is None
+    assert sms_parser._parse_one_sms("Pokupka: 1 UZS 28.02 10:00", 2024)['дата'] == datetime(2024, 2, 28, 10, 0)
+
+
+def test_two_digit_year_pivots_at_69():
+    assert sms_parser._parse_one_sms("Pokupka: 1 UZS 01.01.68 10:00", CURRENT_YEAR)['дата'].year == 2068
+    assert sms_parser._parse_one_sms("Pokupka: 1 UZS 01.01.69 10:00", CURRENT_YEAR)['дата'].year == 1969
+
+
+def test_sms_without_amount_or_date_is_skipped():
+    text = "Karta *0000 oplata 15000 UZS без даты\nKarta *0001 без суммы 12.05.2024 10:15"
+    assert sms_parser.parse_sms_by_date(text) == []
+    assert stream_records(text.splitlines(keepends=True)) == []
+
+
+def test_currency_from_sms():
+    record = sms_parser._parse_one_sms("Karta *0003 ZACHISLENIE 77.7 usd 01-JAN-2025 00:01", CURRENT_YEAR)
+    assert record['валюта_из_смс'] == 'USD'
+    assert record['операция'] == 'доход'
+
+
+def test_registry_detects_format_of_each_segment():
+    # Как и в прежнем парсере, граница - каждый маркер: "Karta *1234 Pokupka: ..." и "OTMENA E-Com oplata: ..."
+    # дают по два куска (внутри второго маркера начинается маркер "E-Com oplata:")
+    names = [sms_format.name for _, sms_format in sms_parser._split("\n".join(GOLDEN_SMS[:8]))]
+    assert names == ['karta', 'pokupka', 'karta', 'schet_po_karte', 'otmena_ecom', 'ecom', 'otmena_ecom', 'ecom',
+                     'ecom', 'pokupka', 'platezh']
+
+
+def test_literal_prefix_only_match_is_not_a_boundary():
+    # "Karta" без номера карты - не маркер: текст остаётся в текущем СМС
+    text = "Pokupka: 100 UZS 12.05.2024 10:15 Karta bez nomera"
+    assert sms_parser.split_sms(text) == [text]
+
+
+def test_registered_format_splits_and_parses_by_own_rules():
+    registry = sms_parser.SmsFormatRegistry(sms_parser.SmsFormat('unknown', ''))
+    for sms_format in sms_parser.registry.formats():
+        registry.register(sms_format)
+    amount_re = re.compile(r'SUM=(\d+)\s+(UZS|USD)')
+    registry.register(sms_parser.SmsFormat('newbank', r'NEWBANK\s+#\d+', amount_patterns=(amount_re,),
+                                           operation=lambda text, amount: 'доход'))
+    text = "NEWBANK #7 SUM=500 USD 12.05.2024 10:15 Pokupka: 100 UZS 12.05.2024 10:16"
+    segments = [(sms.strip(), sms_format.name) for sms, sms_format in registry.segments(text) if sms.strip()]
+    assert segments == [("NEWBANK #7 SUM=500 USD 12.05.2024 10:15", 'newbank'),
+                        ("Pokupka: 100 UZS 12.05.2024 10:16", 'pokupka')]
+    record = registry.detect(segments[0][0]).parse(segments[0][0], CURRENT_YEAR)
+    assert (record['сумма'], record['валюта_из_смс'], record['операция']) == (500.0, 'USD', 'доход')
+    assert registry.find_marker(text, 1) == (text.index('Pokupka:'), registry.detect('Pokupka:'))
+
+
+def test_registry_marker_without_literal_prefix():
+    registry = sms_parser.SmsFormatRegistry(sms_parser.SmsFormat('unknown', ''))
+    registry.register(sms_parser.SmsFormat('digits', r'\d{3}-BANK'))
+    registry.register(sms_parser.SmsFormat('pokupka', r'Pokupka:'))
+    text = "123-BANK a Pokupka: b 456-BANK c"
+    assert [sms_format.name for _, sms_format in registry.segments(text)] == ['unknown', 'digits', 'pokupka', 'digits']
+
+
+def test_register_duplicate_name_fails():
+    registry = sms_parser.SmsFormatRegistry(sms_parser.SmsFormat('unknown', ''))
+    registry.register(sms_parser.SmsFormat('a', r'A:'))
+    with pytest.raises(ValueError):
+        registry.register(sms_parser.SmsFormat('a', r'B:'))
+
+
+
+def test_marker_with_top_level_alternation_splits_on_each_branch():
+    # У 'Karta...|Card...' нет общего буквального начала: маркер проверяется целиком, а не по началу 'Karta'
+    registry = sms_parser.SmsFormatRegistry(sms_parser.SmsFormat('unknown', ''))
+    registry.register(sms_parser.SmsFormat('pokupka', r'Pokupka:'))
+    registry.register(sms_parser.SmsFormat('card', r'Karta\s+\*\d{4}|Card\s+\*\d{4}'))
+    text = "Karta *1234 100 UZS Card *5678 200 UZS Pokupka: 300 UZS"
+    segments = [(sms.strip(), sms_format.name) for sms, sms_format in registry.segments(text) if sms.strip()]
+    assert segments == [("Karta *1234 100 UZS", 'card'), ("Card *5678 200 UZS", 'card'), ("Pokupka: 300 UZS", 'pokupka')]
+
+
+def test_marker_alternation_does_not_leak_into_other_markers():
+    # Без группы вокруг маркера 'A:|B:' общее выражение читалось бы как '(?P<f0>A:|B:)|(?P<f1>...)' и т.п.
+    registry = sms_parser.SmsFormatRegistry(sms_parser.SmsFormat('unknown', ''))
+    registry.register(sms_parser.SmsFormat('ab', r'A:|B:'))
+    registry.register(sms_parser.SmsFormat('c', r'C:'))
+    assert [sms_format.name for _, sms_format in registry.segments("A: 1 C: 2 B: 3")] == ['unknown', 'ab', 'c', 'ab']
+    assert registry.detect("B: 3").name == 'ab'
+
+
+def test_marker_with_inline_global_flag():
+    registry = sms_parser.SmsFormatRegistry(sms_parser.SmsFormat('unknown', ''))
+    registry.register(sms_parser.SmsFormat('pokupka', r'(?i)pokupka:'))
+    registry.register(sms_parser.SmsFormat('platezh', r'Platezh:'))
+    text = "POKUPKA: 1 UZS platezh: 2 UZS Platezh: 3 UZS pokupka: 4 UZS"
+    segments = [(sms.strip(), sms_format.name) for sms, sms_format in registry.segments(text) if sms.strip()]
+    # Флаг действует только на свой маркер: 'platezh:' в нижнем регистре - не маркер
+    assert segments == [("POKUPKA: 1 UZS platezh: 2 UZS", 'pokupka'), ("Platezh: 3 UZS", 'platezh'),
+                        ("pokupka: 4 UZS", 'pokupka')]
+
+
+@pytest.mark.parametrize('start', [r'Pokupka(?i):', r'Karta (', r'(?P<card>Karta)', r'\d*'])
+def test_invalid_marker_is_rejected_and_registry_keeps_working(start):
+    registry = sms_parser.SmsFormatRegistry(sms_parser.SmsFormat('unknown', ''))
+    registry.register(sms_parser.SmsFormat('platezh', r'Platezh:'))
+    with pytest.raises(ValueError):
+        registry.register(sms_parser.SmsFormat('bad', start))
+    registry.register(sms_parser.SmsFormat('pokupka', r'Pokupka:'))
+    assert [sms_format.name for _, sms_format in registry.segments("Platezh: 1 Pokupka: 2")] == ['unknown', 'platezh', 'pokupka']
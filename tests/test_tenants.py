@@ -0,0 +1,176 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from gspread.exceptions import SpreadsheetNotFound, WorksheetNotFound
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+from lru_cache import LRUCache
+from tenants import TenantDirectory
+
+# Режим нескольких таблиц: привязка чата к таблице командой /connect, кэш открытых таблиц и аренда таблицы
+# обработчиком - вытесненная таблица закрывается только после обработчиков, которые с ней работают.
+
+SPREADSHEET_ID = '1AbCdEfGhIjKlMnOpQrStUvWxYz0123456789'
+OTHER_SPREADSHEET_ID = '1ZyXwVuTsRqPoNmLkJiHgFeDcBa9876543210'
+
+
+class Message:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class Chat:
+    id = 42
+
+
+class Update:
+    def __init__(self):
+        self.message = Message()
+        self.effective_message = self.message
+        self.effective_chat = Chat()
+
+
+class Context:
+    def __init__(self, args):
+        self.args = args
+        self.bot = None
+
+
+class FailingClient:
+    def __init__(self, error):
+        self.error = error
+        self.opened = []
+
+    async def worksheet(self, title, priority=None):
+        self.opened.append(title)
+        raise self.error
+
+
+@pytest.fixture
+def multi_tenant(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'MULTI_TENANT', True)
+    monkeypatch.setattr(bot, 'TENANTS_DATA_DIR', str(tmp_path / 'tenants'))
+    directory = TenantDirectory(str(tmp_path / 'tenants.sqlite3'))
+    monkeypatch.setattr(bot, 'tenant_directory', directory)
+    bot.tenant_cache.clear()
+    yield tmp_path
+    bot.tenant_cache.clear()
+    directory.close()
+
+
+@pytest.mark.parametrize('error, reason', [
+    (SpreadsheetNotFound(), 'таблица не найдена'),
+    (WorksheetNotFound('system'), 'в таблице нет листа "system"'),
+])
+def test_connect_to_inaccessible_spreadsheet_persists_nothing(multi_tenant, monkeypatch, error, reason):
+    client = FailingClient(error)
+    monkeypatch.setattr(bot.sheets_client, 'for_spreadsheet', lambda spreadsheet_id: client)
+    update = Update()
+    asyncio.run(bot.connect(update, Context([f'https://docs.google.com/spreadsheets/d/{SPREADSHEET_ID}/edit'])))
+    assert client.opened == ['system']
+    assert len(update.message.replies) == 1 and reason in update.message.replies[0]
+    assert bot.tenant_directory.get(Chat.id) is None
+    assert len(bot.tenant_cache) == 0
+    assert not os.path.exists(multi_tenant / 'tenants')
+
+
+def test_connect_rejects_text_without_spreadsheet_id(multi_tenant):
+    update = Update()
+    asyncio.run(bot.connect(update, Context(['не ссылка'])))
+    assert update.message.replies[0].startswith('Пришлите ссылку')
+    assert bot.tenant_directory.get(Chat.id) is None
+
+
+def test_lru_cache_evicts_least_recently_used():
+    evicted = []
+    cache = LRUCache(maxsize=2, on_evict=lambda key, value: evicted.append(key))
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert evicted == ['b']
+    assert cache.get('b') is None and cache.values() == [1, 3]
+    # pop - удаление без on_evict
+    assert cache.pop('a') == 1
+    assert evicted == ['b'] and len(cache) == 1
+
+
+def test_lru_cache_evicts_idle_entries():
+    evicted = []
+    cache = LRUCache(maxsize=10, idle_ttl=0, on_evict=lambda key, value: evicted.append(key))
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.evict_idle() == 2
+    assert evicted == ['a', 'b'] and len(cache) == 0
+    assert LRUCache(maxsize=10).evict_idle() == 0
+
+
+@pytest.fixture
+def tenant_cache(multi_tenant, monkeypatch):
+    # Таблицы открываются без Google Sheets: справочники и первичная загрузка подменены
+    async def load_keyboard_data(tenant, priority=None):
+        return None
+
+    async def init_google(tenant, load_reference=True):
+        return None
+
+    monkeypatch.setattr(bot.sheets_client, 'for_spreadsheet', lambda spreadsheet_id: object())
+    monkeypatch.setattr(bot, 'load_keyboard_data', load_keyboard_data)
+    monkeypatch.setattr(bot, '_init_google', init_google)
+    cache = LRUCache(maxsize=1, on_evict=bot._on_tenant_evicted)
+    monkeypatch.setattr(bot, 'tenant_cache', cache)
+    return cache
+
+
+def test_evicted_tenant_is_closed_after_handler_lease(tenant_cache):
+    async def scenario():
+        leased, finish = asyncio.Event(), asyncio.Event()
+
+        @bot.releases_tenants
+        async def handler():
+            tenant = await bot._lease_tenant(SPREADSHEET_ID, None)
+            leased.set()
+            await finish.wait()
+            return tenant
+
+        task = asyncio.create_task(handler())
+        await leased.wait()
+        tenant = tenant_cache.get(SPREADSHEET_ID)
+        assert tenant.leases == 1
+        # Вторая таблица вытесняет первую из кэша, но обработчик ещё работает с ней - закрытие ждёт
+        other = await bot.open_tenant(OTHER_SPREADSHEET_ID, None)
+        assert tenant_cache.values() == [other]
+        closing = bot._closing_tenants[SPREADSHEET_ID]
+        await asyncio.sleep(0.01)
+        assert not closing.done() and not tenant.closing
+        finish.set()
+        assert await task is tenant
+        await closing
+        assert tenant.closing and tenant.leases == 0
+        assert SPREADSHEET_ID not in bot._closing_tenants
+        # Повторное открытие даёт новый экземпляр поверх тех же файлов
+        reopened = await bot.open_tenant(SPREADSHEET_ID, None)
+        assert reopened is not tenant
+        await asyncio.gather(*bot._closing_tenants.values())
+        for open_tenant in tenant_cache.values():
+            await open_tenant.close()
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_opens_share_one_tenant(tenant_cache):
+    async def scenario():
+        first, second = await asyncio.gather(bot.open_tenant(SPREADSHEET_ID, None),
+                                             bot.open_tenant(SPREADSHEET_ID, None))
+        assert first is second
+        assert bot._opening_tenants == {}
+        await first.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from write_queue import WriteBehindQueue, WriteJournal
+
+# Очередь отложенной записи: журнал на диске, восстановление прерванных пакетов после перезапуска,
+# отклонение пакетов с постоянной ошибкой и задержка перед повтором после временной.
+
+ROW = ['01.01.2024', 'Еда', 'Кафе', 100, '', 'RUB', 'Карта']
+
+
+class FakeSheet:
+    # Лист "fact": append_rows дописывает строки после последней, как в Google Sheets
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.appends = 0
+        self.errors = []
+
+    async def write(self, rows, on_begin):
+        start_row = len(self.rows) + 2
+        on_begin(start_row)
+        self.appends += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.rows.extend(rows)
+        return start_row, start_row + len(rows) - 1
+
+    async def verify(self, rows, start_row):
+        return self.rows[start_row - 2:start_row - 2 + len(rows)] == rows
+
+
+def write_journal(path, records, tail=''):
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        f.write(tail)
+
+
+def journal_ops(path) -> list[str]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line)['op'] for line in f if line.strip()]
+
+
+def make_queue(path, sheet, **kwargs):
+    return WriteBehindQueue(str(path), writer=sheet.write, verifier=sheet.verify, flush_interval_ms=60000, **kwargs)
+
+
+def test_interrupted_batch_is_written_again_after_restart(tmp_path):
+    # Падение между begin и done до того, как строки легли в таблицу: пакет пишется заново, один раз
+    path = tmp_path / 'journal.jsonl'
+    write_journal(path, [{'op': 'add', 'id': 'a', 'rows': [ROW], 'meta': {'chat_id': 1}},
+                         {'op': 'begin', 'ids': ['a'], 'start_row': 2}])
+    sheet = FakeSheet()
+
+    async def scenario():
+        queue = make_queue(path, sheet)
+        recovered = await queue.start()
+        assert [meta for _, meta in recovered] == [{'chat_id': 1}]
+        await queue.flush()
+        assert await recovered[0][0] == (2, 2)
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert sheet.rows == [ROW]
+    assert sheet.appends == 1
+    assert WriteJournal(str(path)).load() == ({}, {})
+
+
+def test_verified_batch_is_not_written_twice(tmp_path):
+    # Падение после того, как строки легли в таблицу, но до done: проверка находит их, повтора нет
+    path = tmp_path / 'journal.jsonl'
+    write_journal(path, [{'op': 'add', 'id': 'a', 'rows': [ROW], 'meta': {}},
+                         {'op': 'begin', 'ids': ['a'], 'start_row': 2}])
+    sheet = FakeSheet([ROW])
+
+    async def scenario():
+        queue = make_queue(path, sheet)
+        recovered = await queue.start()
+        assert len(recovered) == 1 and recovered[0][0].result() is None
+        assert queue.pending_rows == 0
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert sheet.rows == [ROW]
+    assert sheet.appends == 0
+    assert WriteJournal(str(path)).load() == ({}, {})
+
+
+def test_permanent_error_fails_batch(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    sheet = FakeSheet()
+    sheet.errors.append(PermissionError('нет доступа к таблице'))
+    failed = []
+
+    async def scenario():
+        queue = make_queue(path, sheet, is_transient=lambda error: False,
+                           on_failed=lambda rows, error: failed.append((rows, error)))
+        await queue.start()
+        future = queue.enqueue([ROW])
+        await queue.flush()
+        with pytest.raises(PermissionError):
+            await future
+        assert queue.pending_rows == 0
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert [(rows, type(error)) for rows, error in failed] == [([ROW], PermissionError)]
+    assert journal_ops(path)[-1] == 'failed'
+    assert WriteJournal(str(path)).load() == ({}, {})
+
+
+def test_transient_error_waits_for_retry_delay(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    sheet = FakeSheet()
+    sheet.errors.append(ConnectionError('таймаут'))
+
+    async def scenario():
+        queue = make_queue(path, sheet, retry_base=60.0)
+        await queue.start()
+        future = queue.enqueue([ROW])
+        await queue.flush()
+        assert sheet.appends == 1
+        assert queue.retry_in > 0
+        # До окончания задержки пакет не повторяется
+        await queue.flush()
+        assert sheet.appends == 1 and not future.done()
+        await queue.flush(force=True)
+        assert await future == (2, 2)
+        assert queue.retry_in == 0
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert sheet.rows == [ROW]
+    assert sheet.appends == 2
+
+
+def test_truncated_last_journal_line_is_skipped(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    write_journal(path, [{'op': 'add', 'id': 'a', 'rows': [ROW], 'meta': {}}], tail='{"op": "add", "id": "b", "ro')
+    tickets, in_flight = WriteJournal(str(path)).load()
+    assert list(tickets) == ['a'] and in_flight == {}
+    sheet = FakeSheet()
+
+    async def scenario():
+        queue = make_queue(path, sheet)
+        recovered = await queue.start()
+        assert len(recovered) == 1
+        await queue.flush()
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert sheet.rows == [ROW]
+    assert WriteJournal(str(path)).load() == ({}, {})
+
+
+def test_ticket_enqueued_during_compaction_is_kept(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    sheet = FakeSheet()
+
+    async def scenario():
+        queue = make_queue(path, sheet)
+        await queue.start()
+        queue.enqueue([ROW])
+        flush = asyncio.create_task(queue.flush())
+        # Пакет записан, очередь опустела, сжатие журнала идёт в пуле потоков - а заявки продолжают поступать
+        while sheet.appends == 0:
+            await asyncio.sleep(0)
+        queue.enqueue([ROW])
+        await flush
+
+    asyncio.run(scenario())
+    tickets, _ = WriteJournal(str(path)).load()
+    assert len(tickets) == 1
@@ -0,0 +1,57 @@
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Параллельная обработка обновлений разных чатов при сохранении порядка внутри одного чата:
+# медленный импорт СМС одного пользователя не задерживает нажатия кнопок других, а обновления
+# одного пользователя не гоняются за его user_data (источник, категория, режим СМС).
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # чат -> очередь обновлений чата; первое в очереди обрабатывается, остальные ждут
+        self._chat_queues = {}
+
+    @staticmethod
+    def _chat_key(update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            await coroutine
+            return
+        # Место в общем лимите (семафор базового класса) уже занято. Если чат занят, обновление встаёт
+        # в очередь чата и место сразу освобождается: очередь разбирает обновление, которое её открыло,
+        # по порядку поступления. Так один чат держит не больше одного места, сколько бы он ни прислал
+        queue = self._chat_queues.get(key)
+        if queue is not None:
+            queue.append(coroutine)
+            return
+        queue = self._chat_queues[key] = deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await queue[0]
+                except Exception as e_update:
+                    print(f"Ошибка обработки обновления чата {key}: {e_update}")
+                finally:
+                    queue.popleft()
+        finally:
+            del self._chat_queues[key]
+            for pending in queue:
+                pending.close() # Обработка прервана (остановка бота) - не запущенные обновления отбрасываются
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from lru_cache import LRUCache
+
+# Хранение context.user_data (источник, категория, подкатегория, режим СМС) в SQLite.
+# python-telegram-bot сам копит изменённых пользователей и отдаёт их раз в update_interval секунд;
+# здесь неизменившиеся состояния отбрасываются, а изменившиеся пишутся одной транзакцией.
+# При запуске ничего не читается: состояние пользователя загружается при его первом обновлении.
+# Отметки о загрузке и последние записанные состояния хранятся для cache_size недавно активных пользователей.
+
+
+class SQLiteUserPersistence(BasePersistence[dict, dict, dict]):
+    def __init__(self, path: str, update_interval: float = 30, cache_size: int = 10000):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL)'
+        )
+        self._conn.commit()
+        self._loaded = LRUCache(cache_size) # user_id -> True, состояние уже загружено из базы
+        self._persisted = LRUCache(cache_size) # user_id -> JSON последнего записанного состояния
+        self._pending = {}
+        self._commit_scheduled = False
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        if self._loaded.get(user_id):
+            return
+        self._loaded.put(user_id, True)
+        if user_data:
+            # Отметка вытеснена из кэша, но в памяти бота состояние есть - оно новее сохранённого
+            return
+        row = self._conn.execute('SELECT data FROM user_state WHERE user_id = ?', (user_id,)).fetchone()
+        if not row:
+            return
+        self._persisted.put(user_id, row[0])
+        try:
+            stored = json.loads(row[0])
+        except ValueError:
+            print(f"Сохранённое состояние пользователя {user_id} повреждено и будет перезаписано.")
+            return
+        for key, value in stored.items():
+            user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id: int, data: dict):
+        serialized = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        if self._persisted.get(user_id) == serialized:
+            return
+        self._pending[user_id] = serialized
+        if not self._commit_scheduled:
+            # Все изменённые пользователи передаются в одном проходе - коммитим их вместе после него
+            self._commit_scheduled = True
+            asyncio.get_running_loop().call_soon(self._commit_pending)
+
+    def _commit_pending(self):
+        self._commit_scheduled = False
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        now = time.time()
+        try:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO user_state (user_id, data, updated_at) VALUES (?, ?, ?)',
+                [(user_id, serialized, now) for user_id, serialized in pending.items()]
+            )
+            self._conn.commit()
+        except sqlite3.Error as e:
+            print(f"Не удалось сохранить состояние {len(pending)} пользователей: {e}")
+            for user_id, serialized in pending.items():
+                self._pending.setdefault(user_id, serialized)
+            return
+        for user_id, serialized in pending.items():
+            self._persisted.put(user_id, serialized)
+
+    async def drop_user_data(self, user_id: int):
+        self._pending.pop(user_id, None)
+        self._persisted.pop(user_id, None)
+        self._conn.execute('DELETE FROM user_state WHERE user_id = ?', (user_id,))
+        self._conn.commit()
+
+    async def flush(self):
+        self._commit_pending()
+        self._conn.close()
+
+    # Остальные данные python-telegram-bot бот не хранит
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
@@ -0,0 +1,329 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+# Очередь отложенной записи в лист "fact".
+# Записи всех пользователей копятся и уходят в таблицу одним append_rows каждые flush_interval_ms
+# или по достижении flush_max_rows строк. Каждая заявка сначала попадает в журнал на диске,
+# поэтому после падения или перезапуска незаписанные заявки дописываются ровно один раз.
+#
+# Формат журнала (JSON Lines):
+#   {"op": "add", "id": ..., "rows": [...], "meta": {...}}    - заявка принята
+#   {"op": "begin", "ids": [...], "start_row": N}              - пакет отправляется, ожидаемая первая строка
+#   {"op": "done", "ids": [...], "range": [first, last]}       - пакет записан в таблицу
+#   {"op": "failed", "ids": [...], "error": "..."}             - пакет отклонён (постоянная ошибка или исчерпаны повторы)
+#
+# Заявка пишется в журнал без fsync, чтобы не останавливать event loop на каждом сообщении: журнал
+# сбрасывается на диск одним fsync в пуле потоков перед отправкой пакета (групповая фиксация).
+
+
+class WriteJournal:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def append(self, record: dict, sync: bool = True):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+                f.flush()
+                if sync:
+                    os.fsync(f.fileno())
+
+    def sync(self):
+        # fsync всего файла: на диск уходят и строки, дописанные с sync=False
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            os.fsync(f.fileno())
+
+    def load(self) -> tuple[dict, dict]:
+        # Возвращает незавершённые заявки {id: запись add} и незавершённые пакеты {id заявки: start_row}
+        tickets = {}
+        in_flight = {}
+        if not os.path.exists(self.path):
+            return tickets, in_flight
+        with self._lock, open(self.path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Недописанная строка в конце журнала после аварийного завершения
+                    print(f"Пропущена повреждённая строка журнала записи: {line[:80]}")
+                    continue
+                op = record.get('op')
+                if op == 'add':
+                    tickets[record['id']] = record
+                elif op == 'begin':
+                    for ticket_id in record['ids']:
+                        in_flight[ticket_id] = record['start_row']
+                elif op in ('done', 'failed'):
+                    for ticket_id in record['ids']:
+                        tickets.pop(ticket_id, None)
+                        in_flight.pop(ticket_id, None)
+        return tickets, in_flight
+
+    def compact(self, pending: list[dict]):
+        # Переписывает журнал, оставляя только ещё не записанные заявки. pending копируется под блокировкой журнала:
+        # заявка, которую очередь добавила в pending во время сжатия, попадает либо в копию, либо дописывается
+        # в новый журнал после неё (повтор add с тем же id при загрузке безвреден)
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            pending = list(pending)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for record in pending:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+
+class WriteBehindQueue:
+    def __init__(self, journal_path: str, writer, verifier=None,
+                 flush_interval_ms: int = 1500, flush_max_rows: int = 50,
+                 is_transient=None, on_failed=None, on_verified=None,
+                 retry_base: float = 2.0, retry_max: float = 300.0, max_attempts: int = 8):
+        # writer(rows, on_begin) - корутина, записывающая строки одним append_rows;
+        #   перед обращением к API вызывает on_begin(start_row) и возвращает фактический диапазон (first, last).
+        # verifier(rows, start_row) - корутина, проверяющая после перезапуска, легли ли строки
+        #   прерванного пакета в таблицу (чтобы не записать их второй раз).
+        # is_transient(error) - можно ли повторить пакет после ошибки (по умолчанию - любую).
+        #   Пакет с постоянной ошибкой или после max_attempts неудачных попыток подряд убирается из очереди,
+        #   его future получают исключение, а on_failed(rows, error) - отклонённые строки.
+        # on_verified(rows) - строки пакета, который verifier нашёл в таблице после сбоя: они записаны,
+        #   но диапазон неизвестен (future получают None), поэтому writer не учёл их сам.
+        # Повторы идут с экспоненциальной задержкой от retry_base до retry_max сек (со случайным разбросом).
+        self.journal = WriteJournal(journal_path)
+        self.writer = writer
+        self.verifier = verifier
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_rows = flush_max_rows
+        self.is_transient = is_transient
+        self.on_failed = on_failed
+        self.on_verified = on_verified
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.max_attempts = max_attempts
+        self._failures = 0 # неудачных попыток подряд для пакета в начале очереди
+        self._retry_at = 0.0
+        self._unsynced = False
+        self._pending = []  # записи "add" в порядке поступления
+        self._futures = {}
+        self._pending_rows = 0
+        self._wakeup = None
+        self._flush_lock = None
+        self._task = None
+        self._stopping = False
+
+    @property
+    def pending_rows(self) -> int:
+        return self._pending_rows
+
+    async def start(self) -> list[tuple[asyncio.Future, dict]]:
+        # Загружает журнал и запускает фоновую запись. Возвращает (future, meta) восстановленных заявок,
+        # чтобы вызывающий код мог отправить пользователям подтверждение.
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        tickets, in_flight = self.journal.load()
+        recovered = []
+
+        interrupted = {}
+        for ticket_id, start_row in in_flight.items():
+            interrupted.setdefault(start_row, []).append(ticket_id)
+        for start_row, ticket_ids in interrupted.items():
+            rows = [row for ticket_id in ticket_ids for row in tickets[ticket_id]['rows']]
+            if await self._verify(rows, start_row):
+                print(f"Пакет из {len(rows)} строк (с {start_row}) уже записан в таблицу до перезапуска.")
+                self.journal.append({'op': 'done', 'ids': ticket_ids, 'range': None})
+                self._batch_verified(rows)
+                for ticket_id in ticket_ids:
+                    record = tickets.pop(ticket_id)
+                    future = asyncio.get_running_loop().create_future()
+                    future.set_result(None)
+                    recovered.append((future, record.get('meta', {})))
+
+        for record in tickets.values():
+            future = self._add_pending(record)
+            recovered.append((future, record.get('meta', {})))
+        await self._compact_journal()
+        if self._pending:
+            print(f"Восстановлено из журнала {len(self._pending)} незаписанных заявок ({self._pending_rows} строк).")
+            self._wakeup.set()
+
+        self._task = asyncio.create_task(self._run())
+        return recovered
+
+    def enqueue(self, rows: list[list], meta: dict = None) -> asyncio.Future:
+        record = {'op': 'add', 'id': uuid.uuid4().hex, 'rows': rows, 'meta': meta or {}}
+        # Сначала в pending, потом в журнал: так заявку не потеряет сжатие журнала, идущее в пуле потоков
+        future = self._add_pending(record)
+        try:
+            self.journal.append(record, sync=False)
+        except Exception:
+            self._pending.remove(record)
+            self._futures.pop(record['id'])
+            self._pending_rows -= len(rows)
+            raise
+        self._unsynced = True
+        if self._pending_rows >= self.flush_max_rows and self._wakeup:
+            self._wakeup.set()
+        return future
+
+    def request_flush(self):
+        # Сбросить очередь, не дожидаясь таймера (например, при импорте выписки)
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _add_pending(self, record: dict) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(record)
+        self._futures[record['id']] = future
+        self._pending_rows += len(record['rows'])
+        return future
+
+    async def _verify(self, rows: list[list], start_row: int) -> bool:
+        if not self.verifier:
+            return False
+        try:
+            return await self.verifier(rows, start_row)
+        except Exception as e:
+            print(f"Не удалось проверить прерванный пакет записи (строка {start_row}): {e}")
+            return False
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    @property
+    def retry_in(self) -> float:
+        # Сколько секунд осталось до повтора пакета после ошибки (0 - очередь пишет в обычном режиме)
+        return max(0.0, self._retry_at - time.monotonic())
+
+    async def flush(self, force: bool = False):
+        # Пакеты пишутся строго по одному: от порядка записи зависят номера строк и нарастающие балансы.
+        # force - не ждать окончания задержки перед повтором (явный сброс и остановка)
+        async with self._flush_lock:
+            if force or not self.retry_in:
+                await self._flush_batch()
+
+    async def _compact_journal(self):
+        # Сжатие журнала переписывает файл с fsync - в пуле потоков, чтобы не останавливать event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.journal.compact, self._pending)
+
+    async def _sync_journal(self):
+        if self._unsynced:
+            self._unsynced = False
+            await asyncio.get_running_loop().run_in_executor(None, self.journal.sync)
+
+    def _fail_batch(self, batch: list[dict], rows: list[list], error: Exception):
+        # Пакет больше не повторяется: заявки закрываются в журнале, ожидающие получают ошибку
+        ids = [record['id'] for record in batch]
+        self.journal.append({'op': 'failed', 'ids': ids, 'error': str(error)[:500]}, sync=False)
+        self._unsynced = True
+        self._pending_rows -= len(rows)
+        for ticket_id in ids:
+            future = self._futures.pop(ticket_id)
+            if not future.done():
+                future.set_exception(error)
+        if self.on_failed:
+            try:
+                self.on_failed(rows, error)
+            except Exception as e_callback:
+                print(f"Ошибка обработчика отклонённого пакета: {e_callback}")
+
+    def _batch_verified(self, rows: list[list]):
+        if self.on_verified:
+            try:
+                self.on_verified(rows)
+            except Exception as e_callback:
+                print(f"Ошибка обработчика пакета, найденного в таблице: {e_callback}")
+
+    async def _flush_batch(self):
+        if not self._pending:
+            return
+        await self._sync_journal()
+        batch = []
+        batch_rows = 0
+        # Заявка не делится между пакетами: СМС из одного сообщения записываются вместе
+        while self._pending and (not batch or batch_rows + len(self._pending[0]['rows']) <= self.flush_max_rows):
+            record = self._pending.pop(0)
+            batch.append(record)
+            batch_rows += len(record['rows'])
+        ids = [record['id'] for record in batch]
+        rows = [row for record in batch for row in record['rows']]
+
+        begun_at = []
+
+        def on_begin(start_row: int):
+            begun_at.append(start_row)
+            self.journal.append({'op': 'begin', 'ids': ids, 'start_row': start_row})
+
+        try:
+            written_range = await self.writer(rows, on_begin)
+        except Exception as e:
+            print(f"Ошибка пакетной записи {len(rows)} строк в Google Sheets: {e}")
+            # Запрос мог дойти до таблицы (например, при таймауте) - перед повтором проверяем, не записаны ли строки
+            if not (begun_at and await self._verify(rows, begun_at[-1])):
+                self._failures += 1
+                transient = self.is_transient is None or self.is_transient(e)
+                if not transient or self._failures >= self.max_attempts:
+                    reason = 'постоянная ошибка' if not transient else f'{self._failures} неудачных попыток подряд'
+                    print(f"Пакет из {len(rows)} строк отклонён ({reason}).")
+                    self._failures = 0
+                    self._retry_at = 0.0
+                    self._fail_batch(batch, rows, e)
+                    if self._pending:
+                        self._wakeup.set()
+                    return
+                delay = random.uniform(0.5, 1.0) * min(self.retry_max, self.retry_base * 2 ** (self._failures - 1))
+                self._retry_at = time.monotonic() + delay
+                print(f"Пакет будет повторён через {delay:.1f} сек (попытка {self._failures + 1}/{self.max_attempts}).")
+                self._pending[:0] = batch
+                return
+            written_range = None
+            self._batch_verified(rows)
+
+        self._failures = 0
+        self._retry_at = 0.0
+        self.journal.append({'op': 'done', 'ids': ids, 'range': list(written_range) if written_range else None}, sync=False)
+        self._unsynced = True
+        self._pending_rows -= batch_rows
+        for ticket_id in ids:
+            future = self._futures.pop(ticket_id)
+            if not future.done():
+                future.set_result(written_range)
+        if not self._pending:
+            await self._compact_journal()
+        if self._pending_rows >= self.flush_max_rows:
+            self._wakeup.set()
+
+    async def stop(self):
+        self._stopping = True
+        if self._task:
+            self._wakeup.set()
+            try:
+                await self._task
+            except Exception as e:
+                print(f"Ошибка при остановке очереди записи: {e}")
+        # Последняя попытка записать накопленное; что не записалось - останется в журнале до следующего запуска
+        await self.flush(force=True)
+        await self._sync_journal()
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()